@@ -0,0 +1,515 @@
+"""
+Local stand-ins for Ollama, the Moltbot gateway, Home Assistant and the
+outbound services the bridge talks to.
+
+They speak just enough of each protocol for the add-ons to run against them:
+
+- Ollama: ``/api/chat`` and ``/api/generate`` stream NDJSON at a configurable
+  token rate after a configurable first-token latency, ending with the usual
+  stats frame. ``/api/pull`` streams download progress for ``--pull-time``
+  seconds and then lists the model in ``/api/tags``. Generating loads a
+  model for its ``keep_alive`` (``keep_alive: 0`` unloads it), after a
+  ``--load-duration`` wait if it wasn't loaded, and ``/api/ps`` lists what
+  is loaded; unknown models get 404. ``/api/show`` and ``/api/version``
+  return fixed data.
+- Moltbot gateway: ``/api/chat`` streams the same way when ``stream`` is set,
+  otherwise returns one JSON body.
+- Home Assistant: the WebSocket API at ``/api/websocket`` with the
+  ``auth_required``/``auth_ok`` handshake, ``get_states`` for a configurable
+  number of entities, the registry lists, ``subscribe_events`` and
+  ``call_service`` (which sends a ``state_changed`` event to every connection). Optionally fires
+  random state changes at a fixed rate.
+- Messaging provider: Twilio's ``Messages.json``, BlueBubbles'
+  ``/api/v1/message/text`` and Matrix's room ``send`` endpoint, all answering
+  429 with ``Retry-After`` above ``--provider-rate`` requests per second and
+  500 for a ``--provider-failure-rate`` share of requests. ``/received``
+  lists what was delivered.
+- Google HomeGraph: ``reportStateAndNotification`` and ``requestSync`` with a
+  bearer token, answering 400 ``INVALID_ARGUMENT`` for a batch holding an
+  out-of-range percentage, and with the same 429/500 behaviour as the
+  messaging provider. ``/reported`` shows the latest state of each device
+  and how many calls were made.
+
+Run them all: ``python fakes.py --token-rate 50 --entities 5000``
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import WSMsgType, web
+
+DOMAINS = ("light", "switch", "sensor", "binary_sensor", "climate", "media_player", "cover")
+
+
+class FakeSettings:
+    def __init__(self, token_rate=50.0, latency=0.2, tokens=64, load_duration=0.0,
+                 entities=2000, areas=20, event_rate=0.0, pull_time=2.0,
+                 provider_rate=0.0, provider_failure_rate=0.0):
+        self.token_rate = token_rate
+        self.latency = latency
+        self.tokens = tokens
+        self.load_duration = load_duration
+        self.entities = entities
+        self.areas = areas
+        self.event_rate = event_rate
+        self.pull_time = pull_time
+        self.provider_rate = provider_rate
+        self.provider_failure_rate = provider_failure_rate
+
+
+async def stream_tokens(request, settings, frame, final):
+    """Write ``settings.tokens`` NDJSON frames at ``settings.token_rate``, then ``final``."""
+    started = time.monotonic()
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await asyncio.sleep(settings.latency)
+    await response.prepare(request)
+    interval = 1.0 / settings.token_rate if settings.token_rate > 0 else 0
+    first = time.monotonic()
+    for i in range(settings.tokens):
+        await response.write((json.dumps(frame(f"tok{i} ")) + "\n").encode())
+        # Sleep to the schedule rather than a fixed interval so write time doesn't skew the rate
+        delay = first + (i + 1) * interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await response.write((json.dumps(final(time.monotonic() - started, time.monotonic() - first)) + "\n").encode())
+    await response.write_eof()
+    return response
+
+
+# --- Ollama ---
+
+def parse_keep_alive(value, default=300.0):
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    for unit in ("ms", "s", "m", "h"):
+        if value.endswith(unit) and value[:-len(unit)].lstrip("-").replace(".", "", 1).isdigit():
+            return float(value[:-len(unit)]) * units[unit]
+    return float(value)
+
+
+def ollama_app(settings):
+    installed = ["fake:latest"]
+    # model -> expiry (epoch seconds)
+    loaded = {}
+
+    async def generate(request):
+        body = await request.json()
+        model = body.get("model", "fake:latest")
+        if ":" not in model:
+            model += ":latest"
+        if model not in installed:
+            return web.json_response({"error": f"model '{model}' not found"}, status=404)
+        keep_alive = parse_keep_alive(body.get("keep_alive"))
+        # A model that isn't loaded costs --load-duration first, as a cold load does
+        load = settings.load_duration if loaded.get(model, 0) <= time.time() and keep_alive != 0 else 0.0
+        if keep_alive == 0:
+            loaded.pop(model, None)
+        else:
+            loaded[model] = time.time() + (keep_alive if keep_alive > 0 else 10 ** 9)
+        chat = request.path == "/api/chat"
+        if not body.get("messages") and not body.get("prompt"):
+            # Load or unload only
+            await asyncio.sleep(load)
+            return web.json_response({"model": model, "response": "", "done": True,
+                                      "done_reason": "unload" if keep_alive == 0 else "load"})
+        await asyncio.sleep(load)
+
+        def frame(text):
+            if chat:
+                return {"model": model, "message": {"role": "assistant", "content": text}, "done": False}
+            return {"model": model, "response": text, "done": False}
+
+        def final(total, decode):
+            return {
+                "model": model, "done": True, "done_reason": "stop",
+                "total_duration": int(total * 1e9),
+                "load_duration": int(load * 1e9),
+                "prompt_eval_count": 32,
+                "prompt_eval_duration": int(settings.latency * 1e9),
+                "eval_count": settings.tokens,
+                "eval_duration": int(decode * 1e9),
+            }
+
+        if body.get("stream") is False:
+            await asyncio.sleep(settings.latency + settings.tokens / max(settings.token_rate, 1e-9))
+            result = final(settings.latency, settings.tokens / max(settings.token_rate, 1e-9))
+            text = "".join(f"tok{i} " for i in range(settings.tokens))
+            result.update({"message": {"role": "assistant", "content": text}} if chat else {"response": text})
+            return web.json_response(result)
+        return await stream_tokens(request, settings, frame, final)
+
+    async def tags(request):
+        return web.json_response({"models": [
+            {"name": name, "model": name, "size": 2_000_000_000,
+             "details": {"parameter_size": "3B", "quantization_level": "Q4_K_M"}}
+            for name in installed
+        ]})
+
+    async def pull(request):
+        body = await request.json()
+        name = body.get("model") or body.get("name", "")
+        if ":" not in name:
+            name += ":latest"
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        async def send(event):
+            await response.write((json.dumps(event) + "\n").encode())
+
+        await send({"status": "pulling manifest"})
+        total, steps = 2_000_000_000, 20
+        for i in range(1, steps + 1):
+            await asyncio.sleep(settings.pull_time / steps)
+            await send({"status": "pulling 0123456789ab", "digest": "sha256:0123456789ab",
+                        "total": total, "completed": total * i // steps})
+        for status in ("verifying sha256 digest", "writing manifest", "success"):
+            await send({"status": status})
+        if name not in installed:
+            installed.append(name)
+        await response.write_eof()
+        return response
+
+    async def version(request):
+        return web.json_response({"version": "0.0.0-fake"})
+
+    async def ps(request):
+        now = time.time()
+        for name in [name for name, expiry in loaded.items() if expiry <= now]:
+            del loaded[name]
+        return web.json_response({"models": [
+            {"name": name, "model": name, "size": 2_000_000_000, "size_vram": 0,
+             "expires_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(expiry)) + ".123456789Z"}
+            for name, expiry in loaded.items()
+        ]})
+
+    async def show(request):
+        return web.json_response({"details": {"parameter_size": "3B"}, "model_info": {}})
+
+    # Ollama takes image prompts of any size
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_post("/api/chat", generate)
+    app.router.add_post("/api/generate", generate)
+    app.router.add_get("/api/tags", tags)
+    app.router.add_get("/api/ps", ps)
+    app.router.add_post("/api/show", show)
+    app.router.add_post("/api/pull", pull)
+    app.router.add_get("/api/version", version)
+    return app
+
+
+# --- Moltbot gateway ---
+
+def gateway_app(settings):
+    async def chat(request):
+        body = await request.json()
+        if not body.get("stream"):
+            await asyncio.sleep(settings.latency + settings.tokens / max(settings.token_rate, 1e-9))
+            return web.json_response({"content": "".join(f"tok{i} " for i in range(settings.tokens))})
+        return await stream_tokens(
+            request, settings,
+            lambda text: {"message": {"content": text}, "done": False},
+            lambda total, decode: {"done": True},
+        )
+
+    app = web.Application()
+    app.router.add_post("/api/chat", chat)
+    return app
+
+
+# --- Home Assistant ---
+
+def make_states(count, areas):
+    states = []
+    for i in range(count):
+        domain = DOMAINS[i % len(DOMAINS)]
+        states.append({
+            "entity_id": f"{domain}.fake_{i}",
+            "state": "on" if i % 2 else "off",
+            "attributes": {
+                "friendly_name": f"Fake {domain.replace('_', ' ')} {i}",
+                "area": f"area_{i % areas}",
+                "supported_features": 0,
+            },
+            "last_changed": "2024-01-01T00:00:00+00:00",
+            "last_updated": "2024-01-01T00:00:00+00:00",
+            "context": {"id": f"ctx{i}", "parent_id": None, "user_id": None},
+        })
+    return states
+
+
+def home_assistant_app(settings):
+    states = make_states(settings.entities, settings.areas)
+    by_id = {s["entity_id"]: s for s in states}
+    area_list = [{"area_id": f"area_{i}", "name": f"Area {i}"} for i in range(settings.areas)]
+    device_list = [{"id": f"dev_{i}", "area_id": f"area_{i % settings.areas}"}
+                   for i in range(settings.entities // 4)]
+    entity_list = [{"entity_id": s["entity_id"], "device_id": f"dev_{i // 4}", "area_id": None}
+                   for i, s in enumerate(states)]
+    # One fire() per open connection; state changes reach every subscriber, as in HA
+    connections = set()
+    registries = {
+        "config/area_registry/list": area_list,
+        "config/device_registry/list": device_list,
+        "config/entity_registry/list": entity_list,
+    }
+
+    def change(entity_id, state):
+        old = by_id[entity_id]
+        new = dict(old, state=state, last_updated=time.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
+        by_id[entity_id] = new
+        return {"event_type": "state_changed",
+                "data": {"entity_id": entity_id, "old_state": old, "new_state": new}}
+
+    async def websocket(request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        await ws.send_json({"type": "auth_required", "ha_version": "2024.1.0"})
+        auth = await ws.receive_json()
+        if auth.get("type") != "auth":
+            await ws.close()
+            return ws
+        await ws.send_json({"type": "auth_ok", "ha_version": "2024.1.0"})
+
+        subscriptions = {}
+        storm = None
+
+        async def fire(event):
+            sub = subscriptions.get(event["event_type"])
+            if sub is not None and not ws.closed:
+                await ws.send_json({"id": sub, "type": "event", "event": event})
+
+        async def broadcast(event):
+            for send in list(connections):
+                await send(event)
+
+        async def event_storm():
+            names = list(by_id)
+            while not ws.closed:
+                await asyncio.sleep(1.0 / settings.event_rate)
+                await fire(change(random.choice(names), random.choice(("on", "off"))))
+
+        async def handle(msg):
+            kind = msg.get("type")
+            result = None
+            if kind == "subscribe_events":
+                subscriptions[msg.get("event_type")] = msg["id"]
+            elif kind == "get_states":
+                result = list(by_id.values())
+            elif kind in registries:
+                result = registries[kind]
+            elif kind == "call_service":
+                result = {"context": {"id": "fake"}}
+            elif kind == "ping":
+                await ws.send_json({"id": msg["id"], "type": "pong"})
+                return
+            await ws.send_json({"id": msg["id"], "type": "result", "success": True, "result": result})
+            if kind == "call_service":
+                target = (msg.get("target") or msg.get("service_data") or {}).get("entity_id")
+                if isinstance(target, str) and target in by_id:
+                    await broadcast(change(target, "on" if msg.get("service") == "turn_on" else "off"))
+
+        connections.add(fire)
+        try:
+            if settings.event_rate > 0:
+                storm = asyncio.create_task(event_storm())
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
+                for msg in data if isinstance(data, list) else [data]:
+                    await handle(msg)
+        finally:
+            connections.discard(fire)
+            if storm is not None:
+                storm.cancel()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/api/websocket", websocket)
+    return app
+
+
+# --- Messaging provider ---
+
+def messaging_app(settings):
+    received = []
+    # Matrix transaction ids seen, so a retried send is not delivered twice
+    transactions = set()
+    recent = []
+
+    async def limited(request):
+        """None to accept the request, else the error response a real provider would give."""
+        now = time.monotonic()
+        recent[:] = [t for t in recent if now - t < 1.0]
+        if settings.provider_rate > 0 and len(recent) >= settings.provider_rate:
+            if "/_matrix/" in request.path:
+                return web.json_response({"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 1000}, status=429)
+            return web.json_response({"message": "Too Many Requests"}, status=429, headers={"Retry-After": "1"})
+        recent.append(now)
+        if random.random() < settings.provider_failure_rate:
+            return web.json_response({"message": "Internal error"}, status=500)
+        return None
+
+    async def twilio(request):
+        error = await limited(request)
+        if error is not None:
+            return error
+        form = await request.post()
+        if not form.get("To") or not form.get("Body"):
+            return web.json_response({"code": 21604, "message": "A 'To' phone number is required."}, status=400)
+        received.append({"provider": "twilio", "target": form["To"], "body": form["Body"], "at": time.time()})
+        return web.json_response({"sid": f"SM{len(received):032d}", "status": "queued"}, status=201)
+
+    async def bluebubbles(request):
+        error = await limited(request)
+        if error is not None:
+            return error
+        body = await request.json()
+        received.append({"provider": "bluebubbles", "target": body.get("chatGuid"),
+                         "body": body.get("message"), "at": time.time()})
+        return web.json_response({"status": 200, "message": "Message sent!"})
+
+    async def matrix(request):
+        error = await limited(request)
+        if error is not None:
+            return error
+        txn = request.match_info["txn"]
+        if txn not in transactions:
+            transactions.add(txn)
+            body = await request.json()
+            received.append({"provider": "matrix", "target": request.match_info["room"],
+                             "body": body.get("body"), "at": time.time()})
+        return web.json_response({"event_id": f"$fake{txn}"})
+
+    async def list_received(request):
+        return web.json_response(received)
+
+    app = web.Application()
+    app.router.add_post("/2010-04-01/Accounts/{sid}/Messages.json", twilio)
+    app.router.add_post("/api/v1/message/text", bluebubbles)
+    app.router.add_put("/_matrix/client/v3/rooms/{room}/send/m.room.message/{txn}", matrix)
+    app.router.add_get("/received", list_received)
+    return app
+
+
+def homegraph_app(settings):
+    devices = {}
+    calls = {"report_state": 0, "request_sync": 0, "rejected": 0, "devices_sent": 0}
+    recent = []
+
+    def check(request):
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return web.json_response({"error": {"code": 401, "status": "UNAUTHENTICATED"}}, status=401)
+        now = time.monotonic()
+        recent[:] = [t for t in recent if now - t < 1.0]
+        if settings.provider_rate > 0 and len(recent) >= settings.provider_rate:
+            return web.json_response({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}, status=429,
+                                     headers={"Retry-After": "1"})
+        recent.append(now)
+        if random.random() < settings.provider_failure_rate:
+            return web.json_response({"error": {"code": 500, "status": "INTERNAL"}}, status=500)
+        return None
+
+    async def report_state(request):
+        error = check(request)
+        if error is not None:
+            return error
+        body = await request.json()
+        states = body["payload"]["devices"]["states"]
+        calls["report_state"] += 1
+        for device_id, state in states.items():
+            for key in ("brightness", "openPercent", "currentFanSpeedPercent"):
+                if key in state and not 0 <= state[key] <= 100:
+                    calls["rejected"] += 1
+                    return web.json_response({"error": {
+                        "code": 400, "status": "INVALID_ARGUMENT",
+                        "message": f"Invalid value for {key} of device {device_id}"}}, status=400)
+        devices.update(states)
+        calls["devices_sent"] += len(states)
+        return web.json_response({"requestId": body.get("requestId")})
+
+    async def request_sync(request):
+        error = check(request)
+        if error is not None:
+            return error
+        calls["request_sync"] += 1
+        return web.json_response({})
+
+    async def reported(request):
+        return web.json_response(dict(calls, devices=devices))
+
+    app = web.Application()
+    app.router.add_post("/v1/devices:reportStateAndNotification", report_state)
+    app.router.add_post("/v1/devices:requestSync", request_sync)
+    app.router.add_get("/reported", reported)
+    return app
+
+
+async def serve(app, host, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def serve_all(settings, host="127.0.0.1", ollama_port=11434, gateway_port=18789, ha_port=8123,
+                    messaging_port=8090, homegraph_port=8091):
+    """Start the fakes on the current loop; returns their runners."""
+    return [
+        await serve(ollama_app(settings), host, ollama_port),
+        await serve(gateway_app(settings), host, gateway_port),
+        await serve(home_assistant_app(settings), host, ha_port),
+        await serve(messaging_app(settings), host, messaging_port),
+        await serve(homegraph_app(settings), host, homegraph_port),
+    ]
+
+
+def add_settings_arguments(parser):
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Tokens per second per stream")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens per response")
+    parser.add_argument("--load-duration", type=float, default=0.0, help="Seconds a cold model load takes")
+    parser.add_argument("--entities", type=int, default=2000, help="Entities returned by get_states")
+    parser.add_argument("--areas", type=int, default=20)
+    parser.add_argument("--event-rate", type=float, default=0.0, help="Random state_changed events per second")
+    parser.add_argument("--pull-time", type=float, default=2.0, help="Seconds a fake model pull takes")
+    parser.add_argument("--provider-rate", type=float, default=0.0,
+                        help="Messaging/HomeGraph requests per second before answering 429 (0 = unlimited)")
+    parser.add_argument("--provider-failure-rate", type=float, default=0.0,
+                        help="Share of messaging/HomeGraph requests that fail with 500")
+
+
+def settings_from_args(args):
+    return FakeSettings(token_rate=args.token_rate, latency=args.latency, tokens=args.tokens,
+                        load_duration=args.load_duration, entities=args.entities,
+                        areas=args.areas, event_rate=args.event_rate, pull_time=args.pull_time,
+                        provider_rate=args.provider_rate, provider_failure_rate=args.provider_failure_rate)
+
+
+async def _main(args):
+    await serve_all(settings_from_args(args), args.host, args.ollama_port, args.gateway_port, args.ha_port,
+                    args.messaging_port, args.homegraph_port)
+    print(f"Fake Ollama on :{args.ollama_port}, gateway on :{args.gateway_port}, "
+          f"Home Assistant on :{args.ha_port}, messaging provider on :{args.messaging_port}, "
+          f"HomeGraph on :{args.homegraph_port}", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ollama-port", type=int, default=11434)
+    parser.add_argument("--gateway-port", type=int, default=18789)
+    parser.add_argument("--ha-port", type=int, default=8123)
+    parser.add_argument("--messaging-port", type=int, default=8090)
+    parser.add_argument("--homegraph-port", type=int, default=8091)
+    add_settings_arguments(parser)
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,208 @@
+"""
+Closed-loop HTTP load generator.
+
+``concurrency`` workers each send one request, read the response to the end
+and send the next, for ``duration`` seconds per step. For every request the
+time to the first body byte and the total time are recorded; a step reports
+throughput, p50/p95/p99 of both, and the target process's memory, thread and
+file descriptor counts sampled while it ran.
+
+Single run: ``python loadgen.py http://127.0.0.1:8099/api/chat --body '{"model": "fake", "stream": true}'``
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def process_stats(pid):
+    """RSS (bytes), threads and open file descriptors of ``pid``, or None if it is gone."""
+    if psutil is not None:
+        try:
+            proc = psutil.Process(pid)
+            with proc.oneshot():
+                return {"rss": proc.memory_info().rss, "threads": proc.num_threads(), "fds": proc.num_fds()}
+        except (psutil.Error, AttributeError):
+            return None
+    try:
+        stats = {"fds": len(os.listdir(f"/proc/{pid}/fd"))}
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    stats["rss"] = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+        return stats
+    except OSError:
+        return None
+
+
+class ProcessSampler:
+    """Samples a process every ``interval`` seconds while a step runs."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            stats = process_stats(self.pid)
+            if stats:
+                self.samples.append(stats)
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        if self.pid:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        if self._task is not None:
+            self._task.cancel()
+
+    def summary(self):
+        if not self.samples:
+            return None
+        result = {}
+        for key in ("rss", "threads", "fds"):
+            values = [s[key] for s in self.samples if key in s]
+            if values:
+                result[f"{key}_max"] = max(values)
+                result[f"{key}_last"] = values[-1]
+        return result
+
+
+async def timed_request(session, method, url, body=None, headers=None):
+    """Send one request and read it to the end: ``(status, ttfb, total, bytes)``."""
+    started = time.perf_counter()
+    async with session.request(method, url, data=body, headers=headers) as resp:
+        ttfb = None
+        size = 0
+        async for chunk in resp.content.iter_any():
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            size += len(chunk)
+        total = time.perf_counter() - started
+        return resp.status, ttfb if ttfb is not None else total, total, size
+
+
+async def run_step(url, concurrency, duration, method="GET", body=None, headers=None, pid=None,
+                   timeout=120.0):
+    """One load step at a fixed concurrency; returns its summary dict."""
+    latencies, ttfbs = [], []
+    errors = {}
+    received = 0
+    deadline = time.perf_counter() + duration
+    if isinstance(body, str):
+        body = body.encode()
+
+    connector = aiohttp.TCPConnector(limit=0)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+
+        async def worker():
+            nonlocal received
+            while time.perf_counter() < deadline:
+                try:
+                    status, ttfb, total, size = await timed_request(session, method, url, body, headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    await asyncio.sleep(0.05)
+                    continue
+                if status >= 400:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+                    # Don't spin on an overloaded target (429/503)
+                    await asyncio.sleep(0.05)
+                    continue
+                latencies.append(total)
+                ttfbs.append(ttfb)
+                received += size
+
+        started = time.perf_counter()
+        with ProcessSampler(pid) as sampler:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    def millis(values, q):
+        value = percentile(values, q)
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "bytes_per_s": round(received / elapsed) if elapsed else 0,
+        "latency_ms": {f"p{q}": millis(latencies, q) for q in (50, 95, 99)},
+        "ttfb_ms": {f"p{q}": millis(ttfbs, q) for q in (50, 95, 99)},
+        "process": sampler.summary(),
+    }
+
+
+async def ramp(url, levels, duration, **kwargs):
+    """Run one step per concurrency level, in order."""
+    steps = []
+    for concurrency in levels:
+        step = await run_step(url, concurrency, duration, **kwargs)
+        print(format_step(step), flush=True)
+        steps.append(step)
+    return steps
+
+
+def format_step(step):
+    latency, ttfb = step["latency_ms"], step["ttfb_ms"]
+    line = (f"  c={step['concurrency']:<4} {step['throughput_rps']:>8.1f} req/s  "
+            f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+            f"ttfb p50={ttfb['p50']}ms")
+    if step["process"]:
+        proc = step["process"]
+        line += (f"  rss={proc.get('rss_max', 0) / 2**20:.1f}MiB "
+                 f"threads={proc.get('threads_max')} fds={proc.get('fds_max')}")
+    if step["errors"]:
+        line += f"  errors={step['errors']}"
+    return line
+
+
+def parse_levels(text):
+    return [int(level) for level in text.split(",") if level.strip()]
+
+
+async def _main(args):
+    headers = {"Content-Type": "application/json"} if args.body else None
+    method = args.method or ("POST" if args.body else "GET")
+    steps = await ramp(args.url, parse_levels(args.concurrency), args.duration,
+                       method=method, body=args.body, headers=headers, pid=args.pid)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"url": args.url, "method": method, "steps": steps}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop HTTP load generator")
+    parser.add_argument("url")
+    parser.add_argument("--method")
+    parser.add_argument("--body", help="Request body (sent as JSON)")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="Comma-separated levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per level")
+    parser.add_argument("--pid", type=int, help="Process to sample for memory/threads/FDs")
+    parser.add_argument("--out", help="Write results as JSON")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,194 @@
+"""
+Benchmark the Ollama UI proxy and the Moltbot bridge against local fakes.
+
+Starts the fake Ollama/gateway/Home Assistant servers (see fakes.py), then
+each target in turn as a real subprocess pointed at them, and ramps every
+scenario through the requested concurrency levels. Results go to a JSON file
+so runs can be compared:
+
+    python run.py --out before.json
+    ... change something ...
+    python run.py --out after.json
+    python run.py --compare before.json after.json
+
+Both targets listen on port 8099, so they are benchmarked one after another.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+from fakes import add_settings_arguments, serve_all, settings_from_args
+from loadgen import parse_levels, process_stats, ramp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_PORT = 8099
+FAKE_OLLAMA_PORT = 11434
+FAKE_GATEWAY_PORT = 18789
+FAKE_HA_PORT = 8123
+
+CHAT_BODY = {"model": "fake:latest", "messages": [{"role": "user", "content": "Hello"}], "stream": True}
+
+# target -> (working directory, command, environment, {scenario: request})
+TARGETS = {
+    "ollama": (
+        os.path.join(ROOT, "ollama"),
+        [sys.executable, "web_server.py"],
+        {"OLLAMA_URL": f"http://127.0.0.1:{FAKE_OLLAMA_PORT}"},
+        {
+            "chat_stream": {"method": "POST", "path": "/api/chat", "body": CHAT_BODY},
+            "tags": {"method": "GET", "path": "/api/tags"},
+            "index": {"method": "GET", "path": "/", "headers": {"Accept-Encoding": "br, gzip"}},
+        },
+    ),
+    "bridge": (
+        os.path.join(ROOT, "moltbot_bridge"),
+        [sys.executable, "bridge.py"],
+        {
+            "HA_URL": f"http://127.0.0.1:{FAKE_HA_PORT}/api",
+            "HA_TOKEN": "benchmark",
+            "GATEWAY_URL": f"http://127.0.0.1:{FAKE_GATEWAY_PORT}",
+            "LOG_LEVEL": "warning",
+        },
+        {
+            "chat_stream": {"method": "POST", "path": "/api/chat", "body": {"message": "Hello", "stream": True}},
+            "chat_json": {"method": "POST", "path": "/api/chat", "body": {"message": "Hello"}},
+            "index": {"method": "GET", "path": "/", "headers": {"Accept-Encoding": "br, gzip"}},
+        },
+    ),
+}
+
+
+def wait_for_port(port, timeout=30.0, proc=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"Target exited with code {proc.returncode} before listening")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout:.0f}s")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench_target(name, levels, duration, scenarios, log_dir):
+    cwd, command, env, requests = TARGETS[name]
+    log_path = os.path.join(log_dir, f"{name}.log")
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(command, cwd=cwd, env={**os.environ, **env},
+                                stdout=log, stderr=subprocess.STDOUT)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, wait_for_port, TARGET_PORT, 30.0, proc)
+        # Let the bridge finish its Home Assistant sync before measuring
+        await asyncio.sleep(1.0)
+        result = {"idle": process_stats(proc.pid), "scenarios": {}}
+        for scenario, spec in requests.items():
+            if scenarios and scenario not in scenarios:
+                continue
+            print(f"{name}/{scenario}", flush=True)
+            body = json.dumps(spec["body"]) if "body" in spec else None
+            headers = dict(spec.get("headers", {}))
+            if body:
+                headers["Content-Type"] = "application/json"
+            result["scenarios"][scenario] = await ramp(
+                f"http://127.0.0.1:{TARGET_PORT}{spec['path']}", levels, duration,
+                method=spec["method"], body=body, headers=headers, pid=proc.pid)
+        result["final"] = process_stats(proc.pid)
+        return result
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+async def run_suite(args):
+    settings = settings_from_args(args)
+    runners = await serve_all(settings, "127.0.0.1", FAKE_OLLAMA_PORT, FAKE_GATEWAY_PORT, FAKE_HA_PORT)
+    levels = parse_levels(args.concurrency)
+    os.makedirs(args.log_dir, exist_ok=True)
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "levels": levels,
+            "duration_s": args.duration,
+            "fakes": vars(settings),
+        },
+        "targets": {},
+    }
+    try:
+        for name in args.targets.split(","):
+            results["targets"][name] = await bench_target(name, levels, args.duration, args.scenario, args.log_dir)
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.out}")
+
+
+def _pct(old, new):
+    if not old or new is None:
+        return "   n/a"
+    return f"{(new - old) / old * 100:+6.1f}%"
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['meta'].get('revision')} -> {after['meta'].get('revision')}")
+    for target, data in after["targets"].items():
+        for scenario, steps in data["scenarios"].items():
+            old_steps = {s["concurrency"]: s for s in
+                         before["targets"].get(target, {}).get("scenarios", {}).get(scenario, [])}
+            print(f"{target}/{scenario}")
+            for step in steps:
+                old = old_steps.get(step["concurrency"])
+                if old is None:
+                    print(f"  c={step['concurrency']:<4} (no baseline)")
+                    continue
+                print(f"  c={step['concurrency']:<4} "
+                      f"rps {old['throughput_rps']:>8.1f} -> {step['throughput_rps']:>8.1f} "
+                      f"{_pct(old['throughput_rps'], step['throughput_rps'])}   "
+                      f"p95 {old['latency_ms']['p95']} -> {step['latency_ms']['p95']}ms "
+                      f"{_pct(old['latency_ms']['p95'], step['latency_ms']['p95'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark for the add-ons")
+    parser.add_argument("--targets", default="ollama,bridge", help="Comma-separated: " + ",".join(TARGETS))
+    parser.add_argument("--scenario", action="append", help="Only run this scenario (repeatable)")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="Comma-separated levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per level")
+    parser.add_argument("--out", default="results.json")
+    parser.add_argument("--log-dir", default="logs", help="Where target output is written")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        asyncio.run(run_suite(args))
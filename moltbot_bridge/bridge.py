@@ -1,15 +1,29 @@
 import asyncio
 import logging
 import os
-import json
+import random
 import signal
 import sys
-from typing import Optional, List, Dict, Any
+import time
+from typing import Optional, List, Dict, Any, Callable
 from pydantic import BaseModel, Field, ValidationError
 import aiohttp
 from aiohttp import web
 import websockets
 
+from chat_stream import ChatStreamWriter, iter_gateway_tokens
+from conversations import ConversationStore, estimate_tokens
+from entity_index import EntityIndex
+from homegraph import HOMEGRAPH_URL, GoogleIntegration, ServiceAccountToken, StaticToken
+from http_client import RetryPolicy, SharedHttpClient
+from json_codec import JsonCodec, get_codec
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from model_catalog import ModelCatalog, default_cache_dir, with_variants
+from outbox import BlueBubblesProvider, MatrixProvider, Outbox, Provider, TwilioProvider
+from response_cache import ChatResponseCache, referenced_entities
+from state_store import EntityStore
+from static_assets import StaticAssets
+
 # --- Configuration & Validation ---
 
 class AddonConfig(BaseModel):
@@ -24,6 +38,41 @@ class AddonConfig(BaseModel):
     whatsapp_sid: Optional[str] = None
     whatsapp_token: Optional[str] = None
     whatsapp_from: Optional[str] = None
+    twilio_api_url: str = "https://api.twilio.com"
+    # Sends per second for every provider; 0 keeps each provider's own limit
+    message_rate: float = 0
+    message_max_attempts: int = 8
+
+    # Moltbot Gateway / outbound HTTP
+    gateway_url: str = "http://localhost:18789"
+    gateway_timeout: float = 300.0
+    http_timeout: float = 30.0
+    http_pool_size: int = 100
+    http_retries: int = 3
+
+    # Ollama add-on web server (port 8099); lets model switches skip the add-on restart
+    ollama_ui_url: Optional[str] = None
+
+    # Chat response cache for repeated questions; 0 disables it
+    response_cache_ttl: float = 0
+    response_cache_mb: float = 8
+    # provider/model the gateway answers with (set by run.sh); part of the cache key
+    chat_model: str = ""
+
+    # Chat history per session, trimmed to fit the model's context window
+    chat_context_tokens: int = 2048
+    chat_session_timeout: float = 1800
+    chat_max_sessions: int = 100
+    # Entities relevant to each message added to the prompt; 0 disables it
+    chat_context_entities: int = 8
+
+    # Google HomeGraph state reporting, enabled by a service account key file
+    google_creds: str = "/config/moltbot/google_creds.json"
+    google_agent_user_id: str = "moltbot"
+    google_report_debounce: float = 1.0
+    homegraph_url: str = HOMEGRAPH_URL
+    # Fixed access token instead of the key file, e.g. for a local stand-in HomeGraph
+    homegraph_token: Optional[str] = None
 
 # --- Logging Setup ---
 def setup_logging(level_str: str):
@@ -36,9 +85,67 @@ def setup_logging(level_str: str):
 
 logger = logging.getLogger("MoltbotAddon")
 
+# --- Metrics ---
+CHAT_SECONDS = REGISTRY.histogram(
+    "moltbot_chat_duration_seconds", "End-to-end /api/chat latency", labels=("mode",))
+GATEWAY_TTFB_SECONDS = REGISTRY.histogram(
+    "moltbot_gateway_ttfb_seconds", "Time until the Moltbot gateway returned response headers", labels=("mode",))
+GATEWAY_FIRST_TOKEN_SECONDS = REGISTRY.histogram(
+    "moltbot_gateway_first_token_seconds", "Time until the first streamed token arrived from the gateway")
+CHAT_CACHE = REGISTRY.counter(
+    "moltbot_chat_cache_total", "Chat response cache lookups", labels=("result",))
+CHAT_CACHE_BYTES = REGISTRY.gauge(
+    "moltbot_chat_cache_bytes", "Text held by the chat response cache")
+CHAT_SESSIONS = REGISTRY.gauge(
+    "moltbot_chat_sessions", "Chat sessions with history in memory")
+CHAT_HISTORY_TOKENS = REGISTRY.gauge(
+    "moltbot_chat_history_tokens", "Estimated tokens of chat history held across all sessions")
+CHAT_HISTORY_COMPACTIONS = REGISTRY.counter(
+    "moltbot_chat_history_compactions_total", "Times a session's oldest turns were folded into its summary")
+CHAT_CONTEXT_TOKENS = REGISTRY.histogram(
+    "moltbot_chat_context_tokens", "Estimated prompt tokens of the Home Assistant entities added to a message",
+    buckets=(0, 25, 50, 100, 200, 400, 800))
+HA_COMMAND_SECONDS = REGISTRY.histogram(
+    "moltbot_ha_command_duration_seconds", "Home Assistant WebSocket command round-trip time", labels=("type",))
+HA_COMMAND_ERRORS = REGISTRY.counter(
+    "moltbot_ha_command_errors_total", "Home Assistant commands that failed without a reply", labels=("type", "reason"))
+HA_CONNECTS = REGISTRY.counter(
+    "moltbot_ha_connects_total", "Connection attempts to Home Assistant", labels=("result",))
+HA_RECONNECTS = REGISTRY.counter(
+    "moltbot_ha_reconnects_total", "Successful connections after an earlier connection was lost")
+HA_AUTH_FAILURES = REGISTRY.counter(
+    "moltbot_ha_auth_failures_total", "Rejected Home Assistant authentication attempts")
+HA_WS_MESSAGES = REGISTRY.counter(
+    "moltbot_ha_ws_messages_total", "Home Assistant WebSocket messages", labels=("direction",))
+HA_WS_BYTES = REGISTRY.counter(
+    "moltbot_ha_ws_bytes_total", "Home Assistant WebSocket payload bytes", labels=("direction",))
+HA_PENDING = REGISTRY.gauge(
+    "moltbot_ha_pending_requests", "Home Assistant commands waiting for a reply")
+HA_CONNECTED = REGISTRY.gauge(
+    "moltbot_ha_connected", "1 while connected and authenticated to Home Assistant")
+
+# Reconnecting: the first retry comes within a second, then backs off with jitter so
+# a restarted Home Assistant isn't hit by every client at the same moment
+FIRST_RETRY = 1.0
+RECONNECT_BACKOFF = RetryPolicy(backoff=2.0, max_backoff=30.0)
+# A connection that drops sooner than this counts as a failed attempt, so a flapping
+# Home Assistant still gets backed off from
+STABLE_CONNECTION = 30.0
+# Largest WebSocket message accepted; a get_states reply for a big house is several MB
+WS_MAX_SIZE = 64 * 1024 * 1024
+
+
+def reconnect_delay(failures: int) -> float:
+    """Seconds to wait before the next connection attempt after ``failures`` failed ones in a row."""
+    if failures <= 1:
+        return random.uniform(0, FIRST_RETRY)
+    return RECONNECT_BACKOFF.delay(failures - 1)
+
 # --- Home Assistant Client ---
 class HomeAssistantClient:
-    def __init__(self, url: str, token: str):
+    def __init__(self, url: str, token: str, request_timeout: float = 30.0,
+                 max_inflight: int = 64, batch_commands: bool = False,
+                 codec: Optional[JsonCodec] = None, compression: Optional[str] = "deflate"):
         # Convert http(s) to ws(s)
         if url.startswith("http"):
             self.ws_url = url.replace("http", "ws") + "/websocket"
@@ -46,94 +153,276 @@ class HomeAssistantClient:
             self.ws_url = url
             
         self.token = token
+        self.codec = codec or get_codec()
+        # permessage-deflate; state dumps and events are repetitive JSON and shrink several times over
+        self.compression = compression
         self.connection = None
         self._message_id = 1
         self._futures: Dict[int, asyncio.Future] = {}
+        # Run inside the listen loop, before any later message is processed
+        self._result_handlers: Dict[int, Callable[[Dict[str, Any]], None]] = {}
         self._connected = False
+        self._was_connected = False
+        # Set by the listen task the moment the connection is lost
+        self.disconnected = asyncio.Event()
+        self._listen_task: Optional[asyncio.Task] = None
+        self.request_timeout = request_timeout
+        # Bounds both HA load and the size of _futures
+        self._inflight = asyncio.Semaphore(max_inflight)
+        # Commands issued in the same loop tick go out as one JSON array frame
+        self.batch_commands = batch_commands
+        self._outbox: List[tuple] = []
+        self._flush_scheduled = False
+        self.store = EntityStore()
+        self._registry_refresh: Optional[asyncio.Task] = None
 
     async def connect(self):
         logger.info(f"Connecting to Home Assistant at {self.ws_url}")
         try:
             extra_headers = {"Authorization": f"Bearer {self.token}"}
             # websockets 16.0+ uses additional_headers instead of extra_headers
-            self.connection = await websockets.connect(self.ws_url, additional_headers=extra_headers)
-            auth_msg = await self.connection.recv()
-            auth_data = json.loads(auth_msg)
+            self.connection = await websockets.connect(self.ws_url, additional_headers=extra_headers,
+                                                       compression=self.compression, max_size=WS_MAX_SIZE)
+            async with asyncio.timeout(self.request_timeout):
+                auth_msg = await self.connection.recv(decode=False)
+            auth_data = self.codec.loads(auth_msg)
             
             if auth_data.get("type") == "auth_required":
-                await self.connection.send(json.dumps({
+                await self.connection.send(self.codec.dumps({
                     "type": "auth",
                     "access_token": self.token
                 }))
                 
-                auth_resp_raw = await self.connection.recv()
-                auth_resp = json.loads(auth_resp_raw)
+                async with asyncio.timeout(self.request_timeout):
+                    auth_resp_raw = await self.connection.recv(decode=False)
+                auth_resp = self.codec.loads(auth_resp_raw)
                 
                 if auth_resp.get("type") == "auth_ok":
-                    logger.info("Authenticated with Home Assistant")
+                    logger.info("Authenticated with Home Assistant "
+                                f"(JSON: {self.codec.name}, compression: {self.compression or 'off'})")
+                    if self._was_connected:
+                        HA_RECONNECTS.inc()
                     self._connected = True
+                    self._was_connected = True
+                    self.disconnected.clear()
+                    HA_CONNECTED.set(1)
                     # Start listening loop
-                    asyncio.create_task(self.listen())
+                    self._listen_task = asyncio.create_task(self.listen())
+                    # Subscriptions don't survive a reconnect; resubscribe and resync every time
+                    await self._sync_state()
+                    HA_CONNECTS.inc(result="ok")
                 else:
                     logger.error(f"Authentication failed: {auth_resp}")
+                    HA_AUTH_FAILURES.inc()
                     raise ConnectionError(f"Auth failed: {auth_resp}")
             else:
-                logger.warning(f"Unexpected initial sequence: {auth_data}")
+                raise ConnectionError(f"Unexpected initial sequence: {auth_data}")
 
         except Exception as e:
             logger.error(f"Failed to connect to HA: {e}")
+            HA_CONNECTS.inc(result="error")
+            if self.connection is not None:
+                # Ends the listen task, which fails anything still pending
+                await self.connection.close()
             raise
 
     async def listen(self):
         try:
-            async for message in self.connection:
+            while True:
+                # Text frames stay bytes; the codec parses UTF-8 directly without a str copy
+                message = await self.connection.recv(decode=False)
+                HA_WS_BYTES.inc(len(message), direction="in")
                 try:
-                    data = json.loads(message)
+                    data = self.codec.loads(message)
                     # logger.debug(f"Received: {data}")
-                    
-                    # Handle responses to our requests
-                    if "id" in data and data["id"] in self._futures:
-                        self._futures[data["id"]].set_result(data)
-                        del self._futures[data["id"]]
-                        
-                    # Event handling can go here
-                except json.JSONDecodeError:
-                    logger.warning(f"Received invalid JSON: {message}")
+                    # With coalesce_messages, HA may pack several messages into one frame
+                    items = data if isinstance(data, list) else (data,)
+                    HA_WS_MESSAGES.inc(len(items), direction="in")
+                    for item in items:
+                        self._dispatch(item)
+                except ValueError:
+                    logger.warning(f"Received invalid JSON: {message[:200]!r}")
         except websockets.ConnectionClosed:
             logger.warning("Connection closed")
-            self._connected = False
         except Exception as e:
             logger.error(f"Listen loop error: {e}")
+        finally:
             self._connected = False
-            
-    async def call_service(self, domain: str, service: str, service_data: Dict[str, Any] = None):
+            # Changes made while disconnected are missed; the next snapshot marks it synced again
+            self.store.synced = False
+            HA_CONNECTED.set(0)
+            self._fail_pending(ConnectionError("Connection to Home Assistant lost"))
+            self.disconnected.set()
+
+    def _dispatch(self, data: Dict[str, Any]):
+        # Handle responses to our requests
+        future = self._futures.pop(data.get("id"), None) if "id" in data else None
+        if future is not None:
+            handler = self._result_handlers.pop(data["id"], None)
+            if handler and data.get("success"):
+                try:
+                    handler(data.get("result"))
+                except Exception as e:
+                    logger.error(f"Result handler failed: {e}", exc_info=True)
+            if not future.done():
+                future.set_result(data)
+        elif data.get("type") == "event":
+            self._handle_event(data.get("event") or {})
+
+    def _fail_pending(self, exc: Exception):
+        """Fail every in-flight request at once instead of leaving callers hanging."""
+        futures, self._futures = self._futures, {}
+        self._result_handlers.clear()
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(exc)
+        outbox, self._outbox = self._outbox, []
+        for _, future in outbox:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def call_service(self, domain: str, service: str, service_data: Dict[str, Any] = None,
+                           timeout: Optional[float] = None):
         if not self._connected:
              logger.warning("Cannot call service, not connected to HA")
              return None
 
-        msg_id, future = self._create_future()
-        msg = {
-            "id": msg_id,
+        return await self._command({
             "type": "call_service",
             "domain": domain,
             "service": service,
             "service_data": service_data or {}
-        }
-        await self.connection.send(json.dumps(msg))
-        return await future
+        }, timeout=timeout)
 
     async def get_states(self):
+        """All entity states, served from the local store once it is synced."""
+        if self.store.synced:
+            return [state.to_dict() for state in self.store.all()]
         if not self._connected:
              logger.warning("Cannot get states, not connected to HA")
              return None
 
-        msg_id, future = self._create_future()
-        msg = {
-            "id": msg_id,
-            "type": "get_states"
-        }
-        await self.connection.send(json.dumps(msg))
-        return await future
+        resp = await self._command({"type": "get_states"})
+        return resp.get("result") if resp and resp.get("success") else None
+
+    def get_state(self, entity_id: str) -> Optional[Dict[str, Any]]:
+        state = self.store.get(entity_id)
+        return state.to_dict() if state is not None else None
+
+    def changes_since(self, version: int) -> Dict[str, Any]:
+        return self.store.changes_since(version)
+
+    async def _command(self, msg: Dict[str, Any], on_result: Callable[[Any], None] = None,
+                       timeout: Optional[float] = None):
+        """
+        Send one command and wait for its result.
+
+        Raises TimeoutError if HA does not answer within ``timeout`` (default
+        ``request_timeout``, including time spent waiting for an in-flight slot)
+        and ConnectionError if the socket drops first. The request is never
+        left behind in ``_futures`` either way.
+        """
+        if self.connection is None:
+            raise ConnectionError("Not connected to Home Assistant")
+        timeout = self.request_timeout if timeout is None else timeout
+        msg_id = None
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(timeout):
+                async with self._inflight:
+                    msg_id, future = self._create_future()
+                    if on_result:
+                        self._result_handlers[msg_id] = on_result
+                    await self._send({"id": msg_id, **msg}, future)
+                    result = await future
+            HA_COMMAND_SECONDS.observe(time.perf_counter() - start, type=msg.get("type"))
+            return result
+        except TimeoutError:
+            HA_COMMAND_ERRORS.inc(type=msg.get("type"), reason="timeout")
+            raise TimeoutError(f"Home Assistant did not answer {msg.get('type')} within {timeout}s") from None
+        except ConnectionError:
+            HA_COMMAND_ERRORS.inc(type=msg.get("type"), reason="disconnected")
+            raise
+        finally:
+            if msg_id is not None:
+                self._futures.pop(msg_id, None)
+                self._result_handlers.pop(msg_id, None)
+
+    async def _send(self, msg: Dict[str, Any], future: asyncio.Future):
+        if not self.batch_commands:
+            payload = self.codec.dumps(msg)
+            await self.connection.send(payload)
+            HA_WS_MESSAGES.inc(direction="out")
+            HA_WS_BYTES.inc(len(payload), direction="out")
+            return
+        self._outbox.append((msg, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            # The task only runs once the current tick's callers have queued their commands
+            asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        self._flush_scheduled = False
+        batch, self._outbox = self._outbox, []
+        if not batch:
+            return
+        messages = [msg for msg, _ in batch]
+        try:
+            payload = self.codec.dumps(messages if len(messages) > 1 else messages[0])
+            await self.connection.send(payload)
+            HA_WS_MESSAGES.inc(len(messages), direction="out")
+            HA_WS_BYTES.inc(len(payload), direction="out")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Send failed: {e}"))
+
+    async def _sync_state(self):
+        """
+        Subscribe to state changes, then load one full snapshot.
+
+        Subscribing first means no change is lost between the two; the snapshot
+        is applied from inside the listen loop so events that arrive after it
+        can never be overwritten by it.
+        """
+        # Let HA pack bursts of events into one frame; older cores reply with a harmless error
+        await self._command({"type": "supported_features", "features": {"coalesce_messages": 1}})
+        for event_type in ("state_changed", "area_registry_updated",
+                           "device_registry_updated", "entity_registry_updated"):
+            resp = await self._command({"type": "subscribe_events", "event_type": event_type})
+            if not resp or not resp.get("success"):
+                logger.warning(f"Could not subscribe to {event_type}: {resp}")
+        resp = await self._command({"type": "get_states"}, on_result=self.store.load_snapshot)
+        if resp and resp.get("success"):
+            logger.info(f"State cache loaded: {len(self.store)} entities (version {self.store.version})")
+        await self._sync_registries()
+
+    async def _sync_registries(self):
+        try:
+            areas = await self._command({"type": "config/area_registry/list"})
+            devices = await self._command({"type": "config/device_registry/list"})
+            entities = await self._command({"type": "config/entity_registry/list"})
+        except (websockets.ConnectionClosed, ConnectionError, asyncio.TimeoutError) as e:
+            # The next (re)connect loads them again
+            logger.warning(f"Registry lookup failed ({e}); area index may be stale")
+            return
+        if not all(r and r.get("success") for r in (areas, devices, entities)):
+            logger.warning("Registry lookup failed; area index unavailable")
+            return
+        self.store.load_registries(areas["result"], devices["result"], entities["result"])
+
+    def _handle_event(self, event: Dict[str, Any]):
+        event_type = event.get("event_type")
+        if event_type == "state_changed":
+            self.store.apply_event(event.get("data") or {})
+        elif event_type in ("area_registry_updated", "device_registry_updated", "entity_registry_updated"):
+            # Registry edits come in bursts (e.g. a device with many entities); refresh once
+            if self._registry_refresh is None or self._registry_refresh.done():
+                self._registry_refresh = asyncio.create_task(self._refresh_registries_soon())
+
+    async def _refresh_registries_soon(self):
+        await asyncio.sleep(1)
+        await self._sync_registries()
 
     def _create_future(self):
         self._message_id += 1
@@ -144,6 +433,9 @@ class HomeAssistantClient:
     async def close(self):
         if self.connection:
             await self.connection.close()
+        if self._listen_task is not None:
+            await asyncio.gather(self._listen_task, return_exceptions=True)
+        self._fail_pending(ConnectionError("Client closed"))
 
     async def update_addon_options(self, addon: str, options: Dict[str, Any]):
         return await self.call_service("hassio", "addon_update", {
@@ -151,25 +443,50 @@ class HomeAssistantClient:
             "options": options
         })
 
-# --- Integration Stubs ---
-class GoogleIntegration:
-    def __init__(self, services_json_path: str):
-        self.creds_path = services_json_path
-        
-    async def sync_devices(self):
-        logger.info("Syncing devices with Google Cloud...")
-        # TODO: Implement Google HomeGraph API calls
-        pass
+def google_integration(config: AddonConfig, store: EntityStore, http: SharedHttpClient) -> Optional[GoogleIntegration]:
+    """HomeGraph sync if credentials are configured, else None."""
+    if config.homegraph_token:
+        token = StaticToken(config.homegraph_token)
+    elif os.path.isfile(config.google_creds):
+        try:
+            token = ServiceAccountToken(config.google_creds)
+        except (RuntimeError, ValueError, OSError) as e:
+            logger.error(f"Google credentials in {config.google_creds} unusable: {e}")
+            return None
+    else:
+        return None
+    return GoogleIntegration(store, http, token, config.google_agent_user_id, url=config.homegraph_url,
+                             debounce=config.google_report_debounce)
+
+def messaging_providers(config: AddonConfig) -> Dict[str, Provider]:
+    """The messaging providers the options fully configure."""
+    providers: Dict[str, Provider] = {}
+    if config.whatsapp_provider == "twilio" and config.whatsapp_sid and config.whatsapp_token and config.whatsapp_from:
+        providers["twilio"] = TwilioProvider(config.whatsapp_sid, config.whatsapp_token, config.whatsapp_from,
+                                             config.twilio_api_url)
+    elif config.whatsapp_provider == "matrix" and config.whatsapp_sid and config.whatsapp_token:
+        # For Matrix the SID field holds the homeserver URL and the token the bot's access token
+        providers["matrix"] = MatrixProvider(config.whatsapp_sid, config.whatsapp_token)
+    if config.bluebubbles_url and config.bluebubbles_token:
+        providers["bluebubbles"] = BlueBubblesProvider(config.bluebubbles_url, config.bluebubbles_token)
+    if config.message_rate > 0:
+        for provider in providers.values():
+            provider.rate = config.message_rate
+    return providers
 
 class MessagingBridge:
-    def __init__(self, provider: str, config: AddonConfig):
+    def __init__(self, provider: str, config: AddonConfig, outbox: Optional[Outbox] = None):
         self.provider = provider
         self.config = config
+        self.outbox = outbox
         
-    async def send_message(self, target: str, message: str):
-        logger.info(f"Sending message via {self.provider} to {target}: {message}")
-        # TODO: Implement Twilio/Matrix/BlueBubbles logic
-        pass
+    async def send_message(self, target: str, message: str) -> Optional[int]:
+        """Queue a message for delivery and return its id; sending happens in the background."""
+        if self.outbox is None:
+            logger.warning(f"Cannot send message via {self.provider}, no messaging provider configured")
+            return None
+        logger.info(f"Queueing message via {self.provider} to {target}")
+        return self.outbox.enqueue(self.provider, target, message)
 
 # --- Application ---
 async def main():
@@ -185,9 +502,30 @@ async def main():
             "whatsapp_sid": os.getenv("WHATSAPP_SID"),
             "whatsapp_token": os.getenv("WHATSAPP_TOKEN"),
             "whatsapp_from": os.getenv("WHATSAPP_FROM"),
+            "twilio_api_url": os.getenv("TWILIO_API_URL"),
+            "message_rate": os.getenv("MESSAGE_RATE"),
+            "message_max_attempts": os.getenv("MESSAGE_MAX_ATTEMPTS"),
+            "gateway_url": os.getenv("GATEWAY_URL"),
+            "gateway_timeout": os.getenv("GATEWAY_TIMEOUT"),
+            "http_timeout": os.getenv("HTTP_TIMEOUT"),
+            "http_pool_size": os.getenv("HTTP_POOL_SIZE"),
+            "http_retries": os.getenv("HTTP_RETRIES"),
+            "ollama_ui_url": os.getenv("OLLAMA_UI_URL"),
+            "response_cache_ttl": os.getenv("RESPONSE_CACHE_TTL"),
+            "response_cache_mb": os.getenv("RESPONSE_CACHE_MB"),
+            "chat_model": os.getenv("CHAT_MODEL"),
+            "chat_context_tokens": os.getenv("CHAT_CONTEXT_TOKENS"),
+            "chat_session_timeout": os.getenv("CHAT_SESSION_TIMEOUT"),
+            "chat_max_sessions": os.getenv("CHAT_MAX_SESSIONS"),
+            "chat_context_entities": os.getenv("CHAT_CONTEXT_ENTITIES"),
+            "google_creds": os.getenv("GOOGLE_CREDS"),
+            "google_agent_user_id": os.getenv("GOOGLE_AGENT_USER_ID"),
+            "google_report_debounce": os.getenv("GOOGLE_REPORT_DEBOUNCE"),
+            "homegraph_url": os.getenv("HOMEGRAPH_URL"),
+            "homegraph_token": os.getenv("HOMEGRAPH_TOKEN"),
         }
-        # Filter purely None/missing values so defaults work if not in env
-        config_data = {k: v for k, v in config_data.items() if v is not None}
+        # Filter None/empty values so defaults work if not in env (run.sh exports "" for unset options)
+        config_data = {k: v for k, v in config_data.items() if v not in (None, "")}
         
         config = AddonConfig(**config_data)
     except ValidationError as e:
@@ -200,72 +538,249 @@ async def main():
 
     # 2. Initialize Clients
     ha_client = HomeAssistantClient(config.ha_url, config.ha_token)
+    HA_PENDING.callback = lambda: len(ha_client._futures)
+    response_cache = ChatResponseCache(ttl=config.response_cache_ttl,
+                                       max_bytes=int(config.response_cache_mb * 1024 * 1024))
+    ha_client.store.listeners.append(response_cache.invalidate_entity)
+    CHAT_CACHE_BYTES.callback = lambda: response_cache.bytes
+    conversations = ConversationStore(context_tokens=config.chat_context_tokens,
+                                      idle_timeout=config.chat_session_timeout,
+                                      max_sessions=config.chat_max_sessions)
+    CHAT_SESSIONS.callback = lambda: len(conversations)
+    CHAT_HISTORY_TOKENS.callback = conversations.tokens
+    entity_index = EntityIndex(ha_client.store)
+    http_client = SharedHttpClient(
+        pool_size=config.http_pool_size,
+        timeouts={
+            "default": aiohttp.ClientTimeout(total=config.http_timeout, sock_connect=5),
+            # Generations can take minutes on CPU, but a dead gateway should still fail fast
+            "chat": aiohttp.ClientTimeout(total=config.gateway_timeout, sock_connect=5),
+        },
+        retry=RetryPolicy(attempts=max(1, config.http_retries)),
+    )
     
     # 3. Setup Web Server for Chat
     app = web.Application()
+
+    async def start_http_client(app):
+        await http_client.start()
+
+    async def close_http_client(app):
+        await http_client.close()
+
+    app.on_startup.append(start_http_client)
+    app.on_cleanup.append(close_http_client)
+
+    # Outbound messages go through a durable queue, rate-limited per provider
+    providers = messaging_providers(config)
+    outbox = None
+    if providers:
+        outbox = Outbox(os.path.join(default_cache_dir(), "outbox.sqlite"), http_client, providers,
+                        max_attempts=max(1, config.message_max_attempts))
+        logger.info(f"Messaging providers: {', '.join(providers)}")
+    messengers = {name: MessagingBridge(name, config, outbox) for name in providers}
+
+    async def start_outbox(app):
+        outbox.start()
+
+    async def close_outbox(app):
+        await outbox.close()
+
+    if outbox is not None:
+        app.on_startup.append(start_outbox)
+        app.on_cleanup.insert(0, close_outbox)
+
+    # Entity changes are reported to Google's HomeGraph as they happen
+    google = google_integration(config, ha_client.store, http_client)
+
+    async def start_google(app):
+        google.start()
+
+    async def close_google(app):
+        await google.close()
+
+    if google is not None:
+        logger.info(f"Reporting state to HomeGraph at {config.homegraph_url}")
+        app.on_startup.append(start_google)
+        app.on_cleanup.insert(0, close_google)
     
+    async def stream_chat(request, messages, on_complete=None):
+        writer = ChatStreamWriter(request)
+        await writer.prepare()
+        moltbot_url = f"{config.gateway_url}/api/chat"
+        payload = {
+            "messages": messages,
+            "stream": True
+        }
+        parts = []
+        start = time.perf_counter()
+        try:
+            async with await http_client.post(moltbot_url, route="chat", json=payload) as resp:
+                GATEWAY_TTFB_SECONDS.observe(time.perf_counter() - start, mode="stream")
+                if resp.status != 200:
+                    err_text = await resp.text()
+                    logger.error(f"Moltbot API error {resp.status}: {err_text}")
+                    await writer.send({"type": "error", "error": f"Error from Moltbot: {resp.status}"})
+                    return await writer.finish()
+                try:
+                    async for token in iter_gateway_tokens(resp):
+                        if token is None:
+                            await writer.send({"type": "ping"})
+                            continue
+                        if not parts:
+                            GATEWAY_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                        parts.append(token)
+                        await writer.send({"type": "token", "content": token})
+                except (ConnectionResetError, asyncio.CancelledError):
+                    # Browser went away: drop the upstream connection so the
+                    # gateway stops generating instead of finishing unseen.
+                    logger.info("Chat client disconnected, cancelling generation")
+                    resp.close()
+                    raise
+            await writer.send({"type": "done", "response": "".join(parts)})
+            if on_complete:
+                on_complete("".join(parts))
+        except ConnectionResetError:
+            return writer.response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            logger.error(f"Failed to contact Moltbot: {ex}")
+            try:
+                await writer.send({"type": "error", "error": "Moltbot is not reachable yet (still starting?)."})
+            except ConnectionResetError:
+                return writer.response
+        return await writer.finish()
+
+    async def json_chat(messages, on_complete=None):
+        # Forward message to Moltbot Gateway
+        moltbot_url = f"{config.gateway_url}/api/chat"
+        try:
+            payload = {
+                "messages": messages,
+                "stream": False 
+            }
+            start = time.perf_counter()
+            async with await http_client.post(moltbot_url, route="chat", json=payload) as resp:
+                GATEWAY_TTFB_SECONDS.observe(time.perf_counter() - start, mode="json")
+                if resp.status == 200:
+                    data = await resp.json()
+                    bot_text = data.get("content") or data.get("message") or str(data)
+                    if on_complete:
+                        on_complete(bot_text)
+                    return web.json_response({'response': bot_text})
+                else:
+                    err_text = await resp.text()
+                    logger.error(f"Moltbot API error {resp.status}: {err_text}")
+                    return web.json_response({'response': f"Error from Moltbot: {resp.status}"})
+        except Exception as ex:
+            logger.error(f"Failed to contact Moltbot: {ex}")
+            return web.json_response({'response': "Moltbot is not reachable yet (still starting?)."})
+
+    async def cached_chat(request, text, stream):
+        """Answer from the response cache, in the same shape as a generated answer."""
+        if not stream:
+            return web.json_response({'response': text, 'cached': True}, headers={'X-Cache': 'HIT'})
+        writer = ChatStreamWriter(request)
+        writer.response.headers['X-Cache'] = 'HIT'
+        await writer.prepare()
+        try:
+            await writer.send({"type": "token", "content": text})
+            await writer.send({"type": "done", "response": text, "cached": True})
+        except ConnectionResetError:
+            return writer.response
+        return await writer.finish()
+
+    def cache_writer(key, user_message, context_entities=()):
+        """Stores a finished answer, unless an entity it mentions changed while it was generated."""
+        store = ha_client.store
+        started = store.version
+
+        def remember(text):
+            if store.structure_version != key[2]:
+                return
+            entities = set(referenced_entities(store, user_message, text)).union(context_entities)
+            if entities and store.version != started:
+                changed = {s["entity_id"] for s in store.changes_since(started)["changed"]}
+                if changed.intersection(entities):
+                    return
+            response_cache.put(key, text, entities)
+        return remember
+
     async def handle_chat(request):
         try:
             data = await request.json()
             user_message = data.get('message', '')
             logger.info(f"Chat received: {user_message}")
+            stream = bool(data.get('stream'))
+            session_id = data.get('session')
+            if session_id is not None:
+                session_id = str(session_id)
+                if data.get('reset'):
+                    conversations.reset(session_id)
+            conversation = conversations.get(session_id) if session_id else None
+            completions = []
+
+            # Only the entities the message is about go into the prompt, however big the house
+            prompt_message, context_entities = user_message, []
+            if config.chat_context_entities > 0 and ha_client.store.synced and data.get('context', True) is not False:
+                context, context_entities = entity_index.context(user_message, config.chat_context_entities)
+                if context:
+                    CHAT_CONTEXT_TOKENS.observe(estimate_tokens(context))
+                    prompt_message = f"Current state of possibly relevant Home Assistant entities:\n{context}\n\n{user_message}"
+
+            if session_id:
+                compactions = conversations.compactions
+                # The history keeps the bare message; the entity context is only ever sent with the newest turn
+                messages = conversations.prompt(session_id, prompt_message)
+                if conversations.compactions != compactions:
+                    CHAT_HISTORY_COMPACTIONS.inc()
+                completions.append(lambda text: conversations.record(session_id, user_message, text))
+            else:
+                messages = [{"role": "user", "content": prompt_message}]
+
+            # Without a synced store, changed entities couldn't invalidate the answer.
+            # Follow-up messages depend on the history, so only a session's first message is cached.
+            if (response_cache.enabled and ha_client.store.synced and data.get('cache', True) is not False
+                    and not (conversation and conversation.turns)):
+                key = response_cache.key(user_message, data.get('model') or config.chat_model,
+                                         ha_client.store.structure_version)
+                cached = response_cache.get(key)
+                if cached is not None:
+                    CHAT_CACHE.inc(result="hit")
+                    if session_id:
+                        # A cached first answer still starts the session's history
+                        conversations.record(session_id, user_message, cached)
+                    with CHAT_SECONDS.time(mode="cached"):
+                        return await cached_chat(request, cached, stream)
+                CHAT_CACHE.inc(result="miss")
+                completions.append(cache_writer(key, user_message, context_entities))
+
+            def on_complete(text):
+                for callback in completions:
+                    callback(text)
+
+            if stream:
+                with CHAT_SECONDS.time(mode="stream"):
+                    return await stream_chat(request, messages, on_complete)
             
-            # Forward message to Moltbot Gateway
-            moltbot_url = "http://localhost:18789/api/chat"
-            async with aiohttp.ClientSession() as session:
-                try:
-                    payload = {
-                        "messages": [{"role": "user", "content": user_message}],
-                        "stream": False 
-                    }
-                    async with session.post(moltbot_url, json=payload) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            bot_text = data.get("content") or data.get("message") or str(data)
-                            return web.json_response({'response': bot_text})
-                        else:
-                            err_text = await resp.text()
-                            logger.error(f"Moltbot API error {resp.status}: {err_text}")
-                            return web.json_response({'response': f"Error from Moltbot: {resp.status}"})
-                except Exception as ex:
-                    logger.error(f"Failed to contact Moltbot: {ex}")
-                    return web.json_response({'response': "Moltbot is not reachable yet (still starting?)."})
+            with CHAT_SECONDS.time(mode="json"):
+                return await json_chat(messages, on_complete)
                     
         except Exception as e:
             logger.error(f"Chat error: {e}")
             return web.json_response({'error': str(e)}, status=500)
 
+    async def fetch_library(url, headers):
+        async with await http_client.get(url, headers=headers) as resp:
+            return resp.status, dict(resp.headers), await resp.read()
+
+    catalog = ModelCatalog(async_fetch=fetch_library)
+
     async def handle_available_models(request):
         try:
-            logger.info("Fetching available models from Ollama...")
-            async with aiohttp.ClientSession() as session:
-                async with session.get("https://ollama.com/library") as resp:
-                    if resp.status != 200:
-                        return web.json_response({"error": "Failed to fetch library"}, status=500)
-                    html = await resp.text()
-                    
-                    # Simple regex to find /library/model-name
-                    import re
-                    pattern = r'href="/library/([^/"]+)"'
-                    models = re.findall(pattern, html)
-                    unique_models = sorted(list(set(models)))
-                    
-                    # Add variants for popular ones
-                    rich_models = []
-                    special_cases = {
-                        "gemma3": ["270m", "1b", "4b", "12b", "27b", "vision"],
-                        "llama3.2": ["1b", "3b"],
-                        "llama3.1": ["8b", "70b"],
-                        "phi3.5": ["latest"],
-                        "gemma2": ["2b", "9b", "27b"],
-                        "mistral": ["7b"]
-                    }
-                    
-                    for m in unique_models:
-                        variants = special_cases.get(m, ["latest"])
-                        rich_models.append({"name": m, "variants": variants})
-                        
-                    return web.json_response({"models": rich_models})
+            models = await catalog.aget()
+            if not models:
+                return web.json_response({"error": "Failed to fetch library"}, status=500)
+            return web.json_response({"models": with_variants(sorted(models))})
         except Exception as e:
             logger.error(f"Error fetching models: {e}")
             return web.json_response({"error": str(e)}, status=500)
@@ -278,6 +793,15 @@ async def main():
                 return web.json_response({"error": "No model specified"}, status=400)
             
             logger.info(f"Setting Ollama model to: {model}")
+            if config.ollama_ui_url:
+                # The add-on pulls the model if needed and loads it, no restart
+                url = f"{config.ollama_ui_url.rstrip('/')}/model"
+                async with await http_client.post(url, json={"model": model}) as resp:
+                    if resp.status == 202:
+                        return web.json_response({"status": "ok", "message": f"Switching to {model}. It is downloaded first if needed."})
+                    details = await resp.text()
+                return web.json_response({"error": "Ollama add-on refused the model switch", "details": details}, status=502)
+
             # Update the Ollama add-on options via Home Assistant
             resp = await ha_client.update_addon_options("ollama", {"model": model})
             
@@ -290,27 +814,79 @@ async def main():
             logger.error(f"Error selecting model: {e}")
             return web.json_response({"error": str(e)}, status=500)
 
+    async def handle_send_message(request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON"}, status=400)
+        target, message = data.get("target"), data.get("message")
+        if not target or not message:
+            return web.json_response({"error": "Both target and message are required"}, status=400)
+        # The only configured provider is the default
+        name = data.get("provider") or (next(iter(messengers)) if len(messengers) == 1 else None)
+        messenger = messengers.get(name)
+        if messenger is None:
+            return web.json_response({"error": f"Unknown or unconfigured provider: {name}",
+                                      "providers": list(messengers)}, status=400)
+        message_id = await messenger.send_message(str(target), str(message))
+        return web.json_response({"id": message_id, "provider": name}, status=202)
+
+    async def handle_message_queue(request):
+        if outbox is None:
+            return web.json_response({"providers": [], "pending": {}, "dead": []})
+        return web.json_response({"providers": list(providers), "pending": outbox.pending(),
+                                  "dead": outbox.dead_letters()})
+
+    async def handle_retry_dead(request):
+        if outbox is None:
+            return web.json_response({"retried": 0})
+        try:
+            data = await request.json() if request.can_read_body else {}
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON"}, status=400)
+        ids = data.get("ids")
+        return web.json_response({"retried": outbox.retry_dead([int(i) for i in ids] if ids is not None else None)})
+
+    async def handle_clear_dead(request):
+        return web.json_response({"cleared": outbox.clear_dead() if outbox is not None else 0})
+
+    async def handle_google_sync(request):
+        if google is None:
+            return web.json_response({"error": "Google integration is not configured"}, status=404)
+        try:
+            data = await request.json() if request.can_read_body else {}
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON"}, status=400)
+        return web.json_response({"queued": await google.sync_devices(force=bool(data.get("force")))})
+
+    async def handle_metrics(request):
+        return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
     app.router.add_post('/api/chat', handle_chat)
+    app.router.add_get('/metrics', handle_metrics)
     app.router.add_get('/api/models/available', handle_available_models)
     app.router.add_post('/api/models/select', handle_select_model)
+    app.router.add_post('/api/messages', handle_send_message)
+    app.router.add_get('/api/messages', handle_message_queue)
+    app.router.add_post('/api/messages/retry', handle_retry_dead)
+    app.router.add_delete('/api/messages/dead', handle_clear_dead)
+    app.router.add_post('/api/google/sync', handle_google_sync)
     
-    # Serve index.html explicitly to ensure Ingress finds it at root
-    async def index(request):
-        web_dir = os.path.join(os.path.dirname(__file__), 'web')
-        index_file = os.path.join(web_dir, 'index.html')
-        if os.path.exists(index_file):
-            return web.FileResponse(index_file)
-        return web.Response(text="Web interface not found", status=404)
-
-    app.router.add_get('/', index)
-    app.router.add_get('/index.html', index)
+    # Serve index.html explicitly to ensure Ingress finds it at root.
+    # Loaded and precompressed once; revalidated with ETags on every panel open.
+    web_dir = os.path.join(os.path.dirname(__file__), 'web')
+    assets = StaticAssets()
+    assets.add('/', os.path.join(web_dir, 'index.html'))
+    assets.add('/index.html', os.path.join(web_dir, 'index.html'))
+    assets.register(app.router)
     
     # Optional: Serve other static files if needed, avoiding root conflict
     # web_dir = os.path.join(os.path.dirname(__file__), 'web')
     # app.router.add_static('/static/', web_dir)
 
     # Create web runner
-    runner = web.AppRunner(app)
+    # Cancel handlers when the client disconnects so abandoned chats stop upstream work
+    runner = web.AppRunner(app, handler_cancellation=True)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', 8099)
     await site.start()
@@ -328,25 +904,38 @@ async def main():
     loop.add_signal_handler(signal.SIGINT, signal_handler)
 
     logger.info("Bridge is starting loop. Connecting to HA...")
-    
+
+    async def sleep_unless_stopped(delay):
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    failures = 0
     while not stop_event.is_set():
         try:
-            if not ha_client._connected:
-                try:
-                    await ha_client.connect()
-                except (ConnectionError, OSError) as e:
-                    logger.error(f"Connection failed: {e}. Retrying in 10s...")
-                    try:
-                        await asyncio.wait_for(stop_event.wait(), timeout=10)
-                    except asyncio.TimeoutError:
-                        continue 
-                    
-            # If connected, just wait (the listen task runs in background)
-            # We check periodically if we are still connected or if stop signal came
             try:
-                await asyncio.wait_for(stop_event.wait(), timeout=5)
-            except asyncio.TimeoutError:
-                pass # Just a loop cycle to check status
+                await ha_client.connect()
+            except (ConnectionError, OSError, websockets.WebSocketException) as e:
+                failures += 1
+                delay = reconnect_delay(failures)
+                logger.error(f"Connection failed: {e}. Retrying in {delay:.1f}s...")
+                await sleep_unless_stopped(delay)
+                continue
+
+            # The listen task sets `disconnected` the moment the socket drops
+            connected_at = time.monotonic()
+            stopping = asyncio.ensure_future(stop_event.wait())
+            dropped = asyncio.ensure_future(ha_client.disconnected.wait())
+            await asyncio.wait((stopping, dropped), return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            dropped.cancel()
+            if stop_event.is_set():
+                break
+            failures = 0 if time.monotonic() - connected_at >= STABLE_CONNECTION else failures + 1
+            delay = reconnect_delay(failures)
+            logger.warning(f"Lost connection to Home Assistant. Reconnecting in {delay:.1f}s...")
+            await sleep_unless_stopped(delay)
                 
         except Exception as e:
             logger.error(f"Unexpected error in main loop: {e}", exc_info=True)
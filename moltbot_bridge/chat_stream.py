@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Optional
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("MoltbotAddon.stream")
+
+NDJSON = "application/x-ndjson"
+SSE = "text/event-stream"
+
+
+def extract_token(frame: Any) -> str:
+    """
+    Pull the text delta out of one gateway frame.
+
+    The gateway speaks whichever dialect its provider uses, so accept the
+    common shapes: Ollama (message.content), OpenAI (choices[].delta.content)
+    and plain {"content": ...} / {"delta": ...}.
+    """
+    if isinstance(frame, str):
+        return frame
+    if not isinstance(frame, dict):
+        return ""
+    for key in ("content", "response", "token", "text"):
+        if isinstance(frame.get(key), str):
+            return frame[key]
+    for key in ("delta", "message"):
+        value = frame.get(key)
+        if isinstance(value, str):
+            return value
+        if isinstance(value, dict) and isinstance(value.get("content"), str):
+            return value["content"]
+    choices = frame.get("choices")
+    if isinstance(choices, list) and choices:
+        return extract_token(choices[0])
+    return ""
+
+
+def is_final(frame: Any) -> bool:
+    if not isinstance(frame, dict):
+        return False
+    if frame.get("done") is True or frame.get("type") in ("done", "end"):
+        return True
+    choices = frame.get("choices")
+    return bool(isinstance(choices, list) and choices and choices[0].get("finish_reason"))
+
+
+def _parse_line(line: bytes):
+    """Returns (frame, final) for one NDJSON or SSE line, or (None, False) to skip it."""
+    line = line.strip()
+    if not line or line.startswith(b":"):
+        return None, False
+    if line.startswith(b"data:"):
+        line = line[5:].strip()
+        if line == b"[DONE]":
+            return None, True
+    elif line.startswith((b"event:", b"id:", b"retry:")):
+        return None, False
+    try:
+        frame = json.loads(line)
+    except ValueError:
+        # Some gateways stream bare text lines
+        return line.decode("utf-8", errors="replace") + "\n", False
+    return frame, is_final(frame)
+
+
+async def iter_gateway_tokens(resp: aiohttp.ClientResponse,
+                              heartbeat: float = 15.0) -> AsyncIterator[Optional[str]]:
+    """
+    Yield text deltas from a streaming gateway response as they arrive.
+
+    Yields ``None`` whenever the gateway has been silent for ``heartbeat``
+    seconds (e.g. during prompt prefill) so the caller can ping the client and
+    find out early if it went away. Uses ``readany`` rather than ``readline``
+    because cancelling a half-finished ``readline`` would drop buffered bytes.
+    """
+    buffer = b""
+    while True:
+        try:
+            chunk = await asyncio.wait_for(resp.content.readany(), timeout=heartbeat)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+        if not chunk:
+            break
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            frame, final = _parse_line(line)
+            if frame is not None:
+                token = extract_token(frame)
+                if token:
+                    yield token
+            if final:
+                return
+    if buffer:
+        frame, _ = _parse_line(buffer)
+        if frame is not None:
+            token = extract_token(frame)
+            if token:
+                yield token
+
+
+class ChatStreamWriter:
+    """Relays chat events to the browser as NDJSON, or SSE if the client asked for it."""
+
+    def __init__(self, request: web.Request):
+        self.request = request
+        self.sse = SSE in request.headers.get("Accept", "")
+        self.response = web.StreamResponse(headers={
+            "Content-Type": SSE if self.sse else NDJSON,
+            "Cache-Control": "no-cache",
+            # Stop nginx-style proxies (HA Ingress) from buffering the stream
+            "X-Accel-Buffering": "no",
+        })
+
+    async def prepare(self):
+        await self.response.prepare(self.request)
+
+    async def send(self, event: dict):
+        """
+        Write one event. Awaiting the write applies backpressure: the caller
+        does not read more from the gateway until the client has caught up.
+        Raises ConnectionResetError once the client has disconnected.
+        """
+        data = json.dumps(event)
+        if self.sse:
+            payload = f"data: {data}\n\n".encode()
+        else:
+            payload = f"{data}\n".encode()
+        await self.response.write(payload)
+
+    async def finish(self):
+        try:
+            await self.response.write_eof()
+        except ConnectionResetError:
+            pass
+        return self.response
@@ -0,0 +1,149 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Rough tokens per character for English text; no tokenizer is shipped with the bridge
+CHARS_PER_TOKEN = 4
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD = 4
+# Part of the context kept free for the answer
+REPLY_SHARE = 0.25
+# After compaction the history fills at most this share of its budget, so the
+# next few turns append to an unchanged prefix instead of trimming every turn
+LOW_WATERMARK = 0.5
+# Share of the history budget the summary of dropped turns may use
+SUMMARY_SHARE = 0.2
+# Characters kept from each dropped message in the summary
+SUMMARY_SNIPPET = 160
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN) + MESSAGE_OVERHEAD
+
+
+def _snippet(text: str) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= SUMMARY_SNIPPET else text[:SUMMARY_SNIPPET - 3].rstrip() + "..."
+
+
+class Conversation:
+    """One session's history: a summary of dropped turns, then the recent turns verbatim."""
+
+    __slots__ = ("session_id", "turns", "tokens", "summary", "summary_tokens", "last_used")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.turns: List[Dict[str, str]] = []
+        self.tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.last_used = time.monotonic()
+
+    def messages(self) -> List[Dict[str, str]]:
+        prefix = []
+        if self.summary:
+            prefix.append({"role": "system", "content": f"Earlier in this conversation:\n{self.summary}"})
+        return prefix + list(self.turns)
+
+    def add(self, role: str, content: str):
+        self.turns.append({"role": role, "content": content})
+        self.tokens += estimate_tokens(content)
+
+    def compact(self, budget: int):
+        """
+        Drop the oldest turns until the history fits in half of ``budget`` and
+        fold them into the summary. Turns are dropped in user/assistant pairs
+        so the history never starts with an answer.
+        """
+        target = int(budget * LOW_WATERMARK)
+        dropped = []
+        while self.turns and self.tokens + self.summary_tokens > target:
+            pair = self.turns[:2] if len(self.turns) > 1 and self.turns[1]["role"] == "assistant" else self.turns[:1]
+            del self.turns[:len(pair)]
+            for message in pair:
+                self.tokens -= estimate_tokens(message["content"])
+            dropped.extend(pair)
+        if not dropped:
+            return
+        lines = self.summary.splitlines() if self.summary else []
+        lines += [f"{m['role']}: {_snippet(m['content'])}" for m in dropped]
+        # Keep the newest lines of the summary within its share of the budget
+        limit = int(budget * SUMMARY_SHARE)
+        while lines and estimate_tokens("\n".join(lines)) > limit:
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+        self.summary_tokens = estimate_tokens(self.summary) if self.summary else 0
+
+
+class ConversationStore:
+    """
+    Chat history per session, sized to the model's context window.
+
+    Each session gets ``context_tokens`` minus a reserve for the answer.
+    History is only ever appended to until the next message would not fit;
+    then the oldest turns are folded into a short summary in one go, down to
+    half the budget. Between those compactions every request starts with the
+    exact prompt of the previous one, so the backend can reuse its KV cache
+    and only prefill the new turn. Sessions unused for ``idle_timeout``
+    seconds are dropped, and beyond ``max_sessions`` the least recently used
+    one goes first.
+    """
+
+    def __init__(self, context_tokens: int = 2048, idle_timeout: float = 1800, max_sessions: int = 100):
+        self.context_tokens = context_tokens
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.compactions = 0
+        self._sessions: "OrderedDict[str, Conversation]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def budget(self) -> int:
+        """Tokens available to history plus the new message."""
+        return int(self.context_tokens * (1 - REPLY_SHARE))
+
+    def get(self, session_id: str) -> Optional[Conversation]:
+        self.evict_idle()
+        return self._sessions.get(session_id)
+
+    def prompt(self, session_id: str, message: str) -> List[Dict[str, str]]:
+        """The messages to send for ``message``: the session's history (compacted if needed) plus the message."""
+        self.evict_idle()
+        conversation = self._sessions.get(session_id)
+        if conversation is None:
+            conversation = self._sessions[session_id] = Conversation(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        conversation.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        needed = estimate_tokens(message)
+        if conversation.tokens + conversation.summary_tokens + needed > self.budget:
+            conversation.compact(max(0, self.budget - needed))
+            self.compactions += 1
+        return conversation.messages() + [{"role": "user", "content": message}]
+
+    def record(self, session_id: str, message: str, answer: str):
+        """Append a finished exchange; abandoned generations are never recorded."""
+        conversation = self._sessions.get(session_id)
+        if conversation is None:
+            return
+        conversation.add("user", message)
+        conversation.add("assistant", answer)
+        conversation.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+
+    def reset(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            session_id, conversation = next(iter(self._sessions.items()))
+            if conversation.last_used > cutoff:
+                break
+            del self._sessions[session_id]
+
+    def tokens(self) -> int:
+        return sum(c.tokens + c.summary_tokens for c in self._sessions.values())
@@ -0,0 +1,146 @@
+import math
+import re
+from typing import Any, Dict, List, Tuple
+
+from state_store import EntityStore
+
+_WORD = re.compile(r"[^\W_]+")
+# Words that say nothing about which entity is meant
+STOPWORDS = frozenset(
+    "a an and are at be by can do does for from how i in is it its me my of on or please "
+    "set show the their there this to turn what whats when where which who why will with you your".split())
+# Field weights: a word from the name counts for more than one from the entity_id
+WEIGHTS = {"name": 3.0, "area": 2.0, "device_class": 1.5, "domain": 1.5, "entity_id": 1.0}
+# Words on more than this share of entities only rank matches, they don't add any
+COMMON_SHARE = 0.2
+# Attributes worth a few tokens in the prompt, besides the state and its unit
+ATTRIBUTES = ("current_temperature", "temperature", "brightness", "percentage", "hvac_action", "media_title")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case words without stopwords; a trailing plural "s" is dropped so "lights" finds "light"."""
+    words = []
+    for word in _WORD.findall(text.casefold()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+class EntityIndex:
+    """
+    Inverted index over the entities in an ``EntityStore``, for picking the
+    few entities a chat message is about.
+
+    Each entity is indexed by the words of its entity_id, friendly name, area
+    name, domain and device class. Registered in ``EntityStore.listeners``,
+    it re-indexes one entity per change, and only when one of those fields
+    actually changed, so ordinary state updates cost a dict lookup.
+    ``search`` scores entities by the weighted, IDF-scaled words they share
+    with the question, so a word that appears on half the house ("sensor")
+    counts for little and a name or area counts for a lot.
+    """
+
+    def __init__(self, store: EntityStore):
+        self.store = store
+        # word -> entity_id -> weight of the best field it came from
+        self._postings: Dict[str, Dict[str, float]] = {}
+        # entity_id -> (indexed fields, words), to undo an entity's postings
+        self._entities: Dict[str, Tuple[Tuple, Dict[str, float]]] = {}
+        store.listeners.append(self.update)
+        self.rebuild()
+
+    def __len__(self):
+        return len(self._entities)
+
+    def _fields(self, entity_id: str, state: Dict[str, Any]) -> Tuple:
+        attributes = state.get("attributes") or {}
+        area_id = self.store.area_of(entity_id)
+        area = (self.store.area_name(area_id) if area_id else None) or ""
+        return (entity_id, str(attributes.get("friendly_name") or ""), area,
+                str(attributes.get("device_class") or ""))
+
+    def update(self, entity_id: str):
+        state = self.store.get(entity_id)
+        if state is None:
+            self._unindex(entity_id)
+            return
+        fields = self._fields(entity_id, state)
+        current = self._entities.get(entity_id)
+        if current is not None and current[0] == fields:
+            return
+        self._unindex(entity_id)
+        _, name, area, device_class = fields
+        domain, _, object_id = entity_id.partition(".")
+        words: Dict[str, float] = {}
+        for field, text in (("entity_id", object_id), ("domain", domain), ("device_class", device_class),
+                            ("area", area), ("name", name)):
+            for word in tokenize(text):
+                words[word] = max(words.get(word, 0.0), WEIGHTS[field])
+        for word, weight in words.items():
+            self._postings.setdefault(word, {})[entity_id] = weight
+        self._entities[entity_id] = (fields, words)
+
+    def rebuild(self):
+        self._postings.clear()
+        self._entities.clear()
+        for state in self.store.all():
+            self.update(state["entity_id"])
+
+    def search(self, question: str, limit: int = 8) -> List[str]:
+        """The ``limit`` entity_ids that best match ``question``, best first."""
+        total = len(self._entities)
+        scores: Dict[str, float] = {}
+        found = [self._postings[word] for word in set(tokenize(question)) if word in self._postings]
+        # Rarest words first; a word on most of the house only ranks what rarer words already found
+        for postings in sorted(found, key=len):
+            idf = math.log(1 + total / len(postings))
+            if scores and len(postings) > total * COMMON_SHARE:
+                for entity_id in scores:
+                    weight = postings.get(entity_id)
+                    if weight:
+                        scores[entity_id] += weight * idf
+                continue
+            for entity_id, weight in postings.items():
+                scores[entity_id] = scores.get(entity_id, 0.0) + weight * idf
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [entity_id for entity_id, _ in best[:limit]]
+
+    def render(self, entity_ids: List[str]) -> str:
+        """One short line per entity: ``light.kitchen: on (Kitchen Light, Kitchen) brightness=180``."""
+        lines = []
+        for entity_id in entity_ids:
+            state = self.store.get(entity_id)
+            if state is None:
+                continue
+            attributes = state.get("attributes") or {}
+            _, name, area, _ = self._fields(entity_id, state)
+            value = str(state.get("state"))
+            unit = attributes.get("unit_of_measurement")
+            if unit:
+                value = f"{value} {unit}"
+            label = ", ".join(part for part in (name, area) if part)
+            line = f"{entity_id}: {value}" + (f" ({label})" if label else "")
+            extras = [f"{key}={attributes[key]}" for key in ATTRIBUTES if attributes.get(key) is not None]
+            if extras:
+                line += " " + " ".join(extras)
+            lines.append(line)
+        return "\n".join(lines)
+
+    def context(self, question: str, limit: int = 8) -> Tuple[str, List[str]]:
+        """Prompt text for the entities relevant to ``question``, and their ids; empty if none match."""
+        entity_ids = self.search(question, limit)
+        return self.render(entity_ids), entity_ids
+
+    def _unindex(self, entity_id: str):
+        current = self._entities.pop(entity_id, None)
+        if current is None:
+            return
+        for word in current[1]:
+            postings = self._postings.get(word)
+            if postings is not None:
+                postings.pop(entity_id, None)
+                if not postings:
+                    del self._postings[word]
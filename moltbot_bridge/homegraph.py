@@ -0,0 +1,364 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+import aiohttp
+
+from http_client import RetryPolicy, SharedHttpClient
+from json_codec import get_codec
+from metrics import REGISTRY
+from state_store import EntityStore
+
+try:
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    from google.oauth2 import service_account
+except ImportError:
+    service_account = None
+
+logger = logging.getLogger("MoltbotAddon.homegraph")
+
+HOMEGRAPH_URL = "https://homegraph.googleapis.com"
+HOMEGRAPH_SCOPE = "https://www.googleapis.com/auth/homegraph"
+# Devices per reportStateAndNotification call and a cap on its body; both well
+# under what HomeGraph accepts, so one bad batch never holds up many devices
+MAX_REPORT_DEVICES = 100
+MAX_REPORT_BYTES = 256 * 1024
+
+REPORTS = REGISTRY.counter(
+    "moltbot_homegraph_states_total", "Entity states offered to HomeGraph by result (sent, unchanged, retried, rejected)",
+    labels=("result",))
+REPORT_CALLS = REGISTRY.histogram(
+    "moltbot_homegraph_request_seconds", "HomeGraph API round-trip time by call",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), labels=("call",))
+PENDING = REGISTRY.gauge("moltbot_homegraph_pending", "Entities waiting to be reported to HomeGraph")
+
+# HA climate modes that have a Google thermostatMode
+THERMOSTAT_MODES = {"off": "off", "heat": "heat", "cool": "cool", "heat_cool": "heatcool", "auto": "auto",
+                    "dry": "dry", "fan_only": "fan-only"}
+ON_OFF_DOMAINS = ("light", "switch", "fan", "input_boolean", "media_player")
+
+
+def device_state(state: Mapping[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    The HomeGraph state of an entity, or None for entities that are not
+    exposed to Google. Only fields Google uses are included, so attribute
+    churn it doesn't see (``last_updated``, media position, ...) never
+    counts as a change.
+    """
+    domain = state["entity_id"].partition(".")[0]
+    value = state.get("state")
+    attributes = state.get("attributes") or {}
+    if domain == "sensor":
+        if attributes.get("device_class") != "temperature":
+            return None
+    elif domain not in ON_OFF_DOMAINS and domain not in ("climate", "cover", "lock"):
+        return None
+    if value in ("unavailable", "unknown"):
+        return {"online": False}
+    result: Dict[str, Any] = {"online": True}
+    if domain in ON_OFF_DOMAINS:
+        result["on"] = value not in ("off", "standby")
+    if domain == "light" and attributes.get("brightness") is not None:
+        result["brightness"] = round(attributes["brightness"] * 100 / 255)
+    elif domain == "fan" and attributes.get("percentage") is not None:
+        result["currentFanSpeedPercent"] = attributes["percentage"]
+    elif domain == "cover":
+        position = attributes.get("current_position")
+        result["openPercent"] = position if position is not None else (0 if value == "closed" else 100)
+    elif domain == "lock":
+        result["isLocked"] = value == "locked"
+        result["isJammed"] = value == "jammed"
+    elif domain == "climate":
+        if value in THERMOSTAT_MODES:
+            result["thermostatMode"] = THERMOSTAT_MODES[value]
+        for key, field in (("temperature", "thermostatTemperatureSetpoint"),
+                           ("current_temperature", "thermostatTemperatureAmbient")):
+            if attributes.get(key) is not None:
+                result[field] = attributes[key]
+    elif domain == "sensor":
+        try:
+            celsius = float(value)
+        except (TypeError, ValueError):
+            return {"online": False}
+        if attributes.get("unit_of_measurement") == "°F":
+            celsius = (celsius - 32) * 5 / 9
+        result["temperatureAmbientCelsius"] = round(celsius, 1)
+    return result
+
+
+def fingerprint(state: Dict[str, Any]) -> int:
+    # Only compared within one process, so the built-in (salted) hash is enough
+    return hash(tuple(sorted(state.items())))
+
+
+class HomeGraphError(Exception):
+    """A failed HomeGraph call. ``retryable`` is False when resending the same states cannot succeed."""
+
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class StaticToken:
+    """A fixed access token, e.g. for a local stand-in HomeGraph."""
+
+    def __init__(self, token: str):
+        self.token = token
+
+    async def get(self) -> str:
+        return self.token
+
+    def invalidate(self):
+        pass
+
+
+class ServiceAccountToken:
+    """OAuth access tokens for a service account key file, refreshed shortly before they expire."""
+
+    def __init__(self, path: str):
+        if service_account is None:
+            raise RuntimeError("google-auth is not installed")
+        self.credentials = service_account.Credentials.from_service_account_file(path, scopes=[HOMEGRAPH_SCOPE])
+
+    async def get(self) -> str:
+        if not self.credentials.valid:
+            # google-auth refreshes synchronously; keep the event loop free meanwhile
+            await asyncio.get_running_loop().run_in_executor(None, self.credentials.refresh, GoogleAuthRequest())
+        return self.credentials.token
+
+    def invalidate(self):
+        self.credentials.token = None
+
+
+class GoogleIntegration:
+    """
+    Incremental state sync to the Google HomeGraph.
+
+    Registered in ``EntityStore.listeners``, it marks changed entities dirty
+    and reports them after ``debounce`` seconds, so a light dimmed in ten
+    steps is reported once, with its final brightness, and a busy house
+    costs at most one round of calls per ``debounce``. For each exposed
+    entity it keeps a fingerprint of the state Google last accepted, and a
+    dirty entity whose HomeGraph state still matches it is not sent again.
+    Changed states go out in ``reportStateAndNotification`` batches of at
+    most ``max_devices`` devices and ``max_bytes`` of JSON. A batch that
+    fails is retried with backoff for just its own entities; one that
+    HomeGraph rejects as invalid is split in half until the offending
+    entity is found, and that state is not offered again until it changes.
+    Entities appearing or disappearing trigger one ``requestSync``.
+    """
+
+    def __init__(self, store: EntityStore, http: SharedHttpClient, token, agent_user_id: str,
+                 url: str = HOMEGRAPH_URL, debounce: float = 1.0, max_devices: int = MAX_REPORT_DEVICES,
+                 max_bytes: int = MAX_REPORT_BYTES, backoff: Optional[RetryPolicy] = None):
+        self.store = store
+        self.http = http
+        self.token = token
+        self.agent_user_id = agent_user_id
+        self.url = url.rstrip("/")
+        self.debounce = debounce
+        self.max_devices = max_devices
+        self.max_bytes = max_bytes
+        self.backoff = backoff or RetryPolicy(backoff=5.0, max_backoff=300.0)
+        self.codec = get_codec()
+        # entity_id -> fingerprint of the state HomeGraph has (or refused)
+        self._reported: Dict[str, int] = {}
+        self._rejected: Dict[str, int] = {}
+        # entity_id -> monotonic time it is due to be reported
+        self._dirty: Dict[str, float] = {}
+        self._attempts: Dict[str, int] = {}
+        # Exposed entities Google was last asked to sync
+        self._devices: Set[str] = set()
+        self._sync_requested = True
+        self._blocked_until = 0.0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        store.listeners.append(self.mark)
+        PENDING.callback = lambda: len(self._dirty)
+
+    def mark(self, entity_id: str):
+        """Schedule ``entity_id`` for reporting; further changes before it is due are coalesced."""
+        if entity_id not in self._dirty:
+            self._dirty[entity_id] = time.monotonic() + self.debounce
+            self._wake.set()
+
+    async def sync_devices(self, force: bool = False) -> int:
+        """
+        Reconcile every entity now. Only states that differ from what
+        HomeGraph last accepted are sent, unless ``force`` drops that record
+        (e.g. after the agent was unlinked) so everything is reported again.
+        Returns the number of entities queued.
+        """
+        if force:
+            self._reported.clear()
+            self._rejected.clear()
+            self._sync_requested = True
+        now = time.monotonic()
+        entity_ids = {state["entity_id"] for state in self.store.all()} | set(self._reported)
+        for entity_id in entity_ids:
+            self._dirty[entity_id] = now
+            self._attempts.pop(entity_id, None)
+        self._wake.set()
+        return len(entity_ids)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # --- Worker ---
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            due = [entity_id for entity_id, at in self._dirty.items() if at <= now]
+            if due:
+                # Take everything changed within the window too: at most one pass per debounce under steady churn
+                due = [entity_id for entity_id, at in self._dirty.items() if at <= now + self.debounce]
+            # States read from a store that is resyncing may be stale; its snapshot marks the real changes
+            if not due or not self.store.synced or now < self._blocked_until:
+                timeout = None
+                if self._dirty:
+                    timeout = max(self.debounce if due else 0.0, min(self._dirty.values()) - now,
+                                  self._blocked_until - now)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._flush(due)
+            except Exception as e:
+                logger.error(f"HomeGraph sync failed: {e}", exc_info=True)
+                for entity_id in due:
+                    self._retry(entity_id)
+
+    async def _flush(self, entity_ids: List[str]):
+        states: Dict[str, Tuple[Dict[str, Any], int]] = {}
+        for entity_id in entity_ids:
+            del self._dirty[entity_id]
+            state = self.store.get(entity_id)
+            google = device_state(state) if state is not None else None
+            if google is None:
+                self._attempts.pop(entity_id, None)
+                self._rejected.pop(entity_id, None)
+                self._reported.pop(entity_id, None)
+                if entity_id in self._devices:
+                    self._devices.discard(entity_id)
+                    self._sync_requested = True
+                continue
+            if entity_id not in self._devices:
+                self._devices.add(entity_id)
+                self._sync_requested = True
+            fp = fingerprint(google)
+            if fp == self._reported.get(entity_id) or fp == self._rejected.get(entity_id):
+                self._attempts.pop(entity_id, None)
+                REPORTS.inc(result="unchanged")
+                continue
+            states[entity_id] = (google, fp)
+        if self._sync_requested:
+            await self._request_sync()
+        for batch in self._batches(states):
+            await self._report(batch)
+
+    def _batches(self, states: Dict[str, Tuple[Dict[str, Any], int]]) -> List[Dict[str, Tuple[Dict[str, Any], int]]]:
+        batches = []
+        batch: Dict[str, Tuple[Dict[str, Any], int]] = {}
+        size = 0
+        for entity_id, item in states.items():
+            # Roughly the device's share of the request body
+            item_size = len(entity_id) + len(self.codec.dumps(item[0])) + 4
+            if batch and (len(batch) >= self.max_devices or size + item_size > self.max_bytes):
+                batches.append(batch)
+                batch, size = {}, 0
+            batch[entity_id] = item
+            size += item_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _report(self, batch: Dict[str, Tuple[Dict[str, Any], int]]):
+        if time.monotonic() < self._blocked_until:
+            # HomeGraph asked us to back off; the rest of this pass waits with it
+            for entity_id in batch:
+                self._retry(entity_id)
+            return
+        body = {
+            "requestId": uuid.uuid4().hex,
+            "agentUserId": self.agent_user_id,
+            "payload": {"devices": {"states": {entity_id: item[0] for entity_id, item in batch.items()}}},
+        }
+        try:
+            await self._call("report_state", "/v1/devices:reportStateAndNotification", body)
+        except (HomeGraphError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if getattr(e, "retryable", True):
+                logger.warning(f"Reporting {len(batch)} state(s) to HomeGraph failed, will retry: {e}")
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+                for entity_id in batch:
+                    self._retry(entity_id)
+                return
+            if len(batch) > 1:
+                # Find the state HomeGraph objects to without holding back the rest
+                items = list(batch.items())
+                middle = len(items) // 2
+                await self._report(dict(items[:middle]))
+                await self._report(dict(items[middle:]))
+                return
+            entity_id, (google, fp) = next(iter(batch.items()))
+            logger.warning(f"HomeGraph rejected the state of {entity_id} {google}: {e}")
+            self._rejected[entity_id] = fp
+            self._attempts.pop(entity_id, None)
+            REPORTS.inc(result="rejected")
+            return
+        for entity_id, (_, fp) in batch.items():
+            self._reported[entity_id] = fp
+            self._rejected.pop(entity_id, None)
+            self._attempts.pop(entity_id, None)
+        REPORTS.inc(len(batch), result="sent")
+
+    async def _request_sync(self):
+        try:
+            await self._call("request_sync", "/v1/devices:requestSync",
+                             {"agentUserId": self.agent_user_id, "async": True})
+        except (HomeGraphError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Tried again with the next batch of changes
+            logger.warning(f"HomeGraph requestSync failed: {e}")
+            return
+        self._sync_requested = False
+
+    async def _call(self, call: str, path: str, body: Dict[str, Any]):
+        start = time.monotonic()
+        token = await self.token.get()
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        async with await self.http.post(f"{self.url}{path}", data=self.codec.dumps(body), headers=headers) as resp:
+            REPORT_CALLS.observe(time.monotonic() - start, call=call)
+            if resp.status < 300:
+                return
+            details = (await resp.text())[:300]
+            if resp.status == 401:
+                self.token.invalidate()
+            retry_after = None
+            try:
+                retry_after = float(resp.headers.get("Retry-After", ""))
+            except ValueError:
+                pass
+            # A 400 (invalid state) or 404 (unknown device) won't change on resending
+            retryable = resp.status in (401, 408, 429) or resp.status >= 500
+            raise HomeGraphError(f"HTTP {resp.status}: {details}", retryable, retry_after)
+
+    def _retry(self, entity_id: str):
+        attempts = self._attempts.get(entity_id, 0) + 1
+        self._attempts[entity_id] = attempts
+        due = time.monotonic() + self.backoff.delay(attempts)
+        self._dirty[entity_id] = max(self._dirty.get(entity_id, 0.0), due)
+        REPORTS.inc(result="retried")
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import random
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from pydantic import BaseModel
+
+logger = logging.getLogger("MoltbotAddon.http")
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class RetryPolicy(BaseModel):
+    attempts: int = 3
+    backoff: float = 0.25
+    max_backoff: float = 4.0
+    # Only retried for idempotent requests; a 502/504 on a POST may mean the
+    # gateway already started generating.
+    retry_statuses: Tuple[int, ...] = (502, 503, 504)
+
+    def delay(self, attempt: int) -> float:
+        base = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        return random.uniform(base / 2, base)
+
+
+class SharedHttpClient:
+    """
+    One pooled aiohttp session per app.
+
+    Connections to the Moltbot gateway (and ollama.com) are kept alive and
+    reused instead of opening a new TCP connection for every chat message.
+    Timeouts are chosen per route, e.g. chat generations may take minutes while
+    the model catalog should fail fast.
+    """
+
+    def __init__(self,
+                 pool_size: int = 100,
+                 pool_size_per_host: int = 20,
+                 keepalive_timeout: float = 30.0,
+                 timeouts: Optional[Dict[str, aiohttp.ClientTimeout]] = None,
+                 retry: Optional[RetryPolicy] = None):
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeouts = {"default": aiohttp.ClientTimeout(total=30, sock_connect=5)}
+        self.timeouts.update(timeouts or {})
+        self.retry = retry or RetryPolicy()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTP client is not started")
+        return self._session
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              timeout=self.timeouts["default"])
+        logger.debug(f"HTTP pool started (limit={self.pool_size}, per_host={self.pool_size_per_host})")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def timeout(self, route: str) -> aiohttp.ClientTimeout:
+        return self.timeouts.get(route, self.timeouts["default"])
+
+    async def request(self, method: str, url: str, route: str = "default", **kwargs) -> aiohttp.ClientResponse:
+        """
+        Send a request with the route's timeout and the retry policy applied.
+
+        The returned response must be released by the caller, typically with
+        ``async with await client.request(...) as resp:``.
+        """
+        method = method.upper()
+        idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", self.timeout(route))
+        attempt = 0
+        while True:
+            attempt += 1
+            last_try = attempt >= self.retry.attempts
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+            except aiohttp.ClientConnectorError as e:
+                # The connection was never made, so nothing reached the server
+                # and this is safe to retry for any method.
+                if last_try:
+                    raise
+                logger.debug(f"{method} {url} failed ({e}), retry {attempt}/{self.retry.attempts - 1}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Includes a server disconnecting mid-request: it may already
+                # have acted on a POST, e.g. started a generation.
+                if last_try or not idempotent:
+                    raise
+                logger.debug(f"{method} {url} failed ({e!r}), retry {attempt}/{self.retry.attempts - 1}")
+            else:
+                if last_try or not idempotent or resp.status not in self.retry.retry_statuses:
+                    return resp
+                logger.debug(f"{method} {url} returned {resp.status}, retry {attempt}/{self.retry.attempts - 1}")
+                resp.release()
+            await asyncio.sleep(self.retry.delay(attempt))
+
+    async def get(self, url: str, route: str = "default", **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("GET", url, route=route, **kwargs)
+
+    async def post(self, url: str, route: str = "default", **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("POST", url, route=route, **kwargs)
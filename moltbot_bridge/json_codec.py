@@ -0,0 +1,39 @@
+"""
+JSON encoding for the Home Assistant WebSocket traffic.
+
+``orjson`` parses a large ``get_states`` reply several times faster than the
+standard library and takes bytes straight off the socket, so text frames
+don't have to be decoded to ``str`` first. It is used when installed; the
+standard library is the fallback. Both produce compact output (no spaces
+after separators) and raise a ``ValueError`` subclass on bad input.
+"""
+import json
+from typing import Any, Callable, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    __slots__ = ("name", "loads", "dumps")
+
+    def __init__(self, name: str, loads: Callable[[Union[bytes, str]], Any], dumps: Callable[[Any], str]):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return f"JsonCodec({self.name})"
+
+
+STDLIB = JsonCodec("json", json.loads, lambda obj: json.dumps(obj, separators=(",", ":"), ensure_ascii=False))
+ORJSON = JsonCodec("orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode()) if orjson is not None else None
+
+
+def get_codec(name: str = "") -> JsonCodec:
+    """The codec called ``name``, or the fastest one available; an unavailable choice falls back to the stdlib."""
+    if name == "json":
+        return STDLIB
+    return ORJSON or STDLIB
@@ -0,0 +1,369 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+
+import aiohttp
+
+from http_client import RetryPolicy, SharedHttpClient
+from metrics import REGISTRY
+
+logger = logging.getLogger("MoltbotAddon.outbox")
+
+MESSAGES = REGISTRY.counter(
+    "moltbot_messages_total", "Outbound messages by provider and result (sent, retried, dead)",
+    labels=("provider", "result"))
+MESSAGE_DELIVERY_SECONDS = REGISTRY.histogram(
+    "moltbot_message_delivery_seconds", "Time from queueing a message until the provider accepted it",
+    labels=("provider",))
+MESSAGE_QUEUE_DEPTH = REGISTRY.gauge(
+    "moltbot_message_queue_depth", "Outbound messages waiting to be sent", labels=("provider",))
+MESSAGE_DEAD_LETTERS = REGISTRY.gauge(
+    "moltbot_message_dead_letters", "Messages that could not be delivered and were set aside", labels=("provider",))
+
+# Due messages read per round; same-target runs among them are joined into one send
+BATCH_ROWS = 50
+BATCH_SEPARATOR = "\n\n"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    target TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (provider, dead, next_attempt);
+"""
+
+
+class ProviderError(Exception):
+    """A failed send. ``retryable`` is False when sending the same message again cannot succeed."""
+
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """``rate`` sends per second on average, up to ``burst`` back to back."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = self.blocked_until - now
+            if wait <= 0 and self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(max(wait, (1 - self.tokens) / self.rate))
+
+    def pause(self, seconds: float):
+        """Hold all sends for ``seconds``, e.g. after the provider answered 429."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class Provider:
+    """One messaging service. Subclasses send a single text and raise ProviderError on failure."""
+
+    name = ""
+    # Sustained sends per second and how many may go out back to back
+    rate = 1.0
+    burst = 1
+    # Longest text per send; queued messages to one target are joined up to this
+    max_length = 1600
+
+    async def send(self, http: SharedHttpClient, target: str, text: str, message_ids: List[int]):
+        """Send ``text``, the queued messages ``message_ids`` joined together."""
+        raise NotImplementedError
+
+    @staticmethod
+    async def check(resp: aiohttp.ClientResponse):
+        if resp.status < 300:
+            return
+        details = (await resp.text())[:200]
+        retry_after = None
+        try:
+            retry_after = float(resp.headers.get("Retry-After", ""))
+        except ValueError:
+            pass
+        # Rate limited or a server-side problem: worth another try. Any other 4xx won't change.
+        retryable = resp.status in (408, 425, 429) or resp.status >= 500
+        raise ProviderError(f"HTTP {resp.status}: {details}", retryable, retry_after)
+
+
+class TwilioProvider(Provider):
+    """WhatsApp (or SMS) through Twilio's Messages API."""
+
+    name = "twilio"
+    rate = 1.0
+    burst = 5
+    max_length = 1600
+
+    def __init__(self, account_sid: str, auth_token: str, sender: str, api_url: str = "https://api.twilio.com"):
+        self.url = f"{api_url.rstrip('/')}/2010-04-01/Accounts/{account_sid}/Messages.json"
+        self.auth = aiohttp.BasicAuth(account_sid, auth_token)
+        self.sender = sender
+
+    async def send(self, http, target, text, message_ids):
+        if self.sender.startswith("whatsapp:") and not target.startswith("whatsapp:"):
+            target = f"whatsapp:{target}"
+        data = {"From": self.sender, "To": target, "Body": text}
+        async with await http.post(self.url, route="messaging", data=data, auth=self.auth) as resp:
+            await self.check(resp)
+
+
+class MatrixProvider(Provider):
+    """A Matrix room, through the client-server API of the bot user's homeserver."""
+
+    name = "matrix"
+    rate = 2.0
+    burst = 10
+    max_length = 4000
+
+    def __init__(self, homeserver: str, access_token: str):
+        self.homeserver = homeserver.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {access_token}"}
+
+    async def send(self, http, target, text, message_ids):
+        # The transaction id makes a retried send idempotent on the homeserver. It covers every
+        # message in the batch, since a retry may join more messages than the first attempt.
+        txn = str(message_ids[0])
+        if len(message_ids) > 1:
+            txn += "-" + hashlib.sha1(",".join(map(str, message_ids)).encode()).hexdigest()[:16]
+        url = (f"{self.homeserver}/_matrix/client/v3/rooms/{quote(target, safe='')}"
+               f"/send/m.room.message/moltbot-{txn}")
+        body = {"msgtype": "m.text", "body": text}
+        async with await http.request("PUT", url, route="messaging", json=body, headers=self.headers) as resp:
+            if resp.status == 429:
+                data = await resp.json(content_type=None)
+                raise ProviderError("rate limited", True, (data.get("retry_after_ms") or 1000) / 1000)
+            await self.check(resp)
+
+
+class BlueBubblesProvider(Provider):
+    """iMessage through a BlueBubbles server."""
+
+    name = "bluebubbles"
+    rate = 1.0
+    burst = 3
+    max_length = 2000
+
+    def __init__(self, url: str, password: str):
+        self.url = f"{url.rstrip('/')}/api/v1/message/text"
+        self.params = {"password": password}
+
+    async def send(self, http, target, text, message_ids):
+        # A bare address means a one-to-one iMessage chat
+        chat = target if ";" in target else f"iMessage;-;{target}"
+        body = {"chatGuid": chat, "tempGuid": str(uuid.uuid4()), "message": text}
+        async with await http.post(self.url, route="messaging", params=self.params, json=body) as resp:
+            await self.check(resp)
+
+
+class Outbox:
+    """
+    Durable outbound message queue.
+
+    ``enqueue`` only writes a row to SQLite and returns, so a burst of
+    notifications never waits on a provider. One worker per provider sends
+    due messages through a token bucket at the provider's rate. Messages to
+    the same target that are due together are joined into one send, up to
+    the provider's length limit. Failed sends are retried with exponential
+    backoff (longer if the provider asks for it with Retry-After). After
+    ``max_attempts``, or at once if the provider rejects the message
+    outright, a message moves to the dead-letter list, where it stays
+    until it is retried or cleared. Rows are deleted only once a provider
+    has accepted them, so queued messages survive a restart.
+    """
+
+    def __init__(self, path: str, http: SharedHttpClient, providers: Dict[str, Provider],
+                 max_attempts: int = 8, backoff: Optional[RetryPolicy] = None):
+        self.path = path
+        self.http = http
+        self.providers = providers
+        self.max_attempts = max_attempts
+        self.backoff = backoff or RetryPolicy(backoff=5.0, max_backoff=900.0)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._wake = {name: asyncio.Event() for name in providers}
+        self._buckets = {name: TokenBucket(p.rate, p.burst) for name, p in providers.items()}
+        self._tasks: List[asyncio.Task] = []
+        MESSAGE_QUEUE_DEPTH.callback = lambda: self._counts(dead=False)
+        MESSAGE_DEAD_LETTERS.callback = lambda: self._counts(dead=True)
+
+    # --- API ---
+
+    def enqueue(self, provider: str, target: str, body: str) -> int:
+        if provider not in self.providers:
+            raise ValueError(f"Messaging provider '{provider}' is not configured")
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO outbox (provider, target, body, created, next_attempt) VALUES (?, ?, ?, ?, ?)",
+            (provider, target, body, now, now))
+        self._wake[provider].set()
+        return cursor.lastrowid
+
+    def pending(self) -> Dict[str, int]:
+        return {key[0]: count for key, count in self._counts(dead=False).items()}
+
+    def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        rows = self.db.execute(
+            "SELECT id, provider, target, body, created, attempts, error FROM outbox "
+            "WHERE dead = 1 ORDER BY id DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows]
+
+    def retry_dead(self, ids: Optional[List[int]] = None) -> int:
+        """Put dead letters (all, or just ``ids``) back in the queue with a fresh attempt count."""
+        query = "UPDATE outbox SET dead = 0, attempts = 0, next_attempt = ?, error = NULL WHERE dead = 1"
+        params: List[Any] = [time.time()]
+        if ids is not None:
+            if not ids:
+                return 0
+            query += f" AND id IN ({','.join('?' * len(ids))})"
+            params += ids
+        count = self.db.execute(query, params).rowcount
+        for wake in self._wake.values():
+            wake.set()
+        return count
+
+    def clear_dead(self) -> int:
+        return self.db.execute("DELETE FROM outbox WHERE dead = 1").rowcount
+
+    def start(self):
+        for provider in self.providers.values():
+            self._tasks.append(asyncio.create_task(self._worker(provider)))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        self.db.close()
+
+    # --- Worker ---
+
+    async def _worker(self, provider: Provider):
+        wake = self._wake[provider.name]
+        bucket = self._buckets[provider.name]
+        while True:
+            try:
+                await self._send_due(provider, wake, bucket)
+            except sqlite3.Error as e:
+                # The rows are still queued; try again rather than stop this provider for good
+                logger.error(f"Outbox database error for {provider.name}: {e}")
+                await asyncio.sleep(self.backoff.delay(1))
+
+    async def _send_due(self, provider: Provider, wake: asyncio.Event, bucket: TokenBucket):
+        wake.clear()
+        rows = self.db.execute(
+            "SELECT id, target, body, created, attempts FROM outbox "
+            "WHERE provider = ? AND dead = 0 AND next_attempt <= ? ORDER BY id LIMIT ?",
+            (provider.name, time.time(), BATCH_ROWS)).fetchall()
+        if not rows:
+            await self._sleep_until_due(provider.name, wake)
+            return
+        for group in self._batches(rows, provider.max_length):
+            await bucket.acquire()
+            try:
+                await self._deliver(provider, bucket, group)
+            except sqlite3.Error:
+                raise
+            except Exception as e:
+                # E.g. a reply that isn't the JSON the provider documents; retried like any failed send
+                logger.exception(f"Unexpected error sending {provider.name} message(s) to {group[0]['target']}")
+                self._failed(provider.name, group, f"{type(e).__name__}: {e}", True, None)
+
+    async def _sleep_until_due(self, provider: str, wake: asyncio.Event):
+        row = self.db.execute(
+            "SELECT MIN(next_attempt) FROM outbox WHERE provider = ? AND dead = 0", (provider,)).fetchone()
+        timeout = max(0.0, row[0] - time.time()) if row[0] is not None else None
+        try:
+            await asyncio.wait_for(wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    @staticmethod
+    def _batches(rows: List[sqlite3.Row], max_length: int) -> List[List[sqlite3.Row]]:
+        """Group rows by target, keeping queue order, so each group fits in one send."""
+        groups: Dict[str, List[List[sqlite3.Row]]] = {}
+        ordered = []
+        for row in rows:
+            runs = groups.setdefault(row["target"], [])
+            if runs:
+                run = runs[-1]
+                length = sum(len(r["body"]) for r in run) + len(BATCH_SEPARATOR) * len(run)
+                if length + len(row["body"]) <= max_length:
+                    run.append(row)
+                    continue
+            run = [row]
+            runs.append(run)
+            ordered.append(run)
+        return ordered
+
+    async def _deliver(self, provider: Provider, bucket: TokenBucket, group: List[sqlite3.Row]):
+        ids = [row["id"] for row in group]
+        text = BATCH_SEPARATOR.join(row["body"] for row in group)
+        try:
+            await provider.send(self.http, group[0]["target"], text, ids)
+        except (ProviderError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+            retryable = getattr(e, "retryable", True)
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after:
+                bucket.pause(retry_after)
+            self._failed(provider.name, group, error, retryable, retry_after)
+            return
+        self.db.execute(f"DELETE FROM outbox WHERE id IN ({','.join('?' * len(ids))})", ids)
+        now = time.time()
+        for row in group:
+            MESSAGES.inc(provider=provider.name, result="sent")
+            MESSAGE_DELIVERY_SECONDS.observe(now - row["created"], provider=provider.name)
+
+    def _failed(self, provider: str, group: List[sqlite3.Row], error: str, retryable: bool,
+                retry_after: Optional[float]):
+        attempts = max(row["attempts"] for row in group) + 1
+        ids = [row["id"] for row in group]
+        placeholders = ",".join("?" * len(ids))
+        if not retryable or attempts >= self.max_attempts:
+            logger.error(f"Giving up on {len(ids)} {provider} message(s) to {group[0]['target']} "
+                         f"after {attempts} attempt(s): {error}")
+            self.db.execute(f"UPDATE outbox SET dead = 1, attempts = ?, error = ? WHERE id IN ({placeholders})",
+                            [attempts, error] + ids)
+            MESSAGES.inc(len(ids), provider=provider, result="dead")
+            return
+        delay = max(retry_after or 0, self.backoff.delay(attempts))
+        logger.warning(f"Sending {provider} message(s) to {group[0]['target']} failed ({error}); "
+                       f"retry {attempts}/{self.max_attempts - 1} in {delay:.0f}s")
+        self.db.execute(
+            f"UPDATE outbox SET attempts = ?, error = ?, next_attempt = ? WHERE id IN ({placeholders})",
+            [attempts, error, time.time() + delay] + ids)
+        MESSAGES.inc(len(ids), provider=provider, result="retried")
+
+    def _counts(self, dead: bool) -> Dict[tuple, int]:
+        rows = self.db.execute("SELECT provider, COUNT(*) FROM outbox WHERE dead = ? GROUP BY provider",
+                               (int(dead),))
+        return {(provider,): count for provider, count in rows}
@@ -0,0 +1,122 @@
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from state_store import EntityStore
+
+_SPACE = re.compile(r"\s+")
+_TRAILING = re.compile(r"[\s?!.,;:]+$")
+# Friendly names shorter than this ("TV", "Fan") match too much text to count as references
+MIN_NAME_LENGTH = 4
+# Bookkeeping per entry on top of the text itself
+ENTRY_OVERHEAD = 200
+
+
+class _Entry:
+    __slots__ = ("response", "entities", "expires", "size")
+
+    def __init__(self, response: str, entities: Set[str], expires: float, size: int):
+        self.response = response
+        self.entities = entities
+        self.expires = expires
+        self.size = size
+
+
+class ChatResponseCache:
+    """
+    Answers to repeated chat messages, for templated automation queries.
+
+    Entries are keyed on the normalized message, the model and a context
+    version (``EntityStore.structure_version``: entities added or removed,
+    areas changed). Each entry also remembers the entities its message and
+    answer mention, and is dropped as soon as one of those changes. Entries
+    expire after ``ttl`` seconds, and the least recently used ones are evicted
+    once the cache holds more than ``max_bytes`` of text or ``max_entries``
+    entries. A ``ttl`` of 0 disables the cache.
+    """
+
+    def __init__(self, ttl: float = 0, max_bytes: int = 8 * 1024 * 1024, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self._entries: "OrderedDict[Tuple, _Entry]" = OrderedDict()
+        # entity_id -> keys of the entries that mention it
+        self._by_entity: Dict[str, Set[Tuple]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        """Case, spacing, Unicode form and trailing punctuation don't change the question."""
+        text = unicodedata.normalize("NFKC", message).casefold()
+        return _TRAILING.sub("", _SPACE.sub(" ", text).strip())
+
+    def key(self, message: str, model: str, context_version: int) -> Tuple:
+        return (self.normalize(message), model, context_version)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.response
+
+    def put(self, key: Tuple, response: str, entities: Iterable[str] = ()):
+        if not self.enabled or not response:
+            return
+        size = len(key[0].encode()) + len(response.encode()) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        entry = _Entry(response, set(entities), time.monotonic() + self.ttl, size)
+        self._entries[key] = entry
+        self.bytes += size
+        for entity_id in entry.entities:
+            self._by_entity.setdefault(entity_id, set()).add(key)
+        while self.bytes > self.max_bytes or len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate_entity(self, entity_id: str):
+        """Drop every answer that mentions ``entity_id``; hooked into EntityStore.listeners."""
+        for key in self._by_entity.pop(entity_id, ()):
+            self._drop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_entity.clear()
+        self.bytes = 0
+
+    def _drop(self, key: Tuple):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        for entity_id in entry.entities:
+            keys = self._by_entity.get(entity_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_entity[entity_id]
+
+
+def referenced_entities(store: EntityStore, *texts: str) -> List[str]:
+    """Entities whose entity_id or friendly name appears in any of ``texts``."""
+    haystack = ChatResponseCache.normalize(" ".join(texts))
+    found = []
+    for state in store.all():
+        entity_id = state.get("entity_id", "")
+        name = ChatResponseCache.normalize(str((state.get("attributes") or {}).get("friendly_name") or ""))
+        if entity_id in haystack or (len(name) >= MIN_NAME_LENGTH and name in haystack):
+            found.append(entity_id)
+    return found
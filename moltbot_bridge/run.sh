@@ -25,6 +25,33 @@ export WHATSAPP_SID=$(jq --raw-output '.whatsapp_sid // empty' $CONFIG_PATH)
 export WHATSAPP_TOKEN=$(jq --raw-output '.whatsapp_token // empty' $CONFIG_PATH)
 export WHATSAPP_FROM=$(jq --raw-output '.whatsapp_from // empty' $CONFIG_PATH)
 
+# Outbound HTTP tuning (empty = use the bridge defaults)
+export GATEWAY_TIMEOUT=$(jq --raw-output '.gateway_timeout // empty' $CONFIG_PATH)
+export HTTP_TIMEOUT=$(jq --raw-output '.http_timeout // empty' $CONFIG_PATH)
+export HTTP_POOL_SIZE=$(jq --raw-output '.http_pool_size // empty' $CONFIG_PATH)
+export HTTP_RETRIES=$(jq --raw-output '.http_retries // empty' $CONFIG_PATH)
+
+# Ollama add-on web server, for switching models without restarting it
+export OLLAMA_UI_URL=$(jq --raw-output '.ollama_ui_url // empty' $CONFIG_PATH)
+
+# Chat response cache (empty = disabled)
+export RESPONSE_CACHE_TTL=$(jq --raw-output '.response_cache_ttl // empty' $CONFIG_PATH)
+export RESPONSE_CACHE_MB=$(jq --raw-output '.response_cache_mb // empty' $CONFIG_PATH)
+
+# Chat history per session (empty = use the bridge defaults)
+export CHAT_CONTEXT_TOKENS=$(jq --raw-output '.chat_context_tokens // empty' $CONFIG_PATH)
+export CHAT_SESSION_TIMEOUT=$(jq --raw-output '.chat_session_timeout // empty' $CONFIG_PATH)
+export CHAT_MAX_SESSIONS=$(jq --raw-output '.chat_max_sessions // empty' $CONFIG_PATH)
+export CHAT_CONTEXT_ENTITIES=$(jq --raw-output '.chat_context_entities // empty' $CONFIG_PATH)
+
+# Outbound message queue (empty = use the provider defaults)
+export MESSAGE_RATE=$(jq --raw-output '.message_rate // empty' $CONFIG_PATH)
+export MESSAGE_MAX_ATTEMPTS=$(jq --raw-output '.message_max_attempts // empty' $CONFIG_PATH)
+
+# Google HomeGraph state reporting (needs /config/moltbot/google_creds.json)
+export GOOGLE_AGENT_USER_ID=$(jq --raw-output '.google_agent_user_id // empty' $CONFIG_PATH)
+export GOOGLE_REPORT_DEBOUNCE=$(jq --raw-output '.google_report_debounce // empty' $CONFIG_PATH)
+
 # --- Moltbot Setup ---
 
 echo "Setting up Moltbot..."
@@ -107,6 +134,8 @@ echo "Applying settings via CLI..."
 FULL_MODEL="$LLM_PROVIDER/$MODEL_NAME"
 
 echo "Setting agent model to: $FULL_MODEL"
+# The bridge keys its response cache on the model
+export CHAT_MODEL="$FULL_MODEL"
 
 # Set agent.model (Confirmed valid key)
 clawdbot config set agent.model "$FULL_MODEL" || true
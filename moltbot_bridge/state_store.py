@@ -0,0 +1,307 @@
+import sys
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# String values up to this length ("on", "°C", "temperature") are interned and shared between entities
+INTERN_MAX = 32
+STATE_FIELDS = ("entity_id", "state", "attributes", "last_changed", "last_updated")
+
+
+def _share(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str and len(value) <= INTERN_MAX else value
+
+
+class _Shape:
+    """An attribute key set, shared by every entity that has exactly these keys."""
+
+    __slots__ = ("keys", "index")
+
+    def __init__(self, keys: Tuple[str, ...]):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+
+
+_SHAPES: Dict[Tuple[str, ...], _Shape] = {}
+
+
+class Attributes(Mapping):
+    """
+    Read-only entity attributes: a shared key layout plus a tuple of values,
+    instead of one dict per entity.
+    """
+
+    __slots__ = ("_shape", "_values")
+
+    def __init__(self, attributes: Dict[str, Any]):
+        keys = tuple(attributes)
+        shape = _SHAPES.get(keys)
+        if shape is None:
+            shape = _SHAPES[keys] = _Shape(tuple(sys.intern(k) for k in keys))
+        self._shape = shape
+        self._values = tuple(_share(v) for v in attributes.values())
+
+    def __getitem__(self, key: str) -> Any:
+        return self._values[self._shape.index[key]]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        i = self._shape.index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._shape.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._shape.keys)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Attributes):
+            return self._shape is other._shape and self._values == other._values
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(zip(self._shape.keys, self._values))
+
+
+class EntityState(Mapping):
+    """
+    One entity's state as a slotted record that reads like the ``get_states``
+    dict it came from. The event ``context`` is not kept.
+    """
+
+    __slots__ = STATE_FIELDS
+
+    def __init__(self, state: Dict[str, Any]):
+        self.entity_id = sys.intern(state["entity_id"])
+        self.state = _share(state.get("state"))
+        self.attributes = Attributes(state.get("attributes") or {})
+        self.last_changed = state.get("last_changed")
+        self.last_updated = state.get("last_updated")
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in STATE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(STATE_FIELDS)
+
+    def __len__(self) -> int:
+        return len(STATE_FIELDS)
+
+    def same_as(self, state: Dict[str, Any]) -> bool:
+        """True if the raw ``state`` dict describes this same state."""
+        return (self.state == state.get("state") and self.last_updated == state.get("last_updated")
+                and self.last_changed == state.get("last_changed")
+                and self.attributes == (state.get("attributes") or {}))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"entity_id": self.entity_id, "state": self.state, "attributes": self.attributes.to_dict(),
+                "last_changed": self.last_changed, "last_updated": self.last_updated}
+
+
+class EntityStore:
+    """
+    In-memory mirror of Home Assistant state.
+
+    Filled once from ``get_states`` and then kept current from ``state_changed``
+    events, so reads never go over the WebSocket. States are held as
+    ``EntityState`` records, which share attribute key layouts and short
+    strings between entities. Every change bumps
+    ``version``; callers remember the version they last saw and ask for
+    ``changes_since(version)`` instead of re-reading everything.
+
+    ``structure_version`` only moves when entities are added or removed or the
+    area registry changes, not on ordinary state updates. Callbacks in
+    ``listeners`` are called with the entity_id of every change.
+    """
+
+    def __init__(self, max_tombstones: int = 5000):
+        self.version = 0
+        self._states: Dict[str, EntityState] = {}
+        self._by_domain: Dict[str, Set[str]] = {}
+        self._by_area: Dict[str, Set[str]] = {}
+        # entity_id -> area_id, resolved from the entity and device registries
+        self._entity_area: Dict[str, str] = {}
+        self._area_names: Dict[str, str] = {}
+        # entity_id -> version of its last change, oldest first
+        self._changed: "OrderedDict[str, int]" = OrderedDict()
+        self._tombstones: "OrderedDict[str, int]" = OrderedDict()
+        self._max_tombstones = max_tombstones
+        # Changes older than this can no longer be reported (tombstones evicted)
+        self._horizon = 0
+        self.synced = False
+        self.structure_version = 0
+        self.listeners: List[Callable[[str], None]] = []
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, entity_id: str):
+        return entity_id in self._states
+
+    # --- Reads ---
+
+    def get(self, entity_id: str) -> Optional[EntityState]:
+        return self._states.get(entity_id)
+
+    def all(self) -> List[EntityState]:
+        return list(self._states.values())
+
+    def domain(self, domain: str) -> List[EntityState]:
+        return [self._states[e] for e in self._by_domain.get(domain, ())]
+
+    def area(self, area: str) -> List[EntityState]:
+        """Entities in an area, looked up by area_id or (case-insensitive) area name."""
+        area_id = area if area in self._by_area else self._area_id_for_name(area)
+        return [self._states[e] for e in self._by_area.get(area_id, ())]
+
+    def area_of(self, entity_id: str) -> Optional[str]:
+        return self._entity_area.get(entity_id)
+
+    def area_name(self, area_id: str) -> Optional[str]:
+        return self._area_names.get(area_id)
+
+    def domains(self) -> List[str]:
+        return sorted(self._by_domain)
+
+    def areas(self) -> Dict[str, str]:
+        return dict(self._area_names)
+
+    def changes_since(self, version: int) -> Dict[str, Any]:
+        """
+        Entities changed or removed after ``version``.
+
+        ``full`` is set when ``version`` is older than what the store can
+        still account for; the caller should then re-read ``states``.
+        """
+        if version < self._horizon:
+            return {"version": self.version, "full": True, "changed": self.all(), "removed": []}
+        changed = []
+        for entity_id, v in reversed(self._changed.items()):
+            if v <= version:
+                break
+            changed.append(self._states[entity_id])
+        removed = []
+        for entity_id, v in reversed(self._tombstones.items()):
+            if v <= version:
+                break
+            removed.append(entity_id)
+        changed.reverse()
+        removed.reverse()
+        return {"version": self.version, "full": False, "changed": changed, "removed": removed}
+
+    # --- Writes ---
+
+    def load_snapshot(self, states: Iterable[Dict[str, Any]]):
+        """Replace the store with a full ``get_states`` result, recording only real differences."""
+        seen = set()
+        for state in states:
+            entity_id = state.get("entity_id")
+            if not entity_id:
+                continue
+            seen.add(entity_id)
+            current = self._states.get(entity_id)
+            if current is None or not current.same_as(state):
+                self._set(entity_id, state)
+        for entity_id in [e for e in self._states if e not in seen]:
+            self._remove(entity_id)
+        self.synced = True
+
+    def apply_event(self, data: Dict[str, Any]) -> bool:
+        """Apply the ``data`` of a ``state_changed`` event. Returns True if the store changed."""
+        entity_id = data.get("entity_id")
+        if not entity_id:
+            return False
+        new_state = data.get("new_state")
+        if new_state is None:
+            if entity_id not in self._states:
+                return False
+            self._remove(entity_id)
+            return True
+        self._set(entity_id, new_state)
+        return True
+
+    def load_registries(self, areas: Iterable[Dict[str, Any]],
+                        devices: Iterable[Dict[str, Any]],
+                        entities: Iterable[Dict[str, Any]]):
+        """Resolve each entity's area: its own area_id, else the area of its device."""
+        self._area_names = {a["area_id"]: a.get("name") or a["area_id"] for a in areas if a.get("area_id")}
+        device_area = {d["id"]: d.get("area_id") for d in devices if d.get("id")}
+        entity_area = {}
+        for entry in entities:
+            entity_id = entry.get("entity_id")
+            area_id = entry.get("area_id") or device_area.get(entry.get("device_id"))
+            if entity_id and area_id:
+                entity_area[entity_id] = area_id
+        self._entity_area = entity_area
+        self._by_area = {}
+        for entity_id in self._states:
+            self._index_area(entity_id)
+        self.structure_version += 1
+        self._bump_all()
+
+    # --- Internals ---
+
+    def _area_id_for_name(self, name: str) -> Optional[str]:
+        name = name.lower()
+        for area_id, area_name in self._area_names.items():
+            if area_name.lower() == name:
+                return area_id
+        return None
+
+    def _index_area(self, entity_id: str):
+        area_id = self._entity_area.get(entity_id)
+        if area_id:
+            self._by_area.setdefault(area_id, set()).add(entity_id)
+
+    def _bump(self, entity_id: str):
+        self.version += 1
+        self._changed[entity_id] = self.version
+        self._changed.move_to_end(entity_id)
+        self._notify(entity_id)
+
+    def _notify(self, entity_id: str):
+        for listener in self.listeners:
+            listener(entity_id)
+
+    def _bump_all(self):
+        # Area changes alter every entity's context; report them all once.
+        for entity_id in self._states:
+            self._bump(entity_id)
+
+    def _set(self, entity_id: str, state: Dict[str, Any]):
+        state = EntityState(state)
+        if entity_id not in self._states:
+            self._by_domain.setdefault(entity_id.split(".", 1)[0], set()).add(entity_id)
+            self._index_area(entity_id)
+            self._tombstones.pop(entity_id, None)
+            self.structure_version += 1
+        self._states[entity_id] = state
+        self._bump(entity_id)
+
+    def _remove(self, entity_id: str):
+        self._states.pop(entity_id, None)
+        self._changed.pop(entity_id, None)
+        domain = entity_id.split(".", 1)[0]
+        members = self._by_domain.get(domain)
+        if members is not None:
+            members.discard(entity_id)
+            if not members:
+                del self._by_domain[domain]
+        area_id = self._entity_area.get(entity_id)
+        if area_id and area_id in self._by_area:
+            self._by_area[area_id].discard(entity_id)
+        self.version += 1
+        self.structure_version += 1
+        self._tombstones[entity_id] = self.version
+        self._tombstones.move_to_end(entity_id)
+        self._notify(entity_id)
+        while len(self._tombstones) > self._max_tombstones:
+            _, evicted_version = self._tombstones.popitem(last=False)
+            self._horizon = max(self._horizon, evicted_version)
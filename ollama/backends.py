@@ -0,0 +1,238 @@
+"""
+Routing of generation requests across several Ollama instances.
+
+One box may run more than one Ollama, e.g. this add-on on the CPU and the
+Intel GPU add-on next to it. With their URLs in ``OLLAMA_BACKENDS`` the
+proxy sends each request to the instance expected to finish it first:
+
+- an instance that already has the model loaded (``/api/ps``) saves the
+  multi-second cold load, so it wins unless it is much busier;
+- the requests each instance is already running through the proxy and the
+  decode speed measured for the model there estimate how long a new
+  request would take;
+- instances are health-checked every few seconds and skipped while down;
+  a request whose instance cannot be reached goes to the next best one;
+- ``/api/tags`` and ``/api/ps`` list the union of all instances, so
+  clients see every model they can use.
+
+Models only one instance has installed are always sent there. Requests
+that don't name a model (pulls, deletes, ...) go to the local instance.
+Without extra backends everything goes to the local instance.
+
+This file is kept identical in every add-on that uses it.
+"""
+import asyncio
+import json
+import sys
+import time
+
+import aiohttp
+
+from pull_manager import normalize
+
+# Seconds between health checks of a healthy instance
+HEALTH_INTERVAL = 5.0
+# Failed instances are checked with backoff, up to this
+MAX_RECHECK = 60.0
+CHECK_TIMEOUT = aiohttp.ClientTimeout(total=5, sock_connect=2)
+# Assumed until measured on an instance
+DEFAULT_DECODE_TPS = 10.0
+DEFAULT_LOAD_S = 10.0
+# Length of a typical answer, to turn tokens/s into seconds
+TYPICAL_TOKENS = 200
+# Weight of the newest measurement in the rolling speeds
+SMOOTHING = 0.3
+
+
+def parse_backends(value):
+    """Backend URLs from a comma- or space-separated option."""
+    return [url.strip().rstrip('/') for url in (value or '').replace(',', ' ').split() if url.strip()]
+
+
+def request_model(body):
+    """The ``model`` named in a JSON request body, normalized, or None."""
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        return None
+    model = data.get('model') or data.get('name') if isinstance(data, dict) else None
+    return normalize(model) if isinstance(model, str) and model.strip() else None
+
+
+class Backend:
+    def __init__(self, url, local=False):
+        self.url = url.rstrip('/')
+        self.name = 'local' if local else self.url.split('://', 1)[-1]
+        self.local = local
+        self.healthy = True
+        self.failures = 0
+        self.error = None
+        self.next_check = 0.0
+        self.active = 0
+        self.requests = 0
+        self.resident = set()
+        # None until the first api/tags answer
+        self.installed = None
+        # model -> rolling decode tokens/s and load seconds measured here
+        self.decode_tps = {}
+        self.load_s = {}
+
+    def has(self, model):
+        return self.installed is None or model in self.installed
+
+    def expected_seconds(self, model, fallback_tps):
+        """Estimated time until a new request for ``model`` would be answered here."""
+        generate = TYPICAL_TOKENS / (self.decode_tps.get(model) or fallback_tps)
+        load = 0.0 if model in self.resident else self.load_s.get(model, DEFAULT_LOAD_S)
+        # What is already running here goes first; Ollama's parallel slots only soften that
+        return load + generate * (self.active + 1)
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'url': self.url,
+            'healthy': self.healthy,
+            'error': self.error,
+            'active': self.active,
+            'requests': self.requests,
+            'resident': sorted(self.resident),
+            'installed': len(self.installed) if self.installed is not None else None,
+            'decode_tps': {model: round(tps, 1) for model, tps in self.decode_tps.items()},
+        }
+
+
+class BackendPool:
+    def __init__(self, local_url, extra_urls=(), interval=HEALTH_INTERVAL):
+        self.local = Backend(local_url, local=True)
+        self.backends = [self.local] + [Backend(url) for url in extra_urls if url.rstrip('/') != self.local.url]
+        self.interval = interval
+        self._session = None
+        self._task = None
+
+    @property
+    def multiple(self):
+        return len(self.backends) > 1
+
+    # --- lifecycle ---
+
+    def start(self, session):
+        self._session = session
+        if self.multiple:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    # --- routing ---
+
+    def choose(self, model, exclude=()):
+        """The backend expected to answer a request for ``model`` first, or None if all were tried."""
+        candidates = [b for b in self.backends if b not in exclude]
+        # If every instance looks down, trying one beats refusing outright
+        candidates = [b for b in candidates if b.healthy] or candidates
+        if not candidates:
+            return None
+        if not model:
+            return self.local if self.local in candidates else min(candidates, key=lambda b: b.active)
+        candidates = [b for b in candidates if b.has(model)] or candidates
+        measured = [b.decode_tps[model] for b in self.backends if model in b.decode_tps]
+        fallback = sum(measured) / len(measured) if measured else DEFAULT_DECODE_TPS
+        return min(candidates, key=lambda b: (b.expected_seconds(model, fallback), not b.local))
+
+    def begin(self, backend, model=None):
+        backend.active += 1
+        backend.requests += 1
+        if model:
+            # Ollama loads it for this request; api/ps confirms on the next check
+            backend.resident.add(model)
+
+    def end(self, backend):
+        backend.active -= 1
+
+    def record(self, backend, final):
+        """Fold the stats frame of a finished generation into the backend's measured speeds."""
+        model = final.get('model')
+        if not model:
+            return
+        model = normalize(model)
+        if final.get('eval_count') and final.get('eval_duration'):
+            tps = final['eval_count'] / (final['eval_duration'] / 1e9)
+            previous = backend.decode_tps.get(model)
+            backend.decode_tps[model] = tps if previous is None else previous + SMOOTHING * (tps - previous)
+        load = (final.get('load_duration') or 0) / 1e9
+        # Only a real load says how long the next cold start takes
+        if load > 0.5:
+            previous = backend.load_s.get(model)
+            backend.load_s[model] = load if previous is None else previous + SMOOTHING * (load - previous)
+
+    def mark_failed(self, backend, error):
+        backend.healthy = False
+        backend.failures += 1
+        backend.error = str(error) or type(error).__name__
+        backend.resident.clear()
+        backend.next_check = time.monotonic() + min(MAX_RECHECK, self.interval * 2 ** (backend.failures - 1))
+
+    def snapshot(self):
+        return [backend.summary() for backend in self.backends]
+
+    # --- fan-out ---
+
+    async def merged(self, path):
+        """
+        ``(status, body)`` of a GET to ``path`` on every healthy backend, with
+        their ``models`` lists merged (first backend wins for a model both
+        have). Fails only when no backend answers.
+        """
+        targets = [b for b in self.backends if b.healthy] or self.backends
+        results = await asyncio.gather(*(self._get_json(b, path) for b in targets), return_exceptions=True)
+        models, seen, error, answered = [], set(), None, 0
+        for backend, result in zip(targets, results):
+            if isinstance(result, BaseException):
+                if not isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError, ValueError)):
+                    raise result
+                self.mark_failed(backend, result)
+                error = result
+                continue
+            answered += 1
+            for entry in result.get('models') or []:
+                name = normalize(entry.get('name') or entry.get('model') or '')
+                if name not in seen:
+                    seen.add(name)
+                    models.append(entry)
+        if not answered:
+            raise error
+        return 200, json.dumps({'models': models}).encode()
+
+    # --- health ---
+
+    async def _loop(self):
+        while True:
+            now = time.monotonic()
+            due = [b for b in self.backends if b.next_check <= now]
+            await asyncio.gather(*(self._check(b) for b in due))
+            await asyncio.sleep(1.0)
+
+    async def _check(self, backend):
+        try:
+            loaded = await self._get_json(backend, '/api/ps')
+            tags = await self._get_json(backend, '/api/tags')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            if backend.healthy:
+                print(f"Ollama backend {backend.name} is down: {e}", file=sys.stderr)
+            self.mark_failed(backend, e)
+            return
+        if not backend.healthy:
+            print(f"Ollama backend {backend.name} is back", file=sys.stderr)
+        backend.healthy = True
+        backend.failures = 0
+        backend.error = None
+        backend.next_check = time.monotonic() + self.interval
+        backend.resident = {normalize(m.get('name') or m.get('model') or '') for m in loaded.get('models') or []}
+        backend.installed = {normalize(m.get('name') or m.get('model') or '') for m in tags.get('models') or []}
+
+    async def _get_json(self, backend, path):
+        async with self._session.get(f"{backend.url}{path}", timeout=CHECK_TIMEOUT) as resp:
+            resp.raise_for_status()
+            return await resp.json()
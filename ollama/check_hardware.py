@@ -1,7 +1,46 @@
+import argparse
+import json
+import os
 import platform
-import psutil
+import struct
 import sys
 
+import psutil
+
+try:
+    from model_bench import hardware_fingerprint, load_results, ranking
+except ImportError:
+    ranking = None
+
+MODELS_DIR = os.environ.get("OLLAMA_MODELS", "/share/ollama/models")
+# Written by the Web UI's model benchmark
+BENCHMARK_FILE = os.environ.get("BENCHMARK_FILE", "/data/benchmarks.json")
+DEFAULT_REGISTRY = "registry.ollama.ai"
+# Layers that are loaded into memory along with the model
+WEIGHT_MEDIA_TYPES = ("application/vnd.ollama.image.model", "application/vnd.ollama.image.projector")
+
+# Kept free for Home Assistant and everything else on the box
+MIN_RESERVE = 1024 ** 3
+RESERVE_FRACTION = 0.10
+# Compute buffers and runtime on top of weights and KV cache
+OVERHEAD_FRACTION = 0.10
+MIN_OVERHEAD = 256 * 1024 ** 2
+# Context sizes tried, largest first; Assist prompts with many exposed entities easily pass 2048 tokens
+CONTEXT_SIZES = (8192, 4096, 2048)
+MAX_PARALLEL = 4
+MAX_LOADED = 3
+# Bytes per KV cache element (Ollama's default f16 cache)
+KV_ELEMENT_BYTES = 2
+
+# GGUF value types: struct format for the fixed-size ones
+GGUF_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?",
+                10: "<Q", 11: "<q", 12: "<d"}
+GGUF_STRING, GGUF_ARRAY = 8, 9
+# Metadata needed for sizing, without the architecture prefix
+GGUF_KEYS = ("block_count", "embedding_length", "attention.head_count", "attention.head_count_kv",
+             "attention.key_length", "attention.value_length", "context_length")
+
+
 def get_size(bytes, suffix="B"):
     """
     Scale bytes to its proper format
@@ -15,34 +54,247 @@ def get_size(bytes, suffix="B"):
             return f"{bytes:.2f}{unit}{suffix}"
         bytes /= factor
 
-def check_hardware():
+
+# --- GGUF metadata ---
+
+def _read(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated GGUF header")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f):
+    return f.read(_read(f, "<Q")).decode("utf-8", errors="replace")
+
+
+def _read_value(f, kind):
+    if kind in GGUF_SCALARS:
+        return _read(f, GGUF_SCALARS[kind])
+    if kind == GGUF_STRING:
+        return _read_string(f)
+    if kind == GGUF_ARRAY:
+        item_kind, count = _read(f, "<I"), _read(f, "<Q")
+        if item_kind in GGUF_SCALARS:
+            size = struct.calcsize(GGUF_SCALARS[item_kind])
+            if count > 1024:
+                # Token tables and the like; not needed, so skip without decoding
+                f.seek(size * count, os.SEEK_CUR)
+                return None
+            return [_read(f, GGUF_SCALARS[item_kind]) for _ in range(count)]
+        if item_kind == GGUF_STRING:
+            # Token lists and merges run to hundreds of thousands of strings; step over them by length
+            for _ in range(count):
+                f.seek(_read(f, "<Q"), os.SEEK_CUR)
+            return None
+        return [_read_value(f, item_kind) for _ in range(count)]
+    raise ValueError(f"unknown GGUF value type {kind}")
+
+
+def read_gguf_metadata(path):
+    """The sizing-relevant key/value pairs from a GGUF file header (keys without the architecture prefix)."""
+    with open(path, "rb") as f:
+        if f.read(4) != b"GGUF":
+            raise ValueError("not a GGUF file")
+        version = _read(f, "<I")
+        count_fmt = "<I" if version == 1 else "<Q"
+        _read(f, count_fmt)  # tensor count
+        kv_count = _read(f, count_fmt)
+        raw = {}
+        for _ in range(kv_count):
+            key = _read_string(f)
+            raw[key] = _read_value(f, _read(f, "<I"))
+            arch = raw.get("general.architecture")
+            if arch and all(f"{arch}.{k}" in raw for k in GGUF_KEYS):
+                break
+    arch = raw.get("general.architecture", "")
+    meta = {"architecture": arch}
+    for key in GGUF_KEYS:
+        value = raw.get(f"{arch}.{key}")
+        # Some architectures give per-layer values
+        meta[key] = max(value) if isinstance(value, list) and value else value
+    return meta
+
+
+def kv_bytes_per_token(meta):
+    """KV cache bytes per token of context, or None if the metadata lacks what's needed."""
+    layers, heads = meta.get("block_count"), meta.get("attention.head_count")
+    if not layers or not heads:
+        return None
+    kv_heads = meta.get("attention.head_count_kv") or heads
+    key_length = meta.get("attention.key_length") or (meta.get("embedding_length") or 0) // heads
+    value_length = meta.get("attention.value_length") or key_length
+    if not key_length:
+        return None
+    return layers * kv_heads * (key_length + value_length) * KV_ELEMENT_BYTES
+
+
+# --- installed models ---
+
+def manifest_path(models_dir, model):
+    """Where Ollama keeps the manifest for ``model`` (``llama3.2:3b``, ``user/model``, ``hf.co/org/repo:tag``)."""
+    name, _, tag = model.partition(":")
+    if "/" in tag:
+        name, tag = model, ""
+    parts = name.split("/")
+    if len(parts) == 1:
+        parts = [DEFAULT_REGISTRY, "library"] + parts
+    elif len(parts) == 2:
+        parts = [DEFAULT_REGISTRY] + parts
+    return os.path.join(models_dir, "manifests", *parts, tag or "latest")
+
+
+def model_name(models_dir, path):
+    host, namespace, *name, tag = os.path.relpath(path, os.path.join(models_dir, "manifests")).split(os.sep)
+    if host == DEFAULT_REGISTRY:
+        prefix = "" if namespace == "library" else f"{namespace}/"
+    else:
+        prefix = f"{host}/{namespace}/"
+    return f"{prefix}{'/'.join(name)}:{tag}"
+
+
+def describe_model(models_dir, path, metadata=True):
+    """Name and weight size of an installed model; with ``metadata``, also what its GGUF header says."""
+    with open(path) as f:
+        manifest = json.load(f)
+    info = {"name": model_name(models_dir, path), "size": 0}
+    for layer in manifest.get("layers", []):
+        if layer.get("mediaType") not in WEIGHT_MEDIA_TYPES:
+            continue
+        info["size"] += layer.get("size", 0)
+        if metadata and layer["mediaType"] == WEIGHT_MEDIA_TYPES[0]:
+            blob = os.path.join(models_dir, "blobs", layer["digest"].replace(":", "-"))
+            try:
+                meta = read_gguf_metadata(blob)
+            except (OSError, ValueError, struct.error) as e:
+                info["error"] = str(e)
+                continue
+            info["architecture"] = meta["architecture"]
+            info["context_length"] = meta.get("context_length")
+            info["kv_bytes_per_token"] = kv_bytes_per_token(meta)
+    return info
+
+
+def installed_models(models_dir):
+    root = os.path.join(models_dir, "manifests")
+    models = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            try:
+                models.append(describe_model(models_dir, os.path.join(dirpath, filename), metadata=False))
+            except (OSError, ValueError) as e:
+                print(f"Skipping manifest {filename}: {e}", file=sys.stderr)
+    return sorted(models, key=lambda m: m["name"])
+
+
+# --- sizing ---
+
+def footprint(model, num_ctx, num_parallel):
+    """Estimated memory of ``model`` loaded with ``num_parallel`` slots of ``num_ctx`` tokens."""
+    kv = (model.get("kv_bytes_per_token") or 0) * num_ctx * num_parallel
+    return model["size"] + kv + max(MIN_OVERHEAD, int(model["size"] * OVERHEAD_FRACTION))
+
+
+def tune(hardware, model, num_ctx=None, num_parallel=None):
+    """
+    Pick num_ctx, num_parallel and max_loaded_models for ``model``; None values mean keep the configured ones.
+    A ``num_ctx`` or ``num_parallel`` the user set is kept, and the rest is sized around it.
+    """
+    budget = hardware["ram_available"] - max(MIN_RESERVE, int(hardware["ram_total"] * RESERVE_FRACTION))
+    tuning = {"model": model["name"] if model else None, "budget": budget,
+              "num_ctx": None, "num_parallel": None, "max_loaded_models": None, "notes": []}
+    if model is None:
+        tuning["notes"].append("Model not downloaded yet; using the configured or default values until the next start.")
+        return tuning
+    if not model.get("kv_bytes_per_token"):
+        tuning["notes"].append("Model metadata unreadable; context size is sized from weights only.")
+
+    # Decoding is memory-bandwidth bound, so extra slots only pay off with cores to spare
+    max_parallel = max(1, min(MAX_PARALLEL, (hardware["physical_cores"] or 1) // 4))
+    limit = model.get("context_length") or CONTEXT_SIZES[0]
+    contexts = [num_ctx] if num_ctx else [n for n in CONTEXT_SIZES if n <= limit or n == CONTEXT_SIZES[-1]]
+    slots = [num_parallel] if num_parallel else range(max_parallel, 0, -1)
+    choice = None
+    for ctx in contexts:
+        for parallel in slots:
+            if footprint(model, ctx, parallel) <= budget:
+                choice = (ctx, parallel)
+                break
+        if choice:
+            break
+    if choice is None:
+        choice = (contexts[-1], slots[-1])
+        tuning["notes"].append(
+            f"{model['name']} needs about {get_size(footprint(model, *choice))} but only "
+            f"{get_size(max(budget, 0))} is free; expect swapping or pick a smaller model.")
+    tuning["num_ctx"], tuning["num_parallel"] = choice
+    tuning["footprint"] = footprint(model, *choice)
+    tuning["max_loaded_models"] = max(1, min(MAX_LOADED, budget // tuning["footprint"]))
+    return tuning
+
+
+def detect_hardware():
+    svmem = psutil.virtual_memory()
+    uname = platform.uname()
+    return {
+        "system": uname.system,
+        "machine": uname.machine,
+        "processor": uname.processor,
+        "physical_cores": psutil.cpu_count(logical=False),
+        "logical_cores": psutil.cpu_count(logical=True),
+        "ram_total": svmem.total,
+        "ram_available": svmem.available,
+        "npu": os.path.exists("/dev/accel"),
+        "gpu": os.path.exists("/dev/dri"),
+    }
+
+
+def report(model=None, models_dir=MODELS_DIR, num_ctx=None, num_parallel=None):
+    hardware = detect_hardware()
+    models = installed_models(models_dir)
+    selected = None
+    if model:
+        try:
+            selected = describe_model(models_dir, manifest_path(models_dir, model))
+        except (OSError, ValueError):
+            pass
+    tuning = tune(hardware, selected, num_ctx, num_parallel)
+    if not model:
+        tuning["notes"] = []
+    result = {"hardware": hardware, "models": models, "tuning": tuning}
+    if ranking is not None:
+        # Benchmark results from the Web UI, all devices and Ollama versions on this hardware
+        result["measured"] = ranking(load_results(BENCHMARK_FILE), hardware_fingerprint()[0],
+                                     ram_total=hardware["ram_total"])
+    return result
+
+
+def check_hardware(result):
+    hardware = result["hardware"]
     print("="*40)
     print("Moltbot Ollama Hardware Detection")
     print("="*40)
-    
+
     # System Info
-    uname = platform.uname()
-    print(f"System: {uname.system}")
-    print(f"Machine: {uname.machine}")
-    print(f"Processor: {uname.processor}")
-    
+    print(f"System: {hardware['system']}")
+    print(f"Machine: {hardware['machine']}")
+    print(f"Processor: {hardware['processor']}")
+
     # CPU
-    physical_cores = psutil.cpu_count(logical=False)
-    total_cores = psutil.cpu_count(logical=True)
-    print(f"Physical cores: {physical_cores}")
-    print(f"Total cores: {total_cores}")
-    
+    print(f"Physical cores: {hardware['physical_cores']}")
+    print(f"Total cores: {hardware['logical_cores']}")
+
     # RAM
-    svmem = psutil.virtual_memory()
-    print(f"Total RAM: {get_size(svmem.total)}")
-    print(f"Available RAM: {get_size(svmem.available)}")
-    
+    print(f"Total RAM: {get_size(hardware['ram_total'])}")
+    print(f"Available RAM: {get_size(hardware['ram_available'])}")
+
     # Recommendations
-    total_ram_gb = svmem.total / (1024**3)
-    
+    total_ram_gb = hardware["ram_total"] / (1024**3)
+
     print("-" * 40)
     print("RECOMMENDATION:")
-    
+
     if total_ram_gb < 4:
         print("⚠  Your system has less than 4GB of RAM.")
         print("   We recommend using very small quantized models like:")
@@ -62,14 +314,50 @@ def check_hardware():
         print("   - llama3:8b")
         print("   - mistral:7b")
         print("   - gemma:7b")
-        
+
+    measured = result.get("measured")
+    if measured:
+        print("-" * 40)
+        print("MEASURED ON THIS MACHINE (fastest first):")
+        for row in measured[:5]:
+            print(f"   - {row['model']} on {row['device']}: {row['decode_tps']} tokens/s, "
+                  f"{row['prefill_tps']} prompt tokens/s, loads in {row['load_s']}s")
+
+    tuning = result["tuning"]
+    if tuning["model"]:
+        print("-" * 40)
+        print(f"TUNING for {tuning['model']}:")
+        if tuning["num_ctx"]:
+            print(f"   num_ctx={tuning['num_ctx']} num_parallel={tuning['num_parallel']} "
+                  f"max_loaded_models={tuning['max_loaded_models']} "
+                  f"(about {get_size(tuning['footprint'])} per loaded model)")
+    for note in tuning["notes"]:
+        print(f"   {note}")
+
     print("="*40)
-    
-    # We could output a JSON here if we wanted the bash script to parse it, 
-    # but for now logging to stdout is good for the user to see in HA logs.
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hardware report and Ollama runtime sizing")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON (for run.sh)")
+    parser.add_argument("--model", default=os.environ.get("MODEL"), help="Model to size the runtime for")
+    parser.add_argument("--models-dir", default=MODELS_DIR)
+    parser.add_argument("--num-ctx", type=int, help="Configured context size to size the rest around")
+    parser.add_argument("--num-parallel", type=int, help="Configured parallel slots to size the rest around")
+    parser.add_argument("--saved", metavar="FILE", help="Print a report saved from an earlier --json run")
+    args = parser.parse_args()
     try:
-        check_hardware()
+        if args.saved:
+            with open(args.saved) as f:
+                result = json.load(f)
+        else:
+            result = report(args.model, args.models_dir, args.num_ctx, args.num_parallel)
     except Exception as e:
+        if args.json:
+            sys.exit(f"Error checking hardware: {e}")
         print(f"Error checking hardware: {e}")
+    else:
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            check_hardware(result)
@@ -0,0 +1,331 @@
+"""
+Keeps the right models in memory for the add-on web server.
+
+``OLLAMA_KEEP_ALIVE`` and ``OLLAMA_MAX_LOADED_MODELS`` are fixed at startup,
+which on a small box either unloads a model just before it is needed again
+(a cold load takes seconds) or keeps so much loaded that the OOM killer
+steps in. ``MemoryManager`` samples RAM and swap every few seconds, follows
+the loaded models through ``/api/ps`` and their use through the proxied
+traffic, and:
+
+- preloads the configured model once Ollama has it, so the first request
+  does not pay for the load;
+- when memory runs short, unloads the least recently used idle model with
+  ``keep_alive: 0`` (one per sample, so it stops as soon as enough is free);
+  the preferred model goes last, and only when memory is critically short;
+- stretches keep-alive for models whose requests arrive just a bit further
+  apart than keep-alive, so they stay loaded between requests instead of
+  being reloaded each time.
+
+This file is kept identical in every add-on that uses it.
+"""
+import asyncio
+import re
+import sys
+import time
+from collections import deque
+from datetime import datetime
+
+import aiohttp
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from pull_manager import normalize
+
+# Request times remembered per model, for the keep-alive estimate
+HISTORY = 20
+# Requests needed before keep-alive is adapted at all
+MIN_SAMPLES = 4
+# Percent points above the pressure threshold at which the preferred model is unloaded too
+CRITICAL_MARGIN = 7
+# Swap growth between two samples that counts as the system actively swapping
+SWAP_GROWTH = 64 * 1024 * 1024
+# Only refresh a model's keep-alive when it would move its expiry by more than this
+EXPIRY_SLACK = 30.0
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+TIMESTAMP = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$')
+
+
+def parse_duration(value):
+    """Ollama keep-alive (``"5m"``, ``"1h30m"``, ``300``, ``"-1"``) in seconds; negative means forever."""
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    sign = -1 if text.startswith('-') else 1
+    parts = DURATION_PART.findall(text.lstrip('-'))
+    if not parts:
+        raise ValueError(f"not a duration: {value!r}")
+    return sign * sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_timestamp(text):
+    """Epoch seconds of an RFC 3339 time from Ollama (nanosecond fractions included), or None."""
+    match = TIMESTAMP.match(text or '')
+    if not match:
+        return None
+    base, fraction, zone = match.groups()
+    stamp = datetime.fromisoformat(base + (zone if zone and zone != 'Z' else '+00:00')).timestamp()
+    return stamp + float(f"0.{fraction}") if fraction else stamp
+
+
+def memory_sample():
+    """RAM and swap in bytes: total, available, swap_total, swap_used."""
+    if psutil is not None:
+        ram, swap = psutil.virtual_memory(), psutil.swap_memory()
+        return {'total': ram.total, 'available': ram.available,
+                'swap_total': swap.total, 'swap_used': swap.used}
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            info[key] = int(rest.split()[0]) * 1024
+    return {'total': info['MemTotal'], 'available': info.get('MemAvailable', info.get('MemFree', 0)),
+            'swap_total': info.get('SwapTotal', 0),
+            'swap_used': info.get('SwapTotal', 0) - info.get('SwapFree', 0)}
+
+
+class ModelUsage:
+    def __init__(self, name):
+        self.name = name
+        self.requests = deque(maxlen=HISTORY)
+        self.resident = False
+        self.size = 0
+        self.size_vram = 0
+        self.expires_at = None
+        self.keep_alive = None
+
+    @property
+    def last_used(self):
+        return self.requests[-1] if self.requests else None
+
+    def typical_gap(self):
+        """The 90th percentile of the time between requests, or None with too little history."""
+        if len(self.requests) < MIN_SAMPLES:
+            return None
+        times = list(self.requests)
+        gaps = sorted(b - a for a, b in zip(times, times[1:]))
+        return gaps[min(len(gaps) - 1, int(len(gaps) * 0.9))]
+
+    def summary(self, now):
+        return {
+            'model': self.name,
+            'resident': self.resident,
+            'size': self.size,
+            'size_vram': self.size_vram,
+            'expires_in': round(self.expires_at - now) if self.resident and self.expires_at else None,
+            'keep_alive': self.keep_alive,
+            'requests': len(self.requests),
+            'idle_s': round(now - self.last_used) if self.last_used else None,
+        }
+
+
+class MemoryManager:
+    def __init__(self, base_url, keep_alive='5m', pressure_percent=85, adaptive=True,
+                 max_keep_alive=3600, interval=5.0):
+        self.base_url = base_url
+        try:
+            self.keep_alive = parse_duration(keep_alive)
+        except ValueError:
+            print(f"Ignoring unparsable keep-alive {keep_alive!r}; assuming 5m", file=sys.stderr)
+            self.keep_alive = 300.0
+        self.pressure_percent = pressure_percent
+        self.adaptive = adaptive
+        self.max_keep_alive = max_keep_alive
+        self.interval = interval
+        self.models = {}
+        self.sample = None
+        self.pressure = None
+        self.unloads = 0
+        # Called with (model, reason) after each unload
+        self.on_unload = []
+        self._session = None
+        self._preferred = None
+        self._busy = None
+        self._preloaded = None
+        self._task = None
+
+    # --- lifecycle ---
+
+    def start(self, session, preferred=None, busy=None):
+        """
+        Start sampling. ``preferred()`` names the model to keep loaded and
+        ``busy()`` says whether a generation is running right now.
+        """
+        self._session = session
+        self._preferred = preferred or (lambda: None)
+        self._busy = busy or (lambda: False)
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    # --- API ---
+
+    def record_use(self, model):
+        """Note a finished request for ``model`` (from the proxied traffic)."""
+        self._usage(model).requests.append(time.time())
+
+    def keep_alive_for(self, usage):
+        """Seconds to keep ``usage``'s model loaded after a request, or None for Ollama's default."""
+        if not self.adaptive or self.keep_alive < 0 or self.pressure:
+            return None
+        gap = usage.typical_gap()
+        if gap is None or gap <= self.keep_alive:
+            return None
+        # Requests come a little too far apart to find the model loaded; stretch to cover them.
+        # Much further apart and holding the memory isn't worth it.
+        wanted = gap * 1.25
+        return wanted if wanted <= self.max_keep_alive else None
+
+    async def preload(self):
+        """Load the preferred model if it isn't yet; True once it is (or there is none)."""
+        model = self._preferred()
+        if not model:
+            return True
+        model = normalize(model)
+        if self._preloaded == model:
+            return True
+        usage = self._usage(model)
+        if usage.resident:
+            self._preloaded = model
+            return True
+        if usage.size and self.sample:
+            # Known size from an earlier load: don't load it straight back into a shortage
+            headroom = self.sample['total'] * (100 - self.pressure_percent) / 100
+            if self.sample['available'] - usage.size < headroom:
+                return False
+        body = {'model': model}
+        keep_alive = self.keep_alive_for(usage)
+        if keep_alive is not None:
+            body['keep_alive'] = f"{int(keep_alive)}s"
+        # A generate request without a prompt only loads the model
+        async with self._session.post(f"{self.base_url}/api/generate", json=body) as resp:
+            await resp.read()
+            if resp.status == 404:
+                # Not pulled yet; try again on a later sample
+                return False
+            if resp.status != 200:
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status,
+                                                  message=f"preloading {model} failed")
+        self._preloaded = model
+        print(f"Preloaded model '{model}'", file=sys.stderr)
+        return True
+
+    def snapshot(self):
+        now = time.time()
+        memory = None
+        if self.sample:
+            memory = dict(self.sample, percent=round(self.ram_percent(), 1))
+        return {
+            'memory': memory,
+            'pressure': self.pressure,
+            'pressure_percent': self.pressure_percent,
+            'keep_alive': self.keep_alive,
+            'unloads': self.unloads,
+            'models': [usage.summary(now) for usage in self.models.values()],
+        }
+
+    def ram_percent(self):
+        return 100.0 * (1 - self.sample['available'] / self.sample['total']) if self.sample else 0.0
+
+    # --- internals ---
+
+    def _usage(self, model):
+        model = normalize(model)
+        usage = self.models.get(model)
+        if usage is None:
+            usage = self.models[model] = ModelUsage(model)
+        return usage
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._tick()
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+                # Ollama restarting or not up yet; the next sample tries again
+                print(f"Memory manager: {e}", file=sys.stderr)
+            await asyncio.sleep(self.interval)
+
+    async def _tick(self):
+        previous, self.sample = self.sample, memory_sample()
+        percent = self.ram_percent()
+        swapping = previous is not None and self.sample['swap_used'] - previous['swap_used'] > SWAP_GROWTH
+        if percent >= min(99, self.pressure_percent + CRITICAL_MARGIN):
+            self.pressure = 'critical'
+        elif percent >= self.pressure_percent or swapping:
+            self.pressure = 'high'
+        else:
+            self.pressure = None
+
+        await self._refresh()
+        if self.pressure:
+            await self._relieve()
+            return
+        await self.preload()
+        if not self._busy():
+            for usage in list(self.models.values()):
+                if usage.resident:
+                    await self._extend(usage)
+
+    async def _refresh(self):
+        """Update which models are loaded, and their size and expiry, from api/ps."""
+        async with self._session.get(f"{self.base_url}/api/ps") as resp:
+            resp.raise_for_status()
+            loaded = (await resp.json()).get('models') or []
+        for usage in self.models.values():
+            usage.resident = False
+        for entry in loaded:
+            usage = self._usage(entry.get('name') or entry.get('model') or '')
+            usage.resident = True
+            usage.size = entry.get('size') or usage.size
+            usage.size_vram = entry.get('size_vram') or 0
+            usage.expires_at = parse_timestamp(entry.get('expires_at'))
+
+    async def _relieve(self):
+        """Unload the least recently used idle model; the preferred one only when critical."""
+        preferred = self._preferred()
+        preferred = normalize(preferred) if preferred else None
+        candidates = [usage for usage in self.models.values() if usage.resident
+                      and (usage.name != preferred or self.pressure == 'critical')]
+        if not candidates:
+            return
+        victim = min(candidates, key=lambda u: (u.name == preferred, u.last_used or u.expires_at or 0))
+        async with self._session.post(f"{self.base_url}/api/generate",
+                                      json={'model': victim.name, 'keep_alive': 0}) as resp:
+            await resp.read()
+            resp.raise_for_status()
+        victim.resident = False
+        victim.keep_alive = None
+        if victim.name == self._preloaded:
+            # Preload it again once memory recovers
+            self._preloaded = None
+        self.unloads += 1
+        reason = 'critical' if self.pressure == 'critical' else 'pressure'
+        print(f"Memory at {self.ram_percent():.0f}%: unloaded model '{victim.name}'", file=sys.stderr)
+        for callback in self.on_unload:
+            callback(victim.name, reason)
+
+    async def _extend(self, usage):
+        """Push a resident model's expiry out to what its request pattern needs."""
+        keep_alive = self.keep_alive_for(usage)
+        if keep_alive is None or usage.last_used is None or usage.expires_at is None:
+            return
+        now = time.time()
+        wanted = usage.last_used + keep_alive
+        if wanted <= now or wanted - usage.expires_at < EXPIRY_SLACK:
+            return
+        async with self._session.post(f"{self.base_url}/api/generate",
+                                      json={'model': usage.name, 'keep_alive': f"{int(wanted - now)}s"}) as resp:
+            await resp.read()
+            resp.raise_for_status()
+        usage.keep_alive = round(keep_alive)
+        usage.expires_at = wanted
@@ -0,0 +1,226 @@
+"""
+On-device model benchmark for the add-on web server.
+
+Model advice based on RAM alone can't say how fast a model actually runs on a
+given CPU, iGPU or NPU. A benchmark run sends one short fixed prompt to every
+installed model, starting each one cold, and records load time, prefill and
+decode speed as Ollama reports them. Nothing runs unless asked for (the UI
+button, or an option to run once at startup).
+
+Results are cached in a JSON file under ``/data``, keyed by a hardware
+fingerprint (CPU, cores, RAM, accelerator device nodes), the device Ollama
+runs on and the Ollama version. A new Ollama version or different hardware
+starts a fresh entry. Switching ``device_type`` and benchmarking again adds
+that device's results next to the earlier ones. ``ranking()`` combines them
+into a "fastest models that fit" list.
+
+This file is kept identical in every add-on that uses it.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+
+import aiohttp
+
+BENCHMARK_PROMPT = ("Home Assistant: the living room temperature is 21 degrees and the lights are on. "
+                    "In one short sentence, tell the user what the living room is like.")
+BENCHMARK_TOKENS = 64
+# RAM left for everything else when judging whether a model fits
+RESERVE_BYTES = 1024 ** 3
+# Runtime and KV cache on top of the weights
+SIZE_FACTOR = 1.2
+
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def _ram_total():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def hardware_fingerprint():
+    """What the results depend on besides the device and Ollama version, plus its short hash."""
+    hardware = {
+        "cpu": _cpu_model(),
+        "cores": os.cpu_count(),
+        "ram_gb": round(_ram_total() / 1024 ** 3),
+        "gpu": sorted(os.listdir("/dev/dri")) if os.path.isdir("/dev/dri") else [],
+        "npu": os.path.exists("/dev/accel"),
+    }
+    digest = hashlib.sha1(json.dumps(hardware, sort_keys=True).encode()).hexdigest()[:12]
+    return digest, hardware
+
+
+def fits(size, ram_total=None):
+    ram_total = ram_total if ram_total is not None else _ram_total()
+    return bool(size) and size * SIZE_FACTOR + RESERVE_BYTES <= ram_total
+
+
+def load_results(path):
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable benchmark results {path}: {e}", file=sys.stderr)
+        return {}
+
+
+def ranking(results, fingerprint, ollama_version=None, ram_total=None):
+    """Fastest first: every device's results for this hardware (and Ollama version, if given) that fit in RAM."""
+    rows = []
+    for entry in results.values():
+        if entry.get("fingerprint") != fingerprint:
+            continue
+        if ollama_version and entry.get("ollama_version") != ollama_version:
+            continue
+        for model, result in entry.get("models", {}).items():
+            if result.get("error") or not fits(result.get("size"), ram_total):
+                continue
+            rows.append(dict(result, model=model, device=entry["device"],
+                             ollama_version=entry.get("ollama_version")))
+    return sorted(rows, key=lambda r: r.get("decode_tps") or 0, reverse=True)
+
+
+class ModelBenchmark:
+    def __init__(self, base_url, results_file=None, device="CPU"):
+        self.base_url = base_url
+        self.results_file = results_file
+        self.device = device
+        self.fingerprint, self.hardware = hardware_fingerprint()
+        self.results = load_results(results_file)
+        self.ollama_version = None
+        self.state = "idle"  # idle, running, done, failed
+        self.current = None
+        self.progress = (0, 0)
+        self.error = None
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, session, gate=None):
+        """Benchmark every installed model in the background; ``gate()`` is held around each one."""
+        if not self.running:
+            self.task = asyncio.ensure_future(self.run(session, gate))
+        return self.task
+
+    def cached(self, ollama_version):
+        return f"{self.fingerprint}|{self.device}|{ollama_version}" in self.results
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "current": self.current,
+            "progress": list(self.progress),
+            "error": self.error,
+            "device": self.device,
+            "ollama_version": self.ollama_version,
+            "fingerprint": self.fingerprint,
+            "hardware": self.hardware,
+            "ranking": ranking(self.results, self.fingerprint, self.ollama_version),
+        }
+
+    async def run(self, session, gate=None):
+        self.state, self.error = "running", None
+        try:
+            async with session.get(f"{self.base_url}/api/version") as resp:
+                resp.raise_for_status()
+                self.ollama_version = (await resp.json()).get("version")
+            async with session.get(f"{self.base_url}/api/tags") as resp:
+                resp.raise_for_status()
+                models = (await resp.json()).get("models", [])
+            async with session.get(f"{self.base_url}/api/ps") as resp:
+                resp.raise_for_status()
+                resident = [m.get("name") for m in (await resp.json()).get("models", [])]
+
+            key = f"{self.fingerprint}|{self.device}|{self.ollama_version}"
+            entry = self.results[key] = {
+                "fingerprint": self.fingerprint, "hardware": self.hardware, "device": self.device,
+                "ollama_version": self.ollama_version, "models": {},
+            }
+            for index, model in enumerate(models):
+                name = model.get("name") or model.get("model")
+                self.current, self.progress = name, (index, len(models))
+                if gate is not None:
+                    async with gate():
+                        result = await self._measure(session, name)
+                else:
+                    result = await self._measure(session, name)
+                result["size"] = model.get("size")
+                entry["models"][name] = result
+                self._save()
+            self.progress = (len(models), len(models))
+            self.state = "done"
+            # Put back what was loaded before; every model was unloaded to measure a cold start
+            for name in resident:
+                async with session.post(f"{self.base_url}/api/generate", json={"model": name}) as resp:
+                    await resp.read()
+        except asyncio.CancelledError:
+            self.state = "idle"
+            raise
+        except Exception as e:
+            self.state, self.error = "failed", str(e) or type(e).__name__
+            print(f"Benchmark failed: {self.error}", file=sys.stderr)
+        finally:
+            self.current = None
+
+    async def _measure(self, session, model):
+        """One cold run of the fixed prompt: load time and prefill/decode tokens per second."""
+        try:
+            async with session.post(f"{self.base_url}/api/generate",
+                                    json={"model": model, "keep_alive": 0}) as resp:
+                await resp.read()
+            body = {
+                "model": model, "prompt": BENCHMARK_PROMPT, "stream": False, "keep_alive": 0,
+                "options": {"num_predict": BENCHMARK_TOKENS, "temperature": 0, "seed": 0},
+            }
+            async with session.post(f"{self.base_url}/api/generate", json=body) as resp:
+                data = await resp.json(content_type=None)
+                if resp.status != 200:
+                    # Embedding-only models can't generate
+                    return {"error": data.get("error") or f"HTTP {resp.status}", "at": time.time()}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            return {"error": str(e) or type(e).__name__, "at": time.time()}
+
+        def rate(count, duration):
+            return round(count / (duration / 1e9), 2) if count and duration else None
+
+        return {
+            "load_s": round((data.get("load_duration") or 0) / 1e9, 3),
+            "prefill_tps": rate(data.get("prompt_eval_count"), data.get("prompt_eval_duration")),
+            "decode_tps": rate(data.get("eval_count"), data.get("eval_duration")),
+            "at": time.time(),
+        }
+
+    def _save(self):
+        if not self.results_file:
+            return
+        try:
+            tmp = f"{self.results_file}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.results, f, indent=1)
+            os.replace(tmp, self.results_file)
+        except OSError as e:
+            print(f"Could not save benchmark results: {e}", file=sys.stderr)
@@ -0,0 +1,334 @@
+"""
+Background model downloads for the add-on web server.
+
+Pulls go through Ollama's streaming ``/api/pull``, at most ``concurrency`` at
+a time with the rest queued. Progress is tracked per layer (bytes, rate, ETA)
+and pushed to subscribers such as the UI's event stream. Unfinished pulls are
+recorded in a state file and started again after a restart; Ollama keeps
+partially downloaded layers, so they continue where they stopped.
+
+Selecting a model pulls it if needed and then loads it, so switching models
+needs no add-on restart.
+
+This file is kept identical in every add-on that uses it.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+PULL_RETRIES = 3
+# Minimum seconds between progress events for one pull
+PUBLISH_INTERVAL = 0.5
+# Events a slow subscriber may fall behind before older ones are dropped
+SUBSCRIBER_BACKLOG = 64
+
+
+def normalize(model):
+    """``llama3`` and ``llama3:latest`` are the same model."""
+    name = model.strip()
+    return name if ":" in name.rsplit("/", 1)[-1] else f"{name}:latest"
+
+
+def installed(model, models):
+    """Whether ``model`` is among api/tags ``models`` (an exact tag match, not a substring)."""
+    wanted = normalize(model)
+    return any(normalize(m.get("name") or m.get("model") or "") == wanted for m in models)
+
+
+class Layer:
+    def __init__(self, digest):
+        self.digest = digest
+        self.total = 0
+        self.completed = 0
+        self.rate = 0.0
+        self._mark = (time.monotonic(), 0)
+
+    def update(self, total, completed):
+        self.total = total or self.total
+        now = time.monotonic()
+        at, done = self._mark
+        if completed < done:
+            # Ollama restarted this layer; start measuring again
+            self._mark = (now, completed)
+        elif now - at >= 1.0:
+            sample = (completed - done) / (now - at)
+            self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+            self._mark = (now, completed)
+        self.completed = completed
+
+    @property
+    def eta(self):
+        if not self.rate or not self.total:
+            return None
+        return max(0.0, (self.total - self.completed) / self.rate)
+
+    def summary(self):
+        return {"digest": self.digest, "total": self.total, "completed": self.completed,
+                "rate": round(self.rate), "eta": round(self.eta, 1) if self.eta is not None else None}
+
+
+class PullJob:
+    def __init__(self, model):
+        self.model = model
+        self.state = "queued"  # queued, pulling, done, failed, cancelled
+        self.status = ""
+        self.error = None
+        self.layers = OrderedDict()
+        self.queued_at = time.time()
+        self.finished_at = None
+        self.attempts = 0
+        self.task = None
+        self.done = asyncio.Event()
+        self._published = 0.0
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def summary(self):
+        layers = list(self.layers.values())
+        total = sum(layer.total for layer in layers)
+        completed = sum(layer.completed for layer in layers)
+        rate = sum(layer.rate for layer in layers if layer.completed < layer.total)
+        return {
+            "model": self.model,
+            "state": self.state,
+            "status": self.status,
+            "error": self.error,
+            "total": total,
+            "completed": completed,
+            "rate": round(rate),
+            "eta": round((total - completed) / rate, 1) if rate else None,
+            "attempts": self.attempts,
+            "layers": [layer.summary() for layer in layers],
+        }
+
+
+class PullManager:
+    def __init__(self, base_url, state_file=None, concurrency=2):
+        self.base_url = base_url
+        self.state_file = state_file
+        self.concurrency = max(1, concurrency)
+        self.jobs = OrderedDict()
+        self.active = None
+        # Called with the model name after each successful pull
+        self.on_complete = []
+        self._session = None
+        self._slots = None
+        self._subscribers = set()
+
+    # --- lifecycle ---
+
+    def start(self, session):
+        """Use ``session`` for Ollama requests and resume pulls left over from the last run."""
+        self._session = session
+        self._slots = asyncio.Semaphore(self.concurrency)
+        state = self._load()
+        self.active = state.get("active")
+        for model in state.get("pending", []):
+            print(f"Resuming pull of '{model}'", file=sys.stderr)
+            self.pull(model)
+
+    async def close(self):
+        tasks = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        # The state file keeps them pending, so they resume on the next start
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # --- API ---
+
+    def pull(self, model):
+        """Queue a pull of ``model`` (or return the one already running)."""
+        model = normalize(model)
+        job = self.jobs.get(model)
+        if job is not None and not job.finished:
+            return job
+        job = self.jobs[model] = PullJob(model)
+        self.jobs.move_to_end(model)
+        job.task = asyncio.ensure_future(self._run(job))
+        self._save()
+        self._publish(job, force=True)
+        return job
+
+    def cancel(self, model):
+        job = self.jobs.get(normalize(model))
+        if job is None or job.finished:
+            return False
+        job.task.cancel()
+        job.state = "cancelled"
+        job.finished_at = time.time()
+        job.done.set()
+        self._save()
+        self._publish(job, force=True)
+        return True
+
+    async def is_installed(self, model):
+        async with self._session.get(f"{self.base_url}/api/tags") as resp:
+            resp.raise_for_status()
+            return installed(model, (await resp.json()).get("models", []))
+
+    async def ensure(self, model):
+        """Pull ``model`` unless Ollama already has it; returns the finished job or None."""
+        if await self.is_installed(model):
+            return None
+        job = self.pull(model)
+        await job.done.wait()
+        return job
+
+    async def select(self, model):
+        """Make ``model`` the active one: pull it if missing, then load it into memory."""
+        model = normalize(model)
+        self._broadcast({"type": "select", "model": model, "state": "started"})
+        try:
+            job = await self.ensure(model)
+            if job is not None and job.state != "done":
+                raise RuntimeError(job.error or job.state)
+            # A generate request without a prompt only loads the model
+            async with self._session.post(f"{self.base_url}/api/generate", json={"model": model}) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    raise RuntimeError(f"loading failed with HTTP {resp.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+            print(f"Switching to '{model}' failed: {e}", file=sys.stderr)
+            self._broadcast({"type": "select", "model": model, "state": "failed", "error": str(e)})
+            return False
+        self.active = model
+        self._save()
+        self._broadcast({"type": "select", "model": model, "state": "done"})
+        return True
+
+    def snapshot(self):
+        return {"active": self.active, "pulls": [job.summary() for job in self.jobs.values()]}
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_BACKLOG)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    # --- internals ---
+
+    async def _run(self, job):
+        try:
+            async with self._slots:
+                job.state = "pulling"
+                self._publish(job, force=True)
+                while True:
+                    job.attempts += 1
+                    try:
+                        await self._stream(job)
+                        job.state = "done"
+                        break
+                    except aiohttp.ClientConnectorError:
+                        # Ollama isn't up (yet); resumed pulls start before it is. Doesn't count as an attempt.
+                        job.attempts -= 1
+                        job.status = "waiting for Ollama"
+                        self._publish(job, force=True)
+                        await asyncio.sleep(5)
+                    except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                        if job.attempts >= PULL_RETRIES:
+                            job.state, job.error = "failed", str(e) or type(e).__name__
+                            break
+                        job.status = f"retrying after error: {e}"
+                        self._publish(job, force=True)
+                        # Ollama keeps the partial layers, so the retry continues the download
+                        await asyncio.sleep(2 ** job.attempts)
+                    except RuntimeError as e:
+                        # Reported by Ollama itself (unknown model, disk full); retrying won't help
+                        job.state, job.error = "failed", str(e)
+                        break
+        except asyncio.CancelledError:
+            if job.state != "cancelled":
+                # Shutting down: leave it pending in the state file
+                return
+            raise
+        except Exception as e:
+            # Whatever went wrong, the pull is over and its waiters must hear about it
+            job.state, job.error = "failed", f"{type(e).__name__}: {e}"
+        finally:
+            # ensure_model and select wait on this
+            job.done.set()
+        job.finished_at = time.time()
+        self._save()
+        self._publish(job, force=True)
+        if job.state == "done":
+            for callback in self.on_complete:
+                callback(job.model)
+        else:
+            print(f"Pull of '{job.model}' failed: {job.error}", file=sys.stderr)
+
+    async def _stream(self, job):
+        async with self._session.post(f"{self.base_url}/api/pull",
+                                      json={"model": job.model, "stream": True}) as resp:
+            if resp.status != 200:
+                text = (await resp.text())[:200]
+                if resp.status >= 500:
+                    raise aiohttp.ClientResponseError(resp.request_info, resp.history,
+                                                      status=resp.status, message=text)
+                raise RuntimeError(f"HTTP {resp.status}: {text}")
+            async for line in resp.content:
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A partial or garbled line; the next progress line supersedes it
+                    continue
+                if not isinstance(event, dict):
+                    continue
+                if "error" in event:
+                    raise RuntimeError(event["error"])
+                job.status = event.get("status", job.status)
+                digest = event.get("digest")
+                if digest and "total" in event:
+                    layer = job.layers.get(digest)
+                    if layer is None:
+                        layer = job.layers[digest] = Layer(digest)
+                    layer.update(event.get("total", 0), event.get("completed", 0))
+                self._publish(job)
+            if job.status != "success":
+                raise ConnectionError("pull stream ended before success")
+
+    def _publish(self, job, force=False):
+        now = time.monotonic()
+        if not force and now - job._published < PUBLISH_INTERVAL:
+            return
+        job._published = now
+        self._broadcast({"type": "pull", **job.summary()})
+
+    def _broadcast(self, event):
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def _load(self):
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable pull state {self.state_file}: {e}", file=sys.stderr)
+            return {}
+
+    def _save(self):
+        if not self.state_file:
+            return
+        state = {"active": self.active,
+                 "pending": [job.model for job in self.jobs.values() if not job.finished]}
+        try:
+            tmp = f"{self.state_file}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            print(f"Could not save pull state: {e}", file=sys.stderr)
@@ -7,33 +7,15 @@ echo "===================================================="
 echo "          Starting HA AI Addons: Ollama             "
 echo "===================================================="
 
-# Check Hardware and give recommendations
-echo "Analyzing system resources..."
-python3 /check_hardware.py
-
-# Retrieve configuration
-if [ -f /data/options.json ]; then
-    MODEL=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('model', '') or '')")
-    CUSTOM_MODEL=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('custom_model', '') or '')")
-    DEVICE_TYPE=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('device_type', 'NPU') or 'NPU')")
-    KEEP_ALIVE=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('keep_alive', '5m') or '5m')")
-    NUM_PARALLEL=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('num_parallel', 1))")
-    MAX_LOADED_MODELS=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('max_loaded_models', 1))")
-    NUM_CTX=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('num_ctx', 2048))")
-    DEBUG=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('debug', False))")
-    UPDATE_OLLAMA=$(python3 -c "import sys, json; print(json.load(open('/data/options.json')).get('update_ollama', False))")
-else
-    MODEL=${MODEL:-"gemma2:2b"}
-    CUSTOM_MODEL=${CUSTOM_MODEL:-""}
-    DEVICE_TYPE=${DEVICE_TYPE:-"NPU"}
-    KEEP_ALIVE=${KEEP_ALIVE:-"5m"}
-    NUM_PARALLEL=${NUM_PARALLEL:-1}
-    MAX_LOADED_MODELS=${MAX_LOADED_MODELS:-1}
-    NUM_CTX=${NUM_CTX:-2048}
-    DEBUG=${DEBUG:-"False"}
-    UPDATE_OLLAMA="False"
+# The Web UI and startup orchestrator need aiohttp
+if ! python3 -c "import aiohttp" 2>/dev/null; then
+    echo "Warning: python3-aiohttp not found. Attempting to install..."
+    apt-get update && apt-get install -y python3-aiohttp || echo "Failed to install aiohttp"
 fi
 
+# Retrieve configuration (all options in one pass; also resolves custom_model and the NPU fallback)
+eval "$(python3 /startup.py env)"
+
 # Normalize DEBUG to 1/0 for Ollama
 if [ "$DEBUG" = "True" ]; then
     export OLLAMA_DEBUG="1"
@@ -41,12 +23,6 @@ else
     export OLLAMA_DEBUG="0"
 fi
 
-# Smart fallback: If NPU is selected/defaulted but no hardware found, switch to CPU
-if [ "$DEVICE_TYPE" = "NPU" ] && [ ! -e "/dev/accel" ]; then
-    echo "Warning: NPU selected but /dev/accel not found. Falling back to CPU."
-    DEVICE_TYPE="CPU"
-fi
-
 # Set DEVICE for IPEX init
 DEVICE="$DEVICE_TYPE"
 # Map generic GPU to iGPU for IPEX init if needed
@@ -54,13 +30,6 @@ if [ "$DEVICE" = "GPU" ]; then
     DEVICE="iGPU"
 fi
 
-if [ ! -z "$CUSTOM_MODEL" ]; then
-    echo "Using Custom Model: $CUSTOM_MODEL"
-    MODEL=$CUSTOM_MODEL
-else
-    echo "Using Selected Model: $MODEL"
-fi
-
 # IPEX and Ollama Initialization
 if [ "$DEBUG" = "True" ]; then
     echo "--- IPEX Initialization ---"
@@ -125,6 +94,30 @@ if [ "$DEBUG" = "True" ]; then
     echo "---------------------------"
 fi
 
+# Size context, parallel slots and loaded models from the hardware and the model's GGUF header.
+# Only options left empty are tuned; a value set in the configuration is always kept.
+# The report is saved so the hardware log at startup doesn't scan the models again.
+rm -f /tmp/hardware.json
+if [ "$AUTO_TUNE" = "True" ] && { [ -z "$NUM_CTX" ] || [ -z "$NUM_PARALLEL" ] || [ -z "$MAX_LOADED_MODELS" ]; }; then
+    if TUNING=$(python3 /check_hardware.py --json --model "$MODEL" --models-dir /share/ollama/models \
+            ${NUM_CTX:+--num-ctx "$NUM_CTX"} ${NUM_PARALLEL:+--num-parallel "$NUM_PARALLEL"}); then
+        echo "$TUNING" > /tmp/hardware.json
+        TUNED_CTX=$(echo "$TUNING" | jq -r '.tuning.num_ctx // empty')
+        TUNED_PARALLEL=$(echo "$TUNING" | jq -r '.tuning.num_parallel // empty')
+        TUNED_LOADED=$(echo "$TUNING" | jq -r '.tuning.max_loaded_models // empty')
+        NUM_CTX="${NUM_CTX:-$TUNED_CTX}"
+        NUM_PARALLEL="${NUM_PARALLEL:-$TUNED_PARALLEL}"
+        MAX_LOADED_MODELS="${MAX_LOADED_MODELS:-$TUNED_LOADED}"
+        echo "$TUNING" | jq -r '.tuning.notes[]' | sed 's/^/Auto-tune: /'
+    else
+        echo "Warning: Hardware detection failed; using the default values."
+    fi
+fi
+# Whatever is still empty gets the usual defaults
+NUM_CTX="${NUM_CTX:-2048}"
+NUM_PARALLEL="${NUM_PARALLEL:-1}"
+MAX_LOADED_MODELS="${MAX_LOADED_MODELS:-1}"
+
 # Configure Ollama environment
 export OLLAMA_HOST="0.0.0.0"
 export OLLAMA_MODELS="/share/ollama/models"
@@ -135,7 +128,7 @@ export OLLAMA_MAX_LOADED_MODELS="$MAX_LOADED_MODELS"
 export OLLAMA_NUM_CTX="$NUM_CTX"
 # OLLAMA_DEBUG is already exported above
 
-echo "Ollama Configuration:"
+echo "Ollama Configuration (auto-tune: $AUTO_TUNE):"
 echo "  Keep-Alive: $OLLAMA_KEEP_ALIVE"
 echo "  Num Parallel: $OLLAMA_NUM_PARALLEL"
 echo "  Max Loaded Models: $OLLAMA_MAX_LOADED_MODELS"
@@ -162,71 +155,5 @@ fi
 
 mkdir -p "$OLLAMA_MODELS"
 
-# Start Ollama in background
-echo "Starting Ollama Server..."
-# Use the local ollama binary created by init-ollama
-if [ "$DEBUG" = "True" ]; then
-    ./ollama serve &
-else
-    # Filter out GIN access logs in non-debug mode
-    ./ollama serve 2>&1 | grep -v "\[GIN\]" &
-fi
-PID=$!
-
-# Wait for Ollama to start
-echo "Waiting for Ollama API to be ready..."
-MAX_RETRIES=30
-RETRY_COUNT=0
-until curl -s http://localhost:11434/api/tags > /dev/null || [ $RETRY_COUNT -eq $MAX_RETRIES ]; do
-    sleep 2
-    RETRY_COUNT=$((RETRY_COUNT + 1))
-done
-
-if [ $RETRY_COUNT -eq $MAX_RETRIES ]; then
-    echo "Error: Ollama server failed to start within 60 seconds."
-    exit 1
-fi
-
-echo "Ollama API is active!"
-
-# Pull the requested model if not present
-MODEL_READY=false
-if ./ollama list | grep -q "$MODEL"; then
-    echo "Model '$MODEL' is cached and ready."
-    MODEL_READY=true
-else
-    echo "Model '$MODEL' not found. Downloading (this may take several minutes)..."
-    ./ollama pull "$MODEL"
-    
-    # Check if model exists in list to confirm success
-    if ./ollama list | grep -q "$MODEL"; then
-        echo "Model '$MODEL' downloaded successfully."
-        MODEL_READY=true
-    else
-        echo "Error: Failed to download model '$MODEL'."
-        MODEL_READY=false
-    fi
-fi
-
-echo "----------------------------------------------------"
-if [ "$MODEL_READY" = "true" ]; then
-    echo " Ollama is running and model '$MODEL' is loaded.    "
-else
-    echo " Ollama is running but model '$MODEL' FAILED to load."
-    echo " Please check the logs for download errors."
-fi
-echo " Internal URL: http://ollama:11434                  "
-echo "----------------------------------------------------"
-
-# Start Web UI
-echo "Starting Web UI..."
-if ! python3 -c "import requests" 2>/dev/null; then
-    echo "Warning: python3-requests not found. Attempting to install..."
-    apt-get update && apt-get install -y python3-requests || echo "Failed to install requests"
-fi
-
-python3 -u /web_server.py 2>&1 &
-WEB_PID=$!
-
-# Wait for process
-wait $PID $WEB_PID
+# Start Ollama, the hardware report and the Web UI together, then pull the model in the background
+exec python3 -u /startup.py run
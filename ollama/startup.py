@@ -0,0 +1,301 @@
+"""
+Boot sequence for the Ollama add-on.
+
+run.sh calls this twice:
+
+- ``startup.py env`` reads /data/options.json once and prints the options as
+  shell ``export`` lines for run.sh to ``eval``.
+- ``exec startup.py run`` takes over once the IPEX environment is set up. It
+  starts ``ollama serve``, the hardware report and the web UI together, waits
+  for the Ollama API with exponential backoff, and then pulls the configured
+  model in the background through the web server's pull manager. The UI is
+  usable within seconds even while a first pull takes minutes; ``/startup``
+  reports how far along it is.
+"""
+import asyncio
+import json
+import os
+import shlex
+import signal
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+OPTIONS_FILE = "/data/options.json"
+HARDWARE_CHECK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_hardware.py")
+# Written by run.sh when auto_tune already ran the check
+HARDWARE_REPORT = "/tmp/hardware.json"
+OLLAMA_BIN = os.environ.get("OLLAMA_BIN", "./ollama")
+OLLAMA_API = "http://127.0.0.1:11434"
+READY_TIMEOUT = 60.0
+
+# option -> (exported variable, default)
+OPTIONS = {
+    "model": ("MODEL", "gemma2:2b"),
+    "custom_model": ("CUSTOM_MODEL", ""),
+    "device_type": ("DEVICE_TYPE", "NPU"),
+    "keep_alive": ("KEEP_ALIVE", "5m"),
+    # Left empty, these are sized by auto_tune; run.sh falls back to 1, 1 and 2048
+    "num_parallel": ("NUM_PARALLEL", ""),
+    "max_loaded_models": ("MAX_LOADED_MODELS", ""),
+    "num_ctx": ("NUM_CTX", ""),
+    "auto_tune": ("AUTO_TUNE", True),
+    "debug": ("DEBUG", False),
+    "update_ollama": ("UPDATE_OLLAMA", False),
+    "proxy_cache_ttl": ("PROXY_CACHE_TTL", 3),
+    "max_queue": ("PROXY_MAX_QUEUE", 16),
+    "queue_timeout": ("PROXY_QUEUE_TIMEOUT", 120),
+    "memory_pressure": ("MEMORY_PRESSURE_PERCENT", 85),
+    "adaptive_keep_alive": ("ADAPTIVE_KEEP_ALIVE", True),
+    "benchmark_on_start": ("BENCHMARK_ON_START", False),
+    "backends": ("OLLAMA_BACKENDS", ""),
+}
+
+
+def log(message):
+    print(message, flush=True)
+
+
+# --- env: options -> shell ---
+
+def load_options(path=OPTIONS_FILE):
+    """Options from the Supervisor, or from the environment when run outside it."""
+    if os.path.isfile(path):
+        with open(path) as f:
+            raw = json.load(f)
+    else:
+        raw = {key: os.environ[var] for key, (var, _) in OPTIONS.items() if os.environ.get(var)}
+    options = {}
+    for key, (_, default) in OPTIONS.items():
+        value = raw.get(key)
+        options[key] = default if value in (None, "") else value
+
+    if options["custom_model"]:
+        print(f"Using Custom Model: {options['custom_model']}", file=sys.stderr)
+        options["model"] = options["custom_model"]
+    else:
+        print(f"Using Selected Model: {options['model']}", file=sys.stderr)
+    # Smart fallback: If NPU is selected/defaulted but no hardware found, switch to CPU
+    if options["device_type"] == "NPU" and not os.path.exists("/dev/accel"):
+        print("Warning: NPU selected but /dev/accel not found. Falling back to CPU.", file=sys.stderr)
+        options["device_type"] = "CPU"
+    return options
+
+
+def shell_exports(options):
+    # Booleans keep Python's spelling; run.sh compares against "True"
+    return "\n".join(f"export {var}={shlex.quote(str(options[key]))}" for key, (var, _) in OPTIONS.items())
+
+
+# --- run: processes and readiness ---
+
+async def relay_output(stream, skip=b"[GIN]"):
+    """Copy ``ollama serve`` output to ours, minus per-request access log lines."""
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        if skip not in line:
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+
+
+async def hardware_report():
+    """Run check_hardware.py alongside Ollama's startup and print its report in one piece."""
+    args = ["--saved", HARDWARE_REPORT] if os.path.isfile(HARDWARE_REPORT) else []
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, HARDWARE_CHECK, *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        output, _ = await proc.communicate()
+        sys.stdout.write(output.decode(errors="replace"))
+        sys.stdout.flush()
+    except OSError as e:
+        log(f"Hardware check failed: {e}")
+
+
+async def wait_for_ollama(session, serve, timeout=READY_TIMEOUT):
+    """Probe api/version with exponential backoff; False on timeout or if serve exits."""
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while time.monotonic() < deadline:
+        if serve.returncode is not None:
+            return False
+        try:
+            async with session.get(f"{OLLAMA_API}/api/version",
+                                   timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                if resp.status == 200:
+                    return True
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 2, 2.0)
+    return False
+
+
+async def log_progress(job):
+    """Log a pull's overall progress every 10%."""
+    last_logged = -10
+    while True:
+        await asyncio.sleep(1)
+        summary = job.summary()
+        if summary["total"]:
+            percent = int(summary["completed"] * 100 / summary["total"])
+            if percent >= last_logged + 10:
+                last_logged = percent - percent % 10
+                eta = f", about {summary['eta']:.0f}s left" if summary["eta"] is not None else ""
+                log(f"Pulling '{job.model}': {percent}%{eta}")
+
+
+async def ensure_model(pulls, status):
+    """Pull the configured model through the web server's pull manager if it is missing."""
+    model = status["model"]
+    try:
+        if await pulls.is_installed(model):
+            log(f"Model '{model}' is cached and ready.")
+            return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status["error"] = str(e)
+        log(f"Error: Could not list models: {e}")
+        return False
+
+    log(f"Model '{model}' not found. Downloading in the background (the Web UI is already available)...")
+    status["phase"] = "pulling"
+    job = pulls.pull(model)
+    progress = asyncio.ensure_future(log_progress(job))
+    try:
+        await job.done.wait()
+    finally:
+        progress.cancel()
+    if job.state != "done":
+        status["error"] = job.error or job.state
+        log(f"Error: Failed to download model '{model}': {status['error']}")
+        return False
+    log(f"Model '{model}' downloaded successfully.")
+    return True
+
+
+async def benchmark_once(app, session):
+    """Benchmark the installed models unless this hardware, device and Ollama version already have results."""
+    import web_server
+
+    benchmark = app["benchmark"]
+    try:
+        async with session.get(f"{OLLAMA_API}/api/version") as resp:
+            version = (await resp.json()).get("version")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        log(f"Warning: Skipping benchmark: {e}")
+        return
+    if benchmark.cached(version):
+        log("Benchmark results for this hardware and Ollama version are cached; see the Web UI.")
+        return
+    log("Benchmarking installed models (this takes a minute per model)...")
+    await web_server.start_benchmark(app)
+    for row in benchmark.snapshot()["ranking"][:5]:
+        log(f"  {row['model']} on {row['device']}: {row['decode_tps']} tokens/s, loads in {row['load_s']}s")
+
+
+async def run():
+    # web_server reads its settings from the environment run.sh has exported by now
+    import web_server
+    from pull_manager import normalize
+
+    debug = os.environ.get("DEBUG") == "True"
+    status = {"phase": "starting", "model": os.environ.get("MODEL", ""), "error": None,
+              "started": time.time()}
+
+    log("Starting Ollama Server...")
+    if debug:
+        serve = await asyncio.create_subprocess_exec(OLLAMA_BIN, "serve")
+        relay = None
+    else:
+        serve = await asyncio.create_subprocess_exec(
+            OLLAMA_BIN, "serve", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        relay = asyncio.ensure_future(relay_output(serve.stdout))
+    hardware = asyncio.ensure_future(hardware_report())
+
+    # The UI and proxy come up right away; requests fail with 502 until Ollama answers
+    async def handle_startup(request):
+        job = app["pulls"].jobs.get(normalize(status["model"])) if status["model"] else None
+        return web.json_response(dict(status, pull=job.summary() if job else None),
+                                 headers=web_server.NO_CACHE_HEADERS)
+
+    app = web_server.create_app()
+    app.router.add_get("/startup", handle_startup)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=web_server.PORT, reuse_address=True).start()
+    log(f"Web UI listening on port {web_server.PORT}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    exit_code = 0
+    model_task = None
+    async with aiohttp.ClientSession() as session:
+        log("Waiting for Ollama API to be ready...")
+        status["phase"] = "waiting for ollama"
+        if not await wait_for_ollama(session, serve):
+            log(f"Error: Ollama server failed to start within {READY_TIMEOUT:.0f} seconds.")
+            status["phase"] = "failed"
+            stop.set()
+            exit_code = 1
+        else:
+            log("Ollama API is active!")
+
+            async def prepare_model():
+                ready = await ensure_model(app["pulls"], status)
+                if ready:
+                    # Load it now rather than on the first request; the memory manager retries if this fails
+                    try:
+                        await web_server.MEMORY.preload()
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        log(f"Warning: Could not preload model '{status['model']}': {e}")
+                status["phase"] = "ready" if ready else "failed"
+                log("----------------------------------------------------")
+                if ready:
+                    log(f" Ollama is running and model '{status['model']}' is loaded.")
+                else:
+                    log(f" Ollama is running but model '{status['model']}' FAILED to load.")
+                    log(" Please check the logs for download errors.")
+                log(" Internal URL: http://ollama:11434")
+                log("----------------------------------------------------")
+                if ready and os.environ.get("BENCHMARK_ON_START") == "True":
+                    await benchmark_once(app, session)
+
+            model_task = asyncio.ensure_future(prepare_model())
+
+        serve_exit = asyncio.ensure_future(serve.wait())
+        stopped = asyncio.ensure_future(stop.wait())
+        await asyncio.wait((serve_exit, stopped), return_when=asyncio.FIRST_COMPLETED)
+        if serve_exit.done():
+            log(f"Ollama server exited with code {serve.returncode}")
+            exit_code = serve.returncode or 1
+        for task in (stopped, hardware, model_task):
+            if task is not None:
+                task.cancel()
+
+    if serve.returncode is None:
+        serve.terminate()
+        try:
+            await asyncio.wait_for(serve.wait(), 10)
+        except asyncio.TimeoutError:
+            serve.kill()
+    if relay is not None:
+        relay.cancel()
+    await runner.cleanup()
+    return exit_code
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "env":
+        print(shell_exports(load_options()))
+    elif command == "run":
+        sys.exit(asyncio.run(run()))
+    else:
+        sys.exit(f"usage: {sys.argv[0]} env|run")
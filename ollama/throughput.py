@@ -0,0 +1,129 @@
+"""
+Per-model generation speed, taken from the responses passing through the proxy.
+
+Ollama ends every /api/generate and /api/chat response with a frame holding
+``eval_count``, ``eval_duration``, ``prompt_eval_count``,
+``prompt_eval_duration`` and ``load_duration``. ``FrameTap`` picks that frame
+out of the relayed bytes as they stream past: only the current partial line
+is held, and only lines containing ``"done": true`` are parsed at all.
+"""
+import json
+import os
+import re
+import time
+from collections import deque
+
+STATS_PATHS = ('/api/generate', '/api/chat')
+# Longest partial line kept while waiting for its newline (a stream:false body is one line)
+MAX_LINE = 1024 * 1024
+DONE_MARKER = re.compile(rb'"done"\s*:\s*true')
+
+# Set by run.sh (the Intel GPU add-on only exports OLLAMA_INTEL_GPU)
+DEVICE = os.environ.get("DEVICE") or ("GPU" if os.environ.get("OLLAMA_INTEL_GPU") else "CPU")
+
+
+class FrameTap:
+    def __init__(self, started=None):
+        # When the request reached the proxy, so TTFT includes queueing and model load
+        self.started = started if started is not None else time.monotonic()
+        self.first_byte = None
+        self.final = None
+        self._tail = b""
+        self._overflow = False
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+        if self.final is not None:
+            return
+        lines = (self._tail + chunk).split(b"\n")
+        self._tail = lines.pop()
+        for line in lines:
+            if self._overflow:
+                # Rest of a line we gave up on; its stats (if any) are lost
+                self._overflow = False
+                continue
+            self._check(line)
+        if len(self._tail) > MAX_LINE:
+            self._tail = b""
+            self._overflow = True
+
+    def close(self):
+        """Handle a final frame that was not newline-terminated (e.g. stream:false)."""
+        if self._tail and not self._overflow and self.final is None:
+            self._check(self._tail)
+        self._tail = b""
+
+    def _check(self, line):
+        if not DONE_MARKER.search(line):
+            return
+        try:
+            frame = json.loads(line)
+        except ValueError:
+            return
+        if isinstance(frame, dict) and frame.get("done"):
+            self.final = frame
+
+    @property
+    def ttft(self):
+        return self.first_byte - self.started if self.first_byte is not None else None
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ThroughputStats:
+    """Rolling window of the last ``window`` generations per model."""
+
+    FIELDS = ("decode_tps", "prefill_tps", "ttft_s", "load_s")
+
+    def __init__(self, window=50):
+        self.window = window
+        self._samples = {}
+        self.requests = {}
+
+    def record(self, tap):
+        """Add the stats of one finished generation; returns its model name."""
+        frame = tap.final
+        if not frame or not frame.get("model"):
+            return None
+        model = frame["model"]
+        sample = {"at": time.time()}
+        if frame.get("eval_count") and frame.get("eval_duration"):
+            sample["decode_tps"] = frame["eval_count"] / (frame["eval_duration"] / 1e9)
+        if frame.get("prompt_eval_count") and frame.get("prompt_eval_duration"):
+            sample["prefill_tps"] = frame["prompt_eval_count"] / (frame["prompt_eval_duration"] / 1e9)
+        if tap.ttft is not None:
+            sample["ttft_s"] = tap.ttft
+        if frame.get("load_duration") is not None:
+            sample["load_s"] = frame["load_duration"] / 1e9
+        self._samples.setdefault(model, deque(maxlen=self.window)).append(sample)
+        self.requests[model] = self.requests.get(model, 0) + 1
+        return model
+
+    def snapshot(self):
+        """``{model: {field: {avg, p50, p95, last}, samples, device}}`` over the current window."""
+        result = {}
+        for model, samples in self._samples.items():
+            entry = {"samples": len(samples), "device": DEVICE, "requests": self.requests.get(model, 0)}
+            for field in self.FIELDS:
+                values = [s[field] for s in samples if field in s]
+                if not values:
+                    continue
+                entry[field] = {
+                    "avg": sum(values) / len(values),
+                    "p50": _percentile(values, 0.5),
+                    "p95": _percentile(values, 0.95),
+                    "last": values[-1],
+                }
+            result[model] = entry
+        return result
+
+    def gauge_values(self, field, stat="avg"):
+        """Labelled values for a metrics gauge callback: {(model, device): value}."""
+        return {(model, DEVICE): entry[field][stat]
+                for model, entry in self.snapshot().items() if field in entry}
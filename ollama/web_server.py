@@ -1,72 +1,460 @@
-import http.server
-import socketserver
-import requests
+import asyncio
+import json
 import os
 import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from backends import BackendPool, parse_backends, request_model
+from memory_manager import MemoryManager
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from model_bench import ModelBenchmark
+from proxy_cache import ResponseCache
+from pull_manager import PullManager
+from scheduler import PRIORITIES, AdmissionScheduler, Overloaded
+from static_assets import StaticAssets
+from throughput import DEVICE, STATS_PATHS, FrameTap, ThroughputStats
 
 PORT = 8099
-OLLAMA_URL = "http://localhost:11434"
-
-class ProxyHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        if self.path.startswith("/api/") or self.path.startswith("/v1/"):
-            self.proxy_request("GET")
-        elif self.path == "/" or self.path == "":
-            self.path = "/index.html"
-            return http.server.SimpleHTTPRequestHandler.do_GET(self)
-        else:
-            return http.server.SimpleHTTPRequestHandler.do_GET(self)
-
-    def do_POST(self):
-        if self.path.startswith("/api/") or self.path.startswith("/v1/"):
-            self.proxy_request("POST")
-        else:
-            self.send_error(404)
-
-    def do_DELETE(self):
-        if self.path.startswith("/api/") or self.path.startswith("/v1/"):
-            self.proxy_request("DELETE")
-        else:
-            self.send_error(404)
-
-    def end_headers(self):
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
-        super().end_headers()
-
-    def proxy_request(self, method):
-        url = f"{OLLAMA_URL}{self.path}"
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+# Other Ollama instances to route generations to, e.g. the GPU add-on's (comma-separated)
+OLLAMA_BACKENDS = parse_backends(os.environ.get("OLLAMA_BACKENDS"))
+# Seconds to reuse api/tags, api/ps and api/show responses; 0 disables the cache
+PROXY_CACHE_TTL = float(os.environ.get("PROXY_CACHE_TTL") or 3)
+# Generation requests let through to Ollama at once; the rest wait in the proxy's queue
+NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL") or 1)
+PROXY_MAX_QUEUE = int(os.environ.get("PROXY_MAX_QUEUE") or 16)
+PROXY_QUEUE_TIMEOUT = float(os.environ.get("PROXY_QUEUE_TIMEOUT") or 120)
+# Largest request body read whole: routed generations (replayed on failover) and
+# api/show lookups. Image prompts carry base64 images, so this is generous.
+MAX_BODY_SIZE = 256 * 1024 * 1024
+# Unfinished pulls are recorded here and resumed after a restart
+PULL_STATE_FILE = os.environ.get("PULL_STATE_FILE") or ("/data/pulls.json" if os.path.isdir("/data") else None)
+PULL_CONCURRENCY = int(os.environ.get("PULL_CONCURRENCY") or 2)
+# The configured model, preloaded at startup (the last one selected in the UI wins)
+PRELOAD_MODEL = os.environ.get("MODEL") or None
+KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE") or "5m"
+# RAM use (percent) at which idle models are unloaded
+MEMORY_PRESSURE_PERCENT = float(os.environ.get("MEMORY_PRESSURE_PERCENT") or 85)
+ADAPTIVE_KEEP_ALIVE = (os.environ.get("ADAPTIVE_KEEP_ALIVE") or "true").lower() != "false"
+BENCHMARK_FILE = os.environ.get("BENCHMARK_FILE") or ("/data/benchmarks.json" if os.path.isdir("/data") else None)
+WEB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Connection-level headers that must not be forwarded by a proxy (RFC 7230 6.1)
+HOP_BY_HOP = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'host',
+}
+
+STATS = ThroughputStats()
+GENERATIONS = REGISTRY.counter(
+    "ollama_generations_total", "Completed generations seen by the proxy", labels=("model",))
+EVAL_TOKENS = REGISTRY.counter(
+    "ollama_eval_tokens_total", "Tokens generated", labels=("model",))
+PROMPT_TOKENS = REGISTRY.counter(
+    "ollama_prompt_tokens_total", "Prompt tokens evaluated", labels=("model",))
+for _field, _name, _doc in (
+        ("decode_tps", "ollama_decode_tokens_per_second", "Decode speed, rolling average"),
+        ("prefill_tps", "ollama_prefill_tokens_per_second", "Prompt evaluation speed, rolling average"),
+        ("ttft_s", "ollama_time_to_first_token_seconds", "Time from request to first response byte, rolling average"),
+        ("load_s", "ollama_model_load_seconds", "Model load time reported by Ollama, rolling average")):
+    REGISTRY.gauge(_name, _doc, labels=("model", "device"),
+                   callback=lambda field=_field: STATS.gauge_values(field))
+
+POOL = BackendPool(OLLAMA_URL, OLLAMA_BACKENDS)
+REGISTRY.gauge("ollama_backend_up", "Whether each Ollama instance passed its last health check", labels=("backend",),
+               callback=lambda: {(b.name,): int(b.healthy) for b in POOL.backends})
+REGISTRY.gauge("ollama_backend_active_requests", "Requests each Ollama instance is running for the proxy",
+               labels=("backend",), callback=lambda: {(b.name,): b.active for b in POOL.backends})
+BACKEND_REQUESTS = REGISTRY.counter(
+    "ollama_backend_requests_total", "Generation requests routed to each Ollama instance", labels=("backend",))
+FAILOVERS = REGISTRY.counter(
+    "ollama_backend_failovers_total", "Requests retried on another instance because theirs was unreachable",
+    labels=("backend",))
+
+# Every instance gets NUM_PARALLEL slots (the others are assumed to be configured alike)
+SCHEDULER = AdmissionScheduler(slots=NUM_PARALLEL * len(POOL.backends), max_queue=PROXY_MAX_QUEUE,
+                               queue_timeout=PROXY_QUEUE_TIMEOUT)
+REGISTRY.gauge("ollama_proxy_active_requests", "Generation requests holding a slot",
+               callback=lambda: SCHEDULER.active)
+REGISTRY.gauge("ollama_proxy_queue_depth", "Generation requests waiting for a slot", labels=("priority",),
+               callback=lambda: {(p,): SCHEDULER.depth(p) for p in PRIORITIES})
+QUEUE_WAIT = REGISTRY.histogram(
+    "ollama_proxy_queue_wait_seconds", "Time generation requests spent queued", labels=("priority",))
+REJECTED = REGISTRY.counter(
+    "ollama_proxy_rejected_total", "Generation requests turned away with 429", labels=("priority", "reason"))
+
+MEMORY = MemoryManager(OLLAMA_URL, keep_alive=KEEP_ALIVE, pressure_percent=MEMORY_PRESSURE_PERCENT,
+                       adaptive=ADAPTIVE_KEEP_ALIVE)
+REGISTRY.gauge("ollama_memory_available_bytes", "RAM available to new allocations",
+               callback=lambda: MEMORY.sample['available'] if MEMORY.sample else 0)
+REGISTRY.gauge("ollama_swap_used_bytes", "Swap in use",
+               callback=lambda: MEMORY.sample['swap_used'] if MEMORY.sample else 0)
+REGISTRY.gauge("ollama_model_resident_bytes", "Memory held by each loaded model", labels=("model",),
+               callback=lambda: {(u.name,): u.size for u in MEMORY.models.values() if u.resident})
+UNLOADS = REGISTRY.counter(
+    "ollama_model_unloads_total", "Models unloaded because memory ran short", labels=("model", "reason"))
+
+NO_CACHE_HEADERS = {
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+}
+
+
+class BackendUnavailable(Exception):
+    """The chosen Ollama instance could not be reached before anything was sent to the client."""
+
+
+def forward_headers(headers):
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP}
+
+
+async def proxy_request(request):
+    """Proxy entry point: cached read-only endpoints, queued generations, streaming relay for the rest."""
+    cache = request.app['response_cache']
+    if cache.cacheable(request.method, request.path):
+        return await cached_proxy_request(request)
+
+    cache.invalidate_for(request.method, request.path)
+    try:
+        if SCHEDULER.gated(request.method, request.path):
+            return await scheduled_proxy_request(request)
+        return await stream_proxy_request(request)
+    finally:
+        # A pull or delete changes the model list when it completes, not when it starts
+        cache.invalidate_for(request.method, request.path)
+
+
+def request_priority(request):
+    """Explicit X-Priority wins; the Ingress UI is interactive; anything else is normal."""
+    priority = request.headers.get('X-Priority', '').lower()
+    if priority in PRIORITIES:
+        return priority
+    return 'interactive' if 'X-Ingress-Path' in request.headers else 'normal'
+
+
+def request_client(request):
+    return (request.headers.get('X-Client-Id') or request.headers.get('X-Remote-User-Id')
+            or request.remote or 'unknown')
+
+
+async def scheduled_proxy_request(request):
+    """Relay a generation request once one of Ollama's parallel slots is free."""
+    priority = request_priority(request)
+    try:
+        async with SCHEDULER.slot(priority, request_client(request)) as waited:
+            QUEUE_WAIT.observe(waited, priority=priority)
+            if request.transport is None or request.transport.is_closing():
+                # Gave up while queued; don't start a generation nobody will read
+                return web.Response(status=499, headers=NO_CACHE_HEADERS)
+            if POOL.multiple:
+                return await routed_proxy_request(request)
+            return await stream_proxy_request(request)
+    except Overloaded as e:
+        REJECTED.inc(priority=priority, reason=e.reason)
+        headers = dict(NO_CACHE_HEADERS, **{'Retry-After': str(e.retry_after)})
+        return web.json_response({'error': f"Ollama is busy ({e.reason}), retry in {e.retry_after}s"},
+                                 status=429, headers=headers)
+
+
+async def routed_proxy_request(request):
+    """Send a generation to the instance expected to answer it first, failing over to the next best."""
+    body = await request.read() if request.body_exists else b''
+    model = request_model(body)
+    tried = []
+    while True:
+        backend = POOL.choose(model, exclude=tried)
+        if backend is None:
+            return web.Response(status=502, text="No Ollama instance is reachable", headers=NO_CACHE_HEADERS)
+        tried.append(backend)
         try:
-            headers = {k: v for k, v in self.headers.items() if k.lower() != 'host'}
-            
-            body = None
-            if method in ["POST", "DELETE", "PUT", "PATCH"]:
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length > 0:
-                    body = self.rfile.read(content_length)
-            
-            resp = requests.request(method, url, data=body, headers=headers, stream=True)
-
-            self.send_response(resp.status_code)
-            for key, value in resp.headers.items():
-                if key.lower() not in ['content-encoding', 'transfer-encoding', 'content-length', 'connection']:
-                    self.send_header(key, value)
-            self.end_headers()
-
-            for chunk in resp.iter_content(chunk_size=4096):
-                self.wfile.write(chunk)
-                self.wfile.flush()
-
-        except Exception as e:
-            print(f"Proxy error: {e}", file=sys.stderr)
-            self.send_error(500, str(e))
+            return await stream_proxy_request(request, backend, body or None, model=model, failover=True)
+        except BackendUnavailable as e:
+            print(f"Ollama backend {backend.name} unreachable, trying the next one: {e}", file=sys.stderr)
+            POOL.mark_failed(backend, e)
+            FAILOVERS.inc(backend=backend.name)
+
+
+async def stream_proxy_request(request, backend=None, body=None, model=None, failover=False):
+    """
+    Relay one request to Ollama over the shared keep-alive pool.
+
+    Request bodies are streamed upstream as they arrive and responses are
+    relayed chunk by chunk. Each write waits for the client to drain, and
+    while it waits nothing more is read from Ollama, so a slow client
+    throttles the upstream stream instead of buffering it in memory.
+    With ``failover``, an instance that cannot be reached raises
+    BackendUnavailable instead of answering 502, as long as nothing has been
+    sent to the client yet.
+    """
+    started = time.monotonic()
+    session = request.app['ollama_session']
+    backend = backend or POOL.local
+    url = f"{backend.url}{request.rel_url}"
+    if body is None and request.body_exists:
+        body = request.content
+    response = None
+    if SCHEDULER.gated(request.method, request.path):
+        POOL.begin(backend, model)
+        BACKEND_REQUESTS.inc(backend=backend.name)
+    try:
+        async with session.request(request.method, url,
+                                   headers=forward_headers(request.headers),
+                                   data=body, allow_redirects=False) as upstream:
+            response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+            response.headers.update(forward_headers(upstream.headers))
+            response.headers.update(NO_CACHE_HEADERS)
+            await response.prepare(request)
+            # Watch generation responses for Ollama's final stats frame
+            tap = None
+            if request.path in STATS_PATHS and 'Content-Encoding' not in upstream.headers:
+                tap = FrameTap(started)
+            try:
+                async for chunk in upstream.content.iter_any():
+                    if tap is not None:
+                        tap.feed(chunk)
+                    await response.write(chunk)
+                await response.write_eof()
+                if tap is not None:
+                    record_generation(tap, backend)
+            except ConnectionResetError:
+                # Client went away; closing the upstream connection makes Ollama stop generating
+                upstream.close()
+            return response
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if failover and (response is None or not response.prepared):
+            raise BackendUnavailable(str(e) or type(e).__name__) from e
+        print(f"Proxy error: {e}", file=sys.stderr)
+        if response is not None and response.prepared:
+            # Headers and part of the body are out; dropping the connection is
+            # the only way to tell the client the answer is incomplete
+            if request.transport is not None:
+                request.transport.close()
+            return response
+        return web.Response(status=502, text=f"Ollama is not reachable: {e}", headers=NO_CACHE_HEADERS)
+    finally:
+        if SCHEDULER.gated(request.method, request.path):
+            POOL.end(backend)
+
+
+def record_generation(tap, backend=None):
+    tap.close()
+    if tap.final is None:
+        return
+    if backend is not None:
+        POOL.record(backend, tap.final)
+    if backend is not None and not backend.local:
+        # Throughput stats and memory management describe this instance only
+        model = tap.final.get("model")
+    else:
+        model = STATS.record(tap)
+        if model:
+            MEMORY.record_use(model)
+    if model:
+        GENERATIONS.inc(model=model)
+        EVAL_TOKENS.inc(tap.final.get("eval_count") or 0, model=model)
+        PROMPT_TOKENS.inc(tap.final.get("prompt_eval_count") or 0, model=model)
+
+
+async def handle_metrics(request):
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+async def handle_stats(request):
+    return web.json_response({"models": STATS.snapshot(), "queue": SCHEDULER.snapshot(),
+                              "memory": MEMORY.snapshot(), "backends": POOL.snapshot()},
+                             headers=NO_CACHE_HEADERS)
+
+
+async def cached_proxy_request(request):
+    """Serve a small read-only endpoint from the response cache, fetching it once on a miss."""
+    session = request.app['ollama_session']
+    cache = request.app['response_cache']
+    body = await request.read() if request.body_exists else b''
+    key = (request.method, request.path, request.query_string, body)
+    headers = forward_headers(request.headers)
+
+    async def fetch():
+        if POOL.multiple and request.path in ('/api/tags', '/api/ps'):
+            status, merged = await POOL.merged(request.path)
+            return status, {'Content-Type': 'application/json'}, merged
+        # api/show answers from an instance that has the model
+        backend = POOL.choose(request_model(body)) if POOL.multiple else POOL.local
+        url = f"{backend.url}{request.rel_url}"
+        async with session.request(request.method, url, headers=headers,
+                                   data=body or None, allow_redirects=False) as upstream:
+            resp_headers = {k: v for k, v in forward_headers(upstream.headers).items()
+                            if k.lower() != 'content-length'}
+            return upstream.status, resp_headers, await upstream.read()
+
+    try:
+        status, resp_headers, resp_body, hit = await cache.get_or_fetch(key, fetch)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Proxy error: {e}", file=sys.stderr)
+        return web.Response(status=502, text=f"Ollama is not reachable: {e}", headers=NO_CACHE_HEADERS)
+    response = web.Response(status=status, body=resp_body, headers=resp_headers)
+    response.headers.update(NO_CACHE_HEADERS)
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+
+async def handle_pulls(request):
+    return web.json_response(request.app['pulls'].snapshot(), headers=NO_CACHE_HEADERS)
+
+
+async def model_from_body(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    model = data.get('model') if isinstance(data, dict) else None
+    if not model or not isinstance(model, str):
+        raise web.HTTPBadRequest(text='Expected {"model": "<name>"}')
+    return model
+
+
+async def handle_pull_start(request):
+    job = request.app['pulls'].pull(await model_from_body(request))
+    return web.json_response(job.summary(), status=202, headers=NO_CACHE_HEADERS)
+
+
+async def handle_pull_cancel(request):
+    if not request.app['pulls'].cancel(request.match_info['model']):
+        return web.json_response({'error': 'No running pull for that model'}, status=404, headers=NO_CACHE_HEADERS)
+    return web.json_response({'status': 'cancelled'}, headers=NO_CACHE_HEADERS)
+
+
+async def handle_pull_events(request):
+    """Server-sent events: the current pulls, then every progress update."""
+    pulls = request.app['pulls']
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'X-Accel-Buffering': 'no',
+        **NO_CACHE_HEADERS,
+    })
+    await response.prepare(request)
+    queue = pulls.subscribe()
+    try:
+        await response.write(f"event: snapshot\ndata: {json.dumps(pulls.snapshot())}\n\n".encode())
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), 15)
+            except asyncio.TimeoutError:
+                # Keeps Ingress and other proxies from closing an idle stream
+                await response.write(b": ping\n\n")
+                continue
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        pulls.unsubscribe(queue)
+    return response
+
+
+async def handle_select_model(request):
+    """Switch the active model without a restart; pulls it first if needed."""
+    pulls = request.app['pulls']
+    model = await model_from_body(request)
+    task = asyncio.ensure_future(pulls.select(model))
+    # Keep a reference so the switch outlives this request
+    request.app['model_switches'].add(task)
+    task.add_done_callback(request.app['model_switches'].discard)
+    return web.json_response({'status': 'switching', 'model': model}, status=202, headers=NO_CACHE_HEADERS)
+
+
+async def handle_benchmark(request):
+    return web.json_response(request.app['benchmark'].snapshot(), headers=NO_CACHE_HEADERS)
+
+
+async def handle_benchmark_start(request):
+    benchmark = request.app['benchmark']
+    if benchmark.running:
+        return web.json_response({'error': 'A benchmark is already running'}, status=409, headers=NO_CACHE_HEADERS)
+    start_benchmark(request.app)
+    return web.json_response(benchmark.snapshot(), status=202, headers=NO_CACHE_HEADERS)
+
+
+def start_benchmark(app):
+    # One model at a time in a background slot, so live requests go first
+    return app['benchmark'].start(app['ollama_session'], gate=lambda: SCHEDULER.slot('background', 'benchmark'))
+
+
+async def start_session(app):
+    connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+    app['ollama_session'] = aiohttp.ClientSession(
+        connector=connector,
+        # Generations can stream for a long time; only bound connection setup
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+        # Relay bytes exactly as Ollama sent them (Content-Encoding included)
+        auto_decompress=False,
+    )
+
+
+async def start_pulls(app):
+    pulls = app['pulls']
+    # New models change api/tags
+    pulls.on_complete.append(lambda model: app['response_cache'].invalidate())
+    pulls.start(app['ollama_session'])
+
+
+async def start_memory(app):
+    MEMORY.on_unload.append(lambda model, reason: UNLOADS.inc(model=model, reason=reason))
+    MEMORY.start(app['ollama_session'], preferred=lambda: app['pulls'].active or PRELOAD_MODEL,
+                 busy=lambda: SCHEDULER.active > 0)
+
+
+async def start_backends(app):
+    POOL.start(app['ollama_session'])
+
+
+async def close_session(app):
+    for task in list(app['model_switches']):
+        task.cancel()
+    await POOL.close()
+    await MEMORY.close()
+    if app['benchmark'].running:
+        app['benchmark'].task.cancel()
+    await app['pulls'].close()
+    await app['ollama_session'].close()
+
+
+def create_app():
+    # Most bodies are streamed upstream, but routed generations and cached
+    # lookups are read whole, and aiohttp caps those at 1 MB by default
+    app = web.Application(client_max_size=MAX_BODY_SIZE)
+    app['response_cache'] = ResponseCache(ttl=PROXY_CACHE_TTL)
+    app['pulls'] = PullManager(OLLAMA_URL, state_file=PULL_STATE_FILE, concurrency=PULL_CONCURRENCY)
+    app['model_switches'] = set()
+    app['benchmark'] = ModelBenchmark(OLLAMA_URL, results_file=BENCHMARK_FILE, device=DEVICE)
+    app.on_startup.append(start_session)
+    app.on_startup.append(start_pulls)
+    app.on_startup.append(start_memory)
+    app.on_startup.append(start_backends)
+    app.on_cleanup.append(close_session)
+    # UI files are loaded and precompressed once; only /api/ responses are no-store
+    assets = StaticAssets()
+    index_file = os.path.join(WEB_DIR, 'index.html')
+    assets.add('/', index_file)
+    assets.add('/index.html', index_file)
+    assets.register(app.router)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/stats', handle_stats)
+    app.router.add_get('/pulls', handle_pulls)
+    app.router.add_post('/pulls', handle_pull_start)
+    app.router.add_get('/pulls/events', handle_pull_events)
+    app.router.add_delete('/pulls/{model:.+}', handle_pull_cancel)
+    app.router.add_post('/model', handle_select_model)
+    app.router.add_get('/benchmark', handle_benchmark)
+    app.router.add_post('/benchmark', handle_benchmark_start)
+    for prefix in ('/api/', '/v1/'):
+        app.router.add_route('*', prefix + '{tail:.*}', proxy_request)
+    return app
+
 
 if __name__ == "__main__":
-    # Serve files from the directory where this script is located
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    # Allow reuse address to avoid "Address already in use" on restart
-    socketserver.ThreadingTCPServer.allow_reuse_address = True
-    with socketserver.ThreadingTCPServer(("", PORT), ProxyHandler) as httpd:
-        print(f"Serving UI on port {PORT}")
-        httpd.serve_forever()
+    print(f"Serving UI on port {PORT}")
+    # reuse_address avoids "Address already in use" on restart
+    web.run_app(create_app(), port=PORT, reuse_address=True, access_log=None, print=None)
@@ -1,30 +1,18 @@
-import urllib.request
 import re
 import os
 
+from model_catalog import ModelCatalog, SPECIAL_CASES
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(SCRIPT_DIR, "config.yaml")
 
 def fetch_popular_models():
     print("Fetching popular models from Ollama Library...")
-    url = "https://ollama.com/library"
     try:
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req) as response:
-            html = response.read().decode('utf-8')
+        return ModelCatalog().get()
     except Exception as e:
         print(f"Failed to fetch library: {e}")
         return []
-    
-    # Simple regex to find /library/model-name in hrefs
-    pattern = r'href="/library/([^/"]+)"'
-    models = re.findall(pattern, html)
-    
-    # Remove duplicates but keep order
-    seen = set()
-    unique_models = [x for x in models if not (x in seen or seen.add(x))]
-    
-    return unique_models
 
 def update_config_string(models):
     if not os.path.exists(CONFIG_PATH):
@@ -37,19 +25,9 @@ def update_config_string(models):
     # Create the list of models with some common variants
     model_options = []
     
-    # Known high-profile models and their common tags
-    special_cases = {
-        "gemma3": ["270m", "1b", "4b", "12b", "27b", "vision"],
-        "llama3.2": ["1b", "3b"],
-        "llama3.1": ["8b", "70b"],
-        "phi3.5": ["latest"],
-        "gemma2": ["2b", "9b", "27b"],
-        "mistral": ["7b"]
-    }
-
     for m in models:
-        if m in special_cases:
-            for v in special_cases[m]:
+        if m in SPECIAL_CASES:
+            for v in SPECIAL_CASES[m]:
                 model_options.append(f"{m}:{v}")
         else:
             model_options.append(m)
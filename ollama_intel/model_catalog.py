@@ -0,0 +1,206 @@
+"""
+Cached view of the Ollama model library (https://ollama.com/library).
+
+Shared by the Moltbot bridge (model picker) and the fetch_models.py helpers.
+This file is kept identical in every add-on that uses it, and it only uses
+the standard library so it runs in any of the images.
+
+- Results are kept in memory and on disk (``model_catalog.json``) with a TTL.
+- Refreshes are conditional (ETag / Last-Modified), so an unchanged library
+  costs a 304 instead of a full page download.
+- Concurrent callers share one refresh (single-flight).
+- A stale copy is served immediately while a refresh runs in the background,
+  and is kept if the refresh fails (offline).
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("model_catalog")
+
+LIBRARY_URL = "https://ollama.com/library"
+DEFAULT_TTL = 6 * 3600
+
+# Known high-profile models and their common tags
+SPECIAL_CASES = {
+    "gemma3": ["270m", "1b", "4b", "12b", "27b", "vision"],
+    "llama3.2": ["1b", "3b"],
+    "llama3.1": ["8b", "70b"],
+    "phi3.5": ["latest"],
+    "gemma2": ["2b", "9b", "27b"],
+    "mistral": ["7b"]
+}
+
+# (status, headers, body) for a GET with the given request headers
+FetchResult = Tuple[int, Dict[str, str], bytes]
+
+
+def default_cache_dir() -> str:
+    """/data inside an add-on, a user cache directory when run from a checkout."""
+    if os.environ.get("MODEL_CATALOG_DIR"):
+        return os.environ["MODEL_CATALOG_DIR"]
+    if os.path.isdir("/data") and os.access("/data", os.W_OK):
+        return "/data"
+    return os.path.join(os.path.expanduser("~"), ".cache", "ha-ai-addons")
+
+
+def parse_library(html: str) -> List[str]:
+    # Simple regex to find /library/model-name in hrefs
+    pattern = r'href="/library/([^/"]+)"'
+    models = re.findall(pattern, html)
+    # Remove duplicates but keep order
+    seen = set()
+    return [x for x in models if not (x in seen or seen.add(x))]
+
+
+def with_variants(models: List[str]) -> List[Dict[str, List[str]]]:
+    return [{"name": m, "variants": SPECIAL_CASES.get(m, ["latest"])} for m in models]
+
+
+def urllib_fetch(url: str, headers: Dict[str, str], timeout: float = 15) -> FetchResult:
+    req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0', **headers})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, dict(response.headers), response.read()
+    except urllib.error.HTTPError as e:
+        # urllib raises for 304 Not Modified as well
+        return e.code, dict(e.headers or {}), b""
+
+
+class ModelCatalog:
+    def __init__(self, cache_dir: Optional[str] = None, ttl: float = DEFAULT_TTL,
+                 url: str = LIBRARY_URL,
+                 fetch: Callable[[str, Dict[str, str]], FetchResult] = urllib_fetch,
+                 async_fetch: Optional[Callable[[str, Dict[str, str]], Awaitable[FetchResult]]] = None):
+        self.url = url
+        self.ttl = ttl
+        self.cache_path = os.path.join(cache_dir or default_cache_dir(), "model_catalog.json")
+        self._fetch = fetch
+        self._async_fetch = async_fetch
+        self._entry: Optional[Dict] = None
+        self._lock = threading.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._load_disk()
+
+    # --- Cache state ---
+
+    @property
+    def models(self) -> List[str]:
+        return list(self._entry["models"]) if self._entry else []
+
+    @property
+    def age(self) -> Optional[float]:
+        return time.time() - self._entry["fetched_at"] if self._entry else None
+
+    def is_fresh(self) -> bool:
+        return self._entry is not None and self.age < self.ttl
+
+    def _load_disk(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                entry = json.load(f)
+            if isinstance(entry.get("models"), list) and entry.get("url") == self.url:
+                self._entry = entry
+        except (OSError, ValueError):
+            pass
+
+    def _save_disk(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp = f"{self.cache_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self._entry, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write model catalog cache: {e}")
+
+    def _conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self._entry and self._entry.get("etag"):
+            headers["If-None-Match"] = self._entry["etag"]
+        if self._entry and self._entry.get("last_modified"):
+            headers["If-Modified-Since"] = self._entry["last_modified"]
+        return headers
+
+    def _apply(self, result: FetchResult) -> List[str]:
+        status, headers, body = result
+        headers = {k.lower(): v for k, v in headers.items()}
+        if status == 304 and self._entry:
+            self._entry["fetched_at"] = time.time()
+        elif status == 200:
+            models = parse_library(body.decode("utf-8", errors="replace"))
+            if not models:
+                raise ValueError("No models found in library page")
+            self._entry = {
+                "url": self.url,
+                "models": models,
+                "fetched_at": time.time(),
+                "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"),
+            }
+        else:
+            raise IOError(f"Library returned HTTP {status}")
+        self._save_disk()
+        return self.models
+
+    # --- Synchronous API (fetch_models.py) ---
+
+    def refresh(self) -> List[str]:
+        """Revalidate now. Threads arriving mid-refresh wait for it instead of fetching again."""
+        if not self._lock.acquire(blocking=False):
+            with self._lock:
+                return self.models
+        try:
+            return self._apply(self._fetch(self.url, self._conditional_headers()))
+        finally:
+            self._lock.release()
+
+    def get(self, force_refresh: bool = False) -> List[str]:
+        if self.is_fresh() and not force_refresh:
+            return self.models
+        try:
+            return self.refresh()
+        except Exception as e:
+            if self._entry:
+                logger.warning(f"Failed to refresh model library ({e}), using cached copy")
+                return self.models
+            raise
+
+    # --- Async API (bridge) ---
+
+    async def _refresh_async(self) -> List[str]:
+        headers = self._conditional_headers()
+        if self._async_fetch:
+            result = await self._async_fetch(self.url, headers)
+        else:
+            result = await asyncio.to_thread(self._fetch, self.url, headers)
+        return self._apply(result)
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_async())
+            self._refresh_task.add_done_callback(self._log_refresh_failure)
+        return self._refresh_task
+
+    def _log_refresh_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Model library refresh failed: {task.exception()}")
+
+    async def aget(self) -> List[str]:
+        """
+        Fresh cache: returned as is. Stale cache: returned immediately while one
+        background refresh revalidates it. No cache: wait for that refresh.
+        """
+        if self.is_fresh():
+            return self.models
+        task = self._start_refresh()
+        if self._entry:
+            return self.models
+        return await asyncio.shield(task)
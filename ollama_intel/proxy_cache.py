@@ -0,0 +1,112 @@
+"""
+Short-lived cache for Ollama's read-only endpoints.
+
+Every open UI tab polls ``api/tags`` and ``api/ps``; within the TTL all of
+them share one upstream response, and requests for the same key that arrive
+while it is being fetched wait for that single call. Anything that changes
+the model list invalidates the cache as it passes through the proxy.
+"""
+import asyncio
+import time
+
+# path -> methods whose responses may be cached (api/show is a POST with a JSON body)
+CACHEABLE = {
+    '/api/tags': ('GET',),
+    '/api/ps': ('GET',),
+    '/api/show': ('GET', 'POST'),
+}
+
+# Requests that change the installed models: drop everything
+MODEL_WRITES = ('/api/delete', '/api/pull', '/api/create', '/api/copy', '/api/push')
+# Requests that load or unload models: drop api/ps only
+MODEL_LOADS = ('/api/generate', '/api/chat', '/api/embed', '/api/embeddings', '/v1/')
+
+
+class ResponseCache:
+    def __init__(self, ttl=3.0, max_entries=128):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expires_at, status, headers, body)
+        self._entries = {}
+        self._inflight = {}
+        # Bumped on invalidation so a fetch that started before it is not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def cacheable(self, method, path):
+        return self.enabled and method in CACHEABLE.get(path, ())
+
+    def invalidate(self, path=None):
+        """Drop every entry, or only those for ``path``."""
+        self._generation += 1
+        if path is None:
+            self._entries.clear()
+        else:
+            for key in [k for k in self._entries if k[1] == path]:
+                del self._entries[key]
+
+    def invalidate_for(self, method, path):
+        """Invalidate whatever a request passing through the proxy may have changed."""
+        if not self.enabled or method == 'GET':
+            return
+        if path.startswith(MODEL_WRITES):
+            self.invalidate()
+        elif path.startswith(MODEL_LOADS):
+            self.invalidate('/api/ps')
+
+    async def get_or_fetch(self, key, fetch):
+        """
+        Return ``(status, headers, body, hit)`` for ``key``. ``fetch`` is an
+        async callable returning ``(status, headers, body)``; only one runs per
+        key at a time and only 200 responses are stored.
+        """
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1], entry[2], entry[3], True
+
+        future = self._inflight.get(key)
+        if future is not None:
+            try:
+                status, headers, body = await asyncio.shield(future)
+                self.hits += 1
+                return status, headers, body, True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The request we were waiting on was abandoned; fetch ourselves
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        generation = self._generation
+        try:
+            status, headers, body = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting; don't log "exception never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result((status, headers, body))
+        if status == 200 and generation == self._generation:
+            if len(self._entries) >= self.max_entries:
+                self._evict()
+            self._entries[key] = (time.monotonic() + self.ttl, status, headers, body)
+        return status, headers, body, False
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e[0] <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
@@ -15,6 +15,13 @@ MAX_LOADED_MODELS=$(bashio::config 'max_loaded_models')
 NUM_CTX=$(bashio::config 'num_ctx')
 GPU_OVERHEAD=$(bashio::config 'gpu_overhead')
 DEBUG=$(bashio::config 'debug')
+# The Web UI preloads this model and keeps it loaded while memory allows
+MODEL=$(bashio::config 'model')
+export MODEL
+# Other Ollama instances the Web UI proxy may route requests to
+if bashio::config.has_value 'backends'; then
+    export OLLAMA_BACKENDS=$(bashio::config 'backends')
+fi
 
 export OLLAMA_KEEP_ALIVE="$KEEP_ALIVE"
 export OLLAMA_NUM_PARALLEL="$NUM_PARALLEL"
@@ -65,24 +72,47 @@ until curl -s -f "http://localhost:11434/" > /dev/null; do
 done
 bashio::log.info "Ollama is online!"
 
-# --- 3. Model Management ---
-MODEL=$(bashio::config 'model')
+# --- 3. Start Web UI ---
+# Started before the model check so the UI can show download progress
+bashio::log.info "Starting Web UI..."
+python3 -u /web_server.py 2>&1 &
+WEB_PID=$!
+
+# Up to 30 seconds; without the Web UI the model is pulled directly below
+WEB_READY=false
+for _ in $(seq 60); do
+    if curl -s -f "http://localhost:8099/pulls" > /dev/null; then
+        WEB_READY=true
+        break
+    fi
+    if ! kill -0 "$WEB_PID" 2>/dev/null; then
+        bashio::log.error "Web UI exited during startup."
+        break
+    fi
+    sleep 0.5
+done
+[ "$WEB_READY" = true ] || bashio::log.warning "Web UI is not available; model downloads won't show progress."
+
+# --- 4. Model Management ---
 bashio::log.info "Checking model: $MODEL"
 
-if ollama list | grep -q "$MODEL"; then
+# Exact tag match; a plain grep would take "llama3.2" as "llama3"
+WANTED="$MODEL"
+[[ "${MODEL##*/}" == *:* ]] || WANTED="$MODEL:latest"
+if ollama list | awk 'NR > 1 {print $1}' | grep -qxF "$WANTED"; then
     bashio::log.info "Model '$MODEL' already present."
+elif [ "$WEB_READY" = true ]; then
+    # The Web UI's pull manager downloads in the background and resumes after a restart
+    bashio::log.info "Downloading '$MODEL' in the background. Progress is shown in the Web UI."
+    curl -s -X POST "http://localhost:8099/pulls" \
+        -H "Content-Type: application/json" \
+        -d "$(jq -n --arg model "$MODEL" '{model: $model}')" > /dev/null
 else
     bashio::log.info "Downloading '$MODEL'. This may take a while..."
-    ollama pull "$MODEL"
-    bashio::log.info "Download of '$MODEL' complete."
+    ollama pull "$MODEL" || bashio::log.error "Download of '$MODEL' failed."
 fi
 
-# --- 4. Keep Running ---
+# --- 5. Keep Running ---
 bashio::log.info "Ready to serve. Keep-alive set to: $KEEP_ALIVE"
 
-# --- 5. Start Web UI ---
-bashio::log.info "Starting Web UI..."
-python3 -u /web_server.py 2>&1 &
-WEB_PID=$!
-
-wait "$PID" "$WEB_PID"
\ No newline at end of file
+wait "$PID" "$WEB_PID"
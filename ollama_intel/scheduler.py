@@ -0,0 +1,152 @@
+"""
+Admission control for generation requests going through the proxy.
+
+Ollama runs at most ``OLLAMA_NUM_PARALLEL`` requests at once and queues the
+rest internally with no limit and no visibility, so a burst of automation
+calls can leave an interactive chat waiting until it times out. The proxy
+instead holds that many slots itself and queues the overflow here:
+
+- Waiters are grouped by priority class and served strictly in class order
+  (interactive, then normal, then background).
+- Within a class, clients take turns, so one busy client cannot starve the
+  others.
+- The queue is bounded. When it is full, a new request displaces a waiter
+  of a lower class, or is rejected itself. Rejections carry a Retry-After
+  estimate.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+PRIORITIES = ('interactive', 'normal', 'background')
+
+# Requests that occupy one of Ollama's parallel slots
+GATED_PATHS = (
+    '/api/generate', '/api/chat', '/api/embed', '/api/embeddings',
+    '/v1/chat/completions', '/v1/completions', '/v1/embeddings',
+)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionScheduler:
+    def __init__(self, slots=1, max_queue=16, queue_timeout=120.0):
+        self.slots = max(1, slots)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        # priority -> OrderedDict(client -> deque of futures); client order is the turn order
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        # Moving average of how long a request holds its slot, for Retry-After
+        self._service_time = 5.0
+
+    def gated(self, method, path):
+        return method == 'POST' and path in GATED_PATHS
+
+    def depth(self, priority):
+        return sum(len(waiters) for waiters in self._queues[priority].values())
+
+    def retry_after(self):
+        """Seconds until a new request would likely get a slot."""
+        backlog = (self.queued + 1) / self.slots
+        return max(1, min(300, math.ceil(backlog * self._service_time)))
+
+    def snapshot(self):
+        return {
+            'slots': self.slots,
+            'active': self.active,
+            'queued': {priority: self.depth(priority) for priority in PRIORITIES},
+            'max_queue': self.max_queue,
+            'avg_service_s': round(self._service_time, 3),
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority, client):
+        """Hold one slot for the duration of the block; yields the seconds spent queued."""
+        waited = await self.acquire(priority, client)
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(time.monotonic() - started)
+
+    async def acquire(self, priority, client):
+        if self.active < self.slots and self.queued == 0:
+            self.active += 1
+            return 0.0
+        if self.queued >= self.max_queue and not self._shed(priority):
+            raise Overloaded('queue full', self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        clients = self._queues[priority]
+        clients.setdefault(client, deque()).append(future)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait((future,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was handed over just as the client went away
+                self.release()
+            else:
+                self._remove(priority, client, future)
+            raise
+        if not future.done():
+            self._remove(priority, client, future)
+            raise Overloaded('queue timeout', self.retry_after())
+        # Raises Overloaded if a higher-priority request displaced this one
+        future.result()
+        return time.monotonic() - started
+
+    def release(self, service_time=None):
+        if service_time is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        for priority in PRIORITIES:
+            clients = self._queues[priority]
+            while clients:
+                client, waiters = next(iter(clients.items()))
+                future = waiters.popleft()
+                self.queued -= 1
+                if waiters:
+                    # Next turn goes to the next client
+                    clients.move_to_end(client)
+                else:
+                    del clients[client]
+                if not future.done():
+                    # Hand the slot over directly; active stays the same
+                    future.set_result(None)
+                    return
+        self.active -= 1
+
+    def _remove(self, priority, client, future):
+        waiters = self._queues[priority].get(client)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._queues[priority][client]
+        future.cancel()
+
+    def _shed(self, priority):
+        """Reject the newest waiter of a class below ``priority`` to make room."""
+        for lower in reversed(PRIORITIES[PRIORITIES.index(priority) + 1:]):
+            clients = self._queues[lower]
+            if not clients:
+                continue
+            client = next(reversed(clients))
+            waiters = clients[client]
+            future = waiters.pop()
+            self.queued -= 1
+            if not waiters:
+                del clients[client]
+            future.set_exception(Overloaded('displaced by higher priority', self.retry_after()))
+            return True
+        return False
@@ -0,0 +1,124 @@
+"""
+In-memory, precompressed static files for the add-on web UIs.
+
+Files are read once at startup and compressed with gzip (and brotli when the
+``brotli`` module is installed). Requests get the smallest encoding the client
+accepts, with a strong ETag per representation, so a reopened Ingress panel
+costs a 304 instead of a full download.
+
+This file is kept identical in every add-on that uses it.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Below this size compression is not worth the CPU or the extra header bytes
+MIN_COMPRESS_SIZE = 256
+
+
+def _accepted_encodings(header):
+    """Encodings from an Accept-Encoding header, minus any refused with q=0."""
+    accepted = set()
+    for part in header.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                pass
+        accepted.add(token)
+    return accepted
+
+
+class Asset:
+    def __init__(self, path, content_type=None, cache_control="no-cache"):
+        self.path = path
+        self.cache_control = cache_control
+        self.content_type = content_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        with open(path, "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        # encoding -> (body, etag); identity is always available
+        self.variants = {"identity": (body, f'"{digest}"')}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                self.variants["gzip"] = (gz, f'"{digest}-gz"')
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.variants["br"] = (br, f'"{digest}-br"')
+
+    def choose(self, accept_encoding):
+        accepted = _accepted_encodings(accept_encoding or "")
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def etags(self):
+        return {etag for _, etag in self.variants.values()}
+
+
+class StaticAssets:
+    def __init__(self):
+        self._assets = {}
+        self._by_file = {}
+
+    def add(self, route_path, file_path, **kwargs):
+        """Load ``file_path`` to be served at ``route_path``. Missing files are skipped."""
+        if not os.path.isfile(file_path):
+            print(f"Static asset not found: {file_path}")
+            return None
+        key = (os.path.realpath(file_path), tuple(sorted(kwargs.items())))
+        asset = self._by_file.get(key)
+        if asset is None:
+            asset = self._by_file[key] = Asset(file_path, **kwargs)
+        self._assets[route_path] = asset
+        return asset
+
+    def register(self, router):
+        for route_path, asset in self._assets.items():
+            router.add_get(route_path, self.handler(asset))
+
+    def handler(self, asset):
+        async def handle(request):
+            return self.serve(request, asset)
+        return handle
+
+    @staticmethod
+    def serve(request, asset):
+        encoding = asset.choose(request.headers.get("Accept-Encoding"))
+        body, etag = asset.variants[encoding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            # Proxies that recompress may weaken the tag; the content is still the same
+            tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+            # Any representation of the current content counts as a match
+            if "*" in tags or tags & asset.etags():
+                return web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(body=body, content_type=asset.content_type,
+                            charset="utf-8" if asset.content_type.startswith("text/") else None,
+                            headers=headers)